@@ -6,9 +6,10 @@ import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 
-from core import Node
+from core import Node, MAX_BONES, frame_stats
+from hierarchy import TransformHierarchy
 from transform import (lerp, quaternion_slerp, quaternion_matrix, translate,
-                       scale, identity)
+                       scale, identity, quaternion_slerps, trs_matrices)
 
 
 # -------------- Keyframing Utilities TP6 ------------------------------------
@@ -53,42 +54,597 @@ class TransformKeyFrames:
         scale_mat = scale(self.scale_keys.value(time))
         return translate_mat @ rotate_mat @ scale_mat
 
+    @property
+    def duration(self):
+        """ time of the last key of any component """
+        return max(max(self.translate_keys.times),
+                   max(self.rotate_keys.times),
+                   max(self.scale_keys.times))
+
+
+# -------------- Batched keyframe evaluation ----------------------------------
+class KeyTracks:
+    """ Keyframes of several channels of one component, concatenated in
+        contiguous time & value arrays. Finds the current key of every channel
+        at once, moving cursors forward while time increases """
+    def __init__(self, tracks):
+        counts = np.array([len(track['times']) for track in tracks])
+        channels = np.repeat(np.arange(len(tracks)), counts)
+        times = np.concatenate([track['times'] for track in tracks]).astype('d')
+        values = np.concatenate([track['values'] for track in tracks]).astype('f')
+        order = np.lexsort((times, channels))   # sort keys within channels
+        self.times, self.values = times[order], values[order]
+        self.starts = np.cumsum(counts) - counts
+        self.ends = self.starts + counts - 1
+
+        # channels shifted apart by more than their time range, making one
+        # sorted array that a single searchsorted call can query for all
+        self.range = (self.times.min(), self.times.max())
+        span = self.range[1] - self.range[0] + 1
+        self.offsets = np.arange(len(tracks)) * span
+        self.keys = self.times + self.offsets[channels[order]]
+        self.cursors, self.time = self.starts.copy(), -np.inf
+
+    def segments(self, time, max_steps=4):
+        """ per channel key indices before & after time, and the fraction of
+            time between them, clamped to the first and last keys """
+        time = min(max(time, self.range[0]), self.range[1])
+        cursors, steps = self.cursors, 0
+        if time >= self.time:       # forward in time: advance a few keys
+            while steps < max_steps:
+                following = np.minimum(cursors + 1, self.ends)
+                advance = (following > cursors) & (self.times[following] <= time)
+                if not advance.any():
+                    break
+                cursors[advance] += 1
+                steps += 1
+        if time < self.time or steps == max_steps:
+            cursors = np.searchsorted(self.keys, time + self.offsets, 'right') - 1
+            self.cursors = cursors = np.clip(cursors, self.starts, self.ends)
+        self.time = time
+
+        following = np.minimum(cursors + 1, self.ends)
+        start, length = self.times[cursors], self.times[following] - self.times[cursors]
+        fraction = np.divide(time - start, length, out=np.zeros_like(length),
+                             where=length > 0)
+        return cursors, following, np.clip(fraction, 0, 1)
+
+    def lerp(self, time):
+        """ linearly interpolated value of every channel """
+        before, after, fraction = self.segments(time)
+        values = self.values
+        return lerp(values[before], values[after], fraction[:, None])
+
+    def slerp(self, time):
+        """ spherically interpolated quaternion of every channel """
+        before, after, fraction = self.segments(time)
+        return quaternion_slerps(self.values[before], self.values[after], fraction)
+
+
+class ClipKeyFrames:
+    """ All channels of an animation clip, evaluated together: one pass of
+        array operations gives the TRS matrices of every animated node """
+    def __init__(self, channels):
+        """ channels: node name -> dict(position=, rotation=, scale=) of
+            dict(times=, values=) arrays, as in scene descriptions """
+        self.names = list(channels)
+        self.index = {name: channel for channel, name in enumerate(self.names)}
+        self.translate_keys, self.rotate_keys, self.scale_keys = (
+            KeyTracks([channels[name][kind] for name in self.names])
+            for kind in ('position', 'rotation', 'scale'))
+        self.duration = max(keys.range[1] for keys in (
+            self.translate_keys, self.rotate_keys, self.scale_keys))
+        self.matrices = np.zeros((len(self.names), 4, 4), 'f')
+        self.time = None
+
+    def evaluate(self, time):
+        """ (channels, 4, 4) transforms at time, computed once per time """
+        if time != self.time:
+            trs_matrices(self.translate_keys.lerp(time),
+                         self.rotate_keys.slerp(time),
+                         self.scale_keys.lerp(time), out=self.matrices)
+            self.time = time
+        return self.matrices
+
+    def channel(self, name):
+        """ keyframes-like view of one channel, for a KeyFrameControlNode """
+        return ClipChannel(self, self.index[name])
+
+
+class ClipChannel:
+    """ One channel of a ClipKeyFrames, with the TransformKeyFrames interface """
+    def __init__(self, clip, channel):
+        self.clip, self.channel = clip, channel
+        self.duration = clip.duration
+
+    def value(self, time):
+        """ transform of this channel, copied out of the clip's buffer """
+        return self.clip.evaluate(time)[self.channel].copy()
+
+
+# -------------- Baked animation tables ---------------------------------------
+class BakedTable:
+    """ Transforms of keyframes sampled at a fixed rate into a float32 table:
+        evaluation is an index computation, and an optional lerp between the
+        neighbouring samples. Higher rates trade memory for accuracy. Works
+        for one transform, or the (channels, 4, 4) matrices of a clip """
+    def __init__(self, evaluate, duration, rate, interpolate=True):
+        count = max(int(np.ceil(duration * rate)), 1) + 1
+        self.duration, self.interpolate = duration, interpolate
+        self.rate = (count - 1) / duration if duration > 0 else 0
+        self.table = np.array([np.copy(evaluate(duration * index / (count - 1)))
+                               for index in range(count)], 'f')
+        self.nbytes = self.table.nbytes
+
+        # largest deviation from the keyframes, halfway between samples
+        self.error = max((np.abs(self.value(time) - evaluate(time)).max()
+                          for time in (np.arange(count - 1) + 0.5) / self.rate)
+                         if self.rate else (), default=0.0)
+
+    def value(self, time):
+        """ sampled transform(s) at time, clamped to the sampled range """
+        position = min(max(time, 0), self.duration) * self.rate
+        last = len(self.table) - 1
+        if not self.interpolate:
+            return self.table[min(int(position + 0.5), last)].copy()
+        index = min(int(position), last)
+        return lerp(self.table[index], self.table[min(index + 1, last)],
+                    position - index)
+
+    def report(self):
+        """ one line summary of table size & accuracy """
+        return '%d samples at %.0f/s, %.1f KB, max error %.2g' % (
+            len(self.table), self.rate, self.nbytes / 1024, self.error)
+
+
+class BakedClip:
+    """ ClipKeyFrames interface over a baked table of clip matrices, which
+        can be shared by all instances of a model """
+    def __init__(self, table, names):
+        self.table, self.names = table, names
+        self.index = {name: channel for channel, name in enumerate(names)}
+        self.duration = table.duration
+        self.matrices, self.time = None, None
+
+    @staticmethod
+    def bake(clip, rate, interpolate=True):
+        """ baked table of all channels of a ClipKeyFrames """
+        return BakedTable(clip.evaluate, clip.duration, rate, interpolate)
+
+    def evaluate(self, time):
+        """ (channels, 4, 4) transforms at time, looked up once per time """
+        if time != self.time:
+            self.matrices, self.time = self.table.value(time), time
+        return self.matrices
+
+    def channel(self, name):
+        """ keyframes-like view of one channel, for a KeyFrameControlNode """
+        return ClipChannel(self, self.index[name])
+
+
 class KeyFrameControlNode(Node):
-    """ Place node with transform keys above a controlled subtree """
-    def __init__(self, trans_keys, rot_keys, scale_keys, transform=identity()):
+    """ Place node with transform keys above a controlled subtree. Keys are
+        either given as TRS dicts, or as a keyframes object (ClipChannel).
+        With a bake_rate, keys are pre-sampled in a BakedTable at that rate """
+    def __init__(self, trans_keys=None, rot_keys=None, scale_keys=None,
+                 transform=identity(), keyframes=None, bake_rate=None,
+                 interpolate=True):
         super().__init__(transform=transform)
-        self.keyframes = TransformKeyFrames(trans_keys, rot_keys, scale_keys)
+        self.keyframes = keyframes or TransformKeyFrames(trans_keys, rot_keys,
+                                                         scale_keys)
+        if bake_rate:
+            self.keyframes = BakedTable(self.keyframes.value,
+                                        self.keyframes.duration, bake_rate,
+                                        interpolate)
         # Finding the max time value in animation
-        self.lastframetime = max(max(self.keyframes.translate_keys.times),
-                                 max(self.keyframes.rotate_keys.times),
-                                 max(self.keyframes.scale_keys.times))
+        self.lastframetime = self.keyframes.duration
         self.offset = 0
         self.hasOffset = False
 
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
-        """ When redraw requested, interpolate our node transform from keys """
-        # Loop the animation when finished
+        # with an UpdatePipeline, keys are evaluated ahead, on its thread
+        self.pipelined, self.next_transform = False, None
+
+    def animation_time(self, uniforms):
+        """ time in the looping animation, None if it has no duration """
+        # Loop the animation when finished, frame time is given by the viewer
+        now = uniforms.get('time')
+        now = glfw.get_time() if now is None else now
         if(self.lastframetime != 0):
             if(uniforms.get('from_start') == True):
-                self.offset = glfw.get_time() % self.lastframetime
+                self.offset = now % self.lastframetime
                 self.hasOffset = True
 
-            time = (glfw.get_time() % self.lastframetime) - self.offset
+            return (now % self.lastframetime) - self.offset
+        return None
+
+    def update(self, time):
+        """ pipelined update: transform at frame time, kept for swap() """
+        time = self.animation_time(dict(time=time))
+        self.next_transform = None if time is None else self.keyframes.value(time)
+
+    def swap(self):
+        """ pipelined update: make the transform of update() ours """
+        if self.next_transform is not None:
+            self.transform = self.next_transform
+
+    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+        """ When redraw requested, interpolate our node transform from keys """
+        time = self.animation_time(uniforms)
+        if time is not None and not self.pipelined:
             self.transform = self.keyframes.value(time)
         super().draw(primitives=primitives, **uniforms)
 
 
 # -------------- Linear Blend Skinning : TP7 ---------------------------------
+class BonePalettes:
+    """ Bone matrices of all skeletons in one float texture buffer, matrices
+        stored as 4 RGBA texels (rows), so palettes have no size limit.
+        Skeletons own blocks of it, written during the traversal, and all
+        blocks written are sent to the GPU in one upload per frame """
+    type = GL.GL_TEXTURE_BUFFER     # bound like a Texture by draw code
+
+    def __init__(self, capacity=256):
+        self.matrices = np.zeros((capacity, 4, 4), np.float32)
+        self.free = [(0, capacity)]         # unused (offset, count) blocks
+        self.glid, self.buffer, self.size = None, None, 0
+        self.dirty = None                   # (start, stop) matrices to upload
+
+    def allocate(self, count):
+        """ offset of a new block of count matrices, growing if needed """
+        if self.glid is None:       # first skinned draw: GL context exists
+            self.glid, self.buffer = GL.glGenTextures(1), GL.glGenBuffers(1)
+        for index, (offset, size) in enumerate(self.free):
+            if size >= count:
+                self.free[index] = (offset + count, size - count)
+                return offset
+        capacity = len(self.matrices)
+        grown = max(2 * capacity, capacity + count)
+        self.matrices = np.concatenate((self.matrices, np.zeros(
+            (grown - capacity, 4, 4), np.float32)))
+        self.release(capacity, grown - capacity)
+        return self.allocate(count)
+
+    def release(self, offset, count):
+        """ give a block back, merging it with adjacent free blocks """
+        blocks = sorted(self.free + [(offset, count)])
+        self.free = [blocks[0]]
+        for offset, count in blocks[1:]:
+            last_offset, last_count = self.free[-1]
+            if last_offset + last_count == offset:
+                self.free[-1] = (last_offset, last_count + count)
+            else:
+                self.free.append((offset, count))
+
+    def write(self, offset, matrices, joints=None):
+        """ store matrices, or the rows joints of them, at offset """
+        block = self.matrices[offset:offset + len(matrices if joints is None
+                                                  else joints)]
+        if joints is None:
+            block[...] = matrices
+        else:
+            np.take(matrices, joints, axis=0, out=block)
+        start, stop = self.dirty or (offset, offset)
+        self.dirty = (min(start, offset), max(stop, offset + len(block)))
+
+    def upload(self):
+        """ send the matrices written since the last upload to the GPU """
+        if self.dirty is None and self.size == self.matrices.nbytes:
+            return
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, self.buffer)
+        if self.size != self.matrices.nbytes:   # new or grown storage
+            GL.glBufferData(GL.GL_TEXTURE_BUFFER, self.matrices,
+                            GL.GL_DYNAMIC_DRAW)
+            self.size = self.matrices.nbytes
+            GL.glBindTexture(GL.GL_TEXTURE_BUFFER, self.glid)
+            GL.glTexBuffer(GL.GL_TEXTURE_BUFFER, GL.GL_RGBA32F, self.buffer)
+        else:
+            start, stop = self.dirty
+            GL.glBufferSubData(GL.GL_TEXTURE_BUFFER, 64 * start,
+                               64 * (stop - start), self.matrices[start:stop])
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, 0)
+        self.dirty = None
+        frame_stats['palette_uploads'] += 1
+
+    def __del__(self):
+        if self.glid is not None:
+            GL.glDeleteTextures(1, [self.glid])
+            GL.glDeleteBuffers(1, [self.buffer])
+
+
+# default palette buffer of Skinned meshes, and its texture unit when drawn
+# without a render queue, above those of the mesh textures
+bone_palettes = BonePalettes()
+BONE_PALETTE_UNIT = 15
+
+
+class Skeleton(KeyFrameControlNode):
+    """ Animates the node subtree of a skinned model as a whole: each frame
+        the clip poses the local matrices of a TransformHierarchy, world
+        matrices follow level by level, and the bone palette of all attached
+        Skinned meshes is computed at once, into preallocated buffers """
+    def __init__(self, root, clip, nodes):
+        super().__init__(keyframes=clip)
+        self.clip, self.time = clip, None
+        self.poses = TransformHierarchy(root)
+        self.add(root)
+
+        # hierarchy rows posed by the clip channels of the same name
+        self.node_rows = {node: row for row, node in enumerate(self.poses.nodes)}
+        self.rows, self.channels = self.clip_rows(clip, nodes)
+
+        # palette entries, one per distinct (bone row, offset matrix) pair
+        self.joints = {}
+        self.joint_rows, self.offsets = np.empty(0, int), np.empty((0, 4, 4), 'f')
+        self.joint_world, self.palette = self.offsets.copy(), self.offsets.copy()
+        self.palette_version = None
+        self.palettes, self.block = None, None  # (offset, count) in a buffer
+        self.written_version = None
+        self.back, self.front, self.placed = None, None, None   # pipelined
+
+    def attach(self, bone_nodes, bone_offsets):
+        """ add bones of a skinned mesh to the palette, returns the palette
+            index of each bone. Meshes sharing bones share palette entries """
+        indices = []
+        for node, offset in zip(bone_nodes, np.asarray(bone_offsets, 'f')):
+            if node not in self.node_rows:
+                raise ValueError('bone %r is not in the skeleton' % node)
+            key = (self.node_rows[node], offset.tobytes())
+            if key not in self.joints:
+                self.joints[key] = len(self.joints)
+                self.joint_rows = np.append(self.joint_rows, key[0])
+                self.offsets = np.concatenate((self.offsets, offset[None]))
+            indices.append(self.joints[key])
+        self.joint_world = np.empty_like(self.offsets)
+        self.palette = np.empty_like(self.offsets)
+        self.palette_version = None
+        return np.array(indices, int)
+
+    def clip_rows(self, clip, nodes):
+        """ hierarchy rows of the nodes animated by a clip, and the clip
+            channels of the same names """
+        animated = [name for name in clip.index
+                    if nodes.get(name) in self.node_rows]
+        return (np.array([self.node_rows[nodes[name]] for name in animated], int),
+                np.array([clip.index[name] for name in animated], int))
+
+    def pose_into(self, local, time):
+        """ set the local matrices of all animated nodes from the clip """
+        local[self.rows] = self.clip.evaluate(time)[self.channels]
+
+    def pose(self, time):
+        """ local matrices of all animated nodes, set from the clip at once """
+        if time != self.time:
+            self.pose_into(self.poses.local, time)
+            self.poses.dirty, self.time = True, time
+
+    def bone_palette(self):
+        """ world @ offset matrix of every joint, computed once per update
+            of the world matrices whatever the number of meshes using it """
+        if self.palette_version != self.poses.version:
+            np.take(self.poses.world, self.joint_rows, axis=0, out=self.joint_world)
+            np.matmul(self.joint_world, self.offsets, out=self.palette)
+            self.palette_version = self.poses.version
+        return self.palette
+
+    def palette_offset(self, palettes):
+        """ offset of our palette in a BonePalettes buffer, where it is
+            written once per update whatever the number of meshes using it """
+        palette = self.bone_palette()
+        if self.block is None or self.block[1] != len(palette):
+            self.release_block()
+            self.palettes, self.block = palettes, (palettes.allocate(len(palette)),
+                                                   len(palette))
+            self.written_version = None
+        if self.written_version != self.palette_version:
+            palettes.write(self.block[0], palette)
+            self.written_version = self.palette_version
+        return self.block[0]
+
+    def release_block(self):
+        """ give our palettes buffer block back """
+        if self.block is not None:
+            self.palettes.release(*self.block)
+            self.palettes, self.block = None, None
+
+    def __del__(self):
+        self.release_block()
+
+    def update(self, time):
+        """ pipelined update: pose of frame time, world matrices and palette
+            relative to the skeleton, in back buffers while the front ones
+            are drawn. Parent transforms are applied by place() """
+        if self.back is None or len(self.back['palette']) != len(self.offsets):
+            self.back, self.front = ({name: np.empty_like(array) for name, array
+                                      in (('local', self.poses.local),
+                                          ('world', self.poses.world),
+                                          ('joint_world', self.offsets),
+                                          ('palette', self.offsets))}
+                                     for _ in range(2))
+            self.back['local'][...] = self.poses.local
+        back = self.back
+        time = self.animation_time(dict(time=time))
+        if time is not None:
+            self.pose_into(back['local'], time)
+        self.poses.propagate(identity(), back['local'], back['world'])
+        np.take(back['world'], self.joint_rows, axis=0, out=back['joint_world'])
+        np.matmul(back['joint_world'], self.offsets, out=back['palette'])
+
+    def swap(self):
+        """ pipelined update: back buffers of update() become the front ones """
+        self.front['local'][...] = self.back['local']   # next pose starts there
+        self.back, self.front = self.front, self.back
+        self.poses.local[...] = self.front['local']
+        self.placed = None
+
+    def place(self, model):
+        """ pipelined update: world matrices and palette of the published
+            pose under parent world matrix model, two batched products """
+        if self.placed is model:
+            return
+        np.matmul(model, self.front['world'], out=self.poses.world)
+        self.poses.updated(model)
+        np.matmul(model, self.front['palette'], out=self.palette)
+        self.palette_version, self.placed = self.poses.version, model
+
+    def draw(self, primitives=GL.GL_TRIANGLES, model=identity(), **uniforms):
+        """ pose the skeleton before any of its nodes or meshes is drawn """
+        time = self.animation_time(uniforms)
+        if self.pipelined:
+            self.place(self.update_world_transform(model))
+        elif time is not None:
+            self.pose(time)
+        Node.draw(self, primitives=primitives, model=model, **uniforms)
+
+
+class Animator(Skeleton):
+    """ Skeleton playing one of several named clips of the same rig, e.g. an
+        idle, a run and a jump exported to files of their own. Mesh and nodes
+        exist once: switching clips only changes which keyframe tracks are
+        evaluated, and a cross-fade lerps the pose matrices of the last and
+        new clip for a while, which suits short fades. Nodes the playing clip
+        does not animate are back to their rest transform """
+    def __init__(self, root, clips, nodes, playing=None):
+        super().__init__(root, next(iter(clips.values())), nodes)
+        self.nodes = nodes
+        self.rest = self.poses.local.copy()
+        self.fading = self.rest.copy()      # pose of the clip fading out
+        self.tracks = {}                    # clip name -> (clip, rows, channels)
+        self.others = {}                    # clip name -> rows of other clips
+        for name, clip in clips.items():
+            self.add_clip(name, clip)
+        self.playing = (None, None)         # current & fading out plays
+        self.play(playing or next(iter(clips)))
+
+    def add_clip(self, name, clip):
+        """ make a ClipKeyFrames or BakedClip playable under name """
+        self.tracks[name] = (clip, *self.clip_rows(clip, self.nodes))
+        animated = np.unique(np.concatenate(
+            [rows for _, rows, _ in self.tracks.values()]))
+        self.others = {other: np.setdiff1d(animated, rows)
+                       for other, (_, rows, _) in self.tracks.items()}
+
+    @property
+    def current(self):
+        """ name of the clip playing """
+        return self.playing[0]['name']
+
+    def play(self, name, fade=0.0, loop=True):
+        """ play clip name from its start, cross-fading from the current one
+            over fade seconds, then looping or holding its last pose. Playing
+            the current clip again changes nothing """
+        if name not in self.tracks:
+            raise KeyError('no clip %r in animator' % name)
+        current = self.playing[0]
+        if current is not None and current['name'] == name:
+            return
+        # starts on its first pose; set at once, the update thread may read it
+        play = dict(name=name, start=None, fade=fade, loop=loop)
+        self.playing = (play, current if fade > 0 else None)
+        self.time = None
+
+    def animation_time(self, uniforms):
+        """ frame time, clips keep their own time from it """
+        now = uniforms.get('time')
+        return glfw.get_time() if now is None else now
+
+    def pose_clip(self, local, play, now):
+        """ set the local matrices of a play at frame time now, returns the
+            seconds since it started """
+        if play['start'] is None or now < play['start']:    # or clock reset
+            play['start'] = now
+        elapsed = now - play['start']
+        clip, rows, channels = self.tracks[play['name']]
+        time = 0.0
+        if clip.duration > 0:
+            time = (elapsed % clip.duration if play['loop'] else
+                    min(elapsed, clip.duration))
+        local[self.others[play['name']]] = self.rest[self.others[play['name']]]
+        local[rows] = clip.evaluate(time)[channels]
+        return elapsed
+
+    def pose_into(self, local, time):
+        """ set the local matrices of the playing clip, faded in if it just
+            started playing """
+        play, faded = self.playing
+        elapsed = self.pose_clip(local, play, time)
+        if faded is not None and elapsed < play['fade']:
+            self.pose_clip(self.fading, faded, time)
+            local -= self.fading
+            local *= elapsed / play['fade']
+            local += self.fading
+
+
 class Skinned:
-    """ Skinned mesh decorator, passes bone world transforms to shader """
-    def __init__(self, mesh, bone_nodes, bone_offsets):
+    """ Skinned mesh decorator, passes bone world transforms to shader. With
+        a skeleton, bone matrices come from its shared palette, read by the
+        shader from the palettes texture buffer (bone_palette, bone_offset).
+        Otherwise, or without palettes, they are gathered in the MAX_BONES
+        bone_matrix uniform array, the shader dropping weights of bones past
+        it """
+    def __init__(self, mesh, bone_nodes, bone_offsets, skeleton=None,
+                 palettes=bone_palettes):
         self.mesh = mesh
 
         # store skinning data
         self.bone_nodes = bone_nodes
         self.bone_offsets = np.array(bone_offsets, np.float32)
+        self.bone_matrix = np.empty_like(self.bone_offsets)
+        self.skeleton = skeleton
+        self.palettes = palettes if skeleton is not None else None
+        if skeleton is not None:
+            self.joints = skeleton.attach(bone_nodes, self.bone_offsets)
+            # palette prefix already in our bone order: used without a copy
+            self.in_order = np.array_equal(self.joints, np.arange(len(self.joints)))
+        self.block, self.version = None, None   # own palettes block if reordered
+        if self.palettes is None and len(bone_nodes) > MAX_BONES:
+            print('Warning: skinned mesh has %d bones, only %d are animated,'
+                  ' the shader drops weights of the others'
+                  % (len(bone_nodes), MAX_BONES))
+
+        # vertices follow the bones anywhere, bounds unknown: never culled
+        self.bounds = None
+
+    def palette_offset(self):
+        """ offset of our bone matrices in the palettes texture buffer """
+        if self.in_order:
+            return self.skeleton.palette_offset(self.palettes)
+        palette = self.skeleton.bone_palette()
+        if self.block is None:
+            self.block = self.palettes.allocate(len(self.joints))
+        if self.version != self.skeleton.palette_version:
+            self.palettes.write(self.block, palette, self.joints)
+            self.version = self.skeleton.palette_version
+        return self.block
+
+    def draw(self, render_queue=None, **uniforms):
+        if self.palettes is not None:
+            uniforms.update(bone_buffer=1, bone_offset=self.palette_offset())
+            if render_queue is not None:    # one upload before queued draws
+                render_queue.prepare(self.palettes.upload)
+                uniforms['textures'] = {**uniforms.get('textures', {}),
+                                        'bone_palette': self.palettes}
+            else:
+                self.palettes.upload()
+                GL.glActiveTexture(GL.GL_TEXTURE0 + BONE_PALETTE_UNIT)
+                GL.glBindTexture(self.palettes.type, self.palettes.glid)
+                frame_stats['texture_binds'] += 1
+                uniforms['bone_palette'] = BONE_PALETTE_UNIT
+            self.mesh.draw(render_queue=render_queue, **uniforms)
+            return
+
+        if self.skeleton is None:
+            world_transforms = [node.world_transform for node in self.bone_nodes]
+            np.matmul(world_transforms, self.bone_offsets, out=self.bone_matrix)
+        elif self.in_order:
+            self.bone_matrix = self.skeleton.bone_palette()[:len(self.joints)]
+        else:
+            np.take(self.skeleton.bone_palette(), self.joints, axis=0,
+                    out=self.bone_matrix)
+        # samplers of different types must not share a unit, even unused
+        uniforms.update(bone_buffer=0, bone_matrix=self.bone_matrix[:MAX_BONES],
+                        bone_palette=BONE_PALETTE_UNIT)
+        self.mesh.draw(render_queue=render_queue, **uniforms)
 
-    def draw(self, **uniforms):
-        world_transforms = [node.world_transform for node in self.bone_nodes]
-        uniforms['bone_matrix'] = world_transforms @ self.bone_offsets
-        self.mesh.draw(**uniforms)
\ No newline at end of file
+    def __del__(self):
+        if self.block is not None:
+            self.palettes.release(self.block, len(self.joints))
\ No newline at end of file
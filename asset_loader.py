@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Background asset loading: CPU only work (model parsing, image decoding) runs
+on a pool of workers while the main thread, which owns the OpenGL context,
+only uploads the resulting numpy buffers.
+"""
+# Python built-in modules
+import os                           # os function, i.e. resolving file paths
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+
+class AssetLoader:
+    """ Runs loading jobs on a thread pool, or a process pool for jobs that
+        hold the GIL. Results are looked up by (kind, file) and consumed
+        once: the first load of an asset waits for its job to finish """
+    def __init__(self, workers=None, processes=False):
+        self.workers, self.processes = workers, processes
+        self.pool = None
+        self.jobs = {}          # (kind, real file path) -> future
+
+    def submit(self, kind, file, function, *args):
+        """ start function(file, *args) in the background, once per asset """
+        key = (kind, os.path.realpath(file))
+        if key not in self.jobs:
+            if self.pool is None:
+                executor = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+                self.pool = executor(max_workers=self.workers)
+            self.jobs[key] = self.pool.submit(function, file, *args)
+        return self.jobs[key]
+
+    def result(self, kind, file):
+        """ result of the job submitted for this asset, waiting for it if
+            needed, None if nothing was submitted. Job exceptions re-raise """
+        future = self.jobs.pop((kind, os.path.realpath(file)), None)
+        return future.result() if future is not None else None
+
+    def wait(self):
+        """ block until all submitted jobs are done """
+        wait(list(self.jobs.values()))
+
+    def shutdown(self):
+        """ stop the workers, dropping results that were never used """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+        self.jobs.clear()
+
+
+# default loader, consulted by core.load and texture.Texture
+asset_loader = AssetLoader()
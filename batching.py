@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Static geometry baking: meshes of subtrees that never move relative to their
+root are pre-transformed and merged, one vertex & index buffer per shader,
+textures and material, so they cost one draw call per material.
+"""
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Mesh, Node
+from instancing import static_meshes
+from texture import Textured
+
+
+def material_key(mesh, textures):
+    """ meshes with equal keys can be drawn with the same state """
+    uniforms = tuple(sorted((name, np.asarray(value).tobytes())
+                            for name, value in mesh.uniforms.items()))
+    texture_ids = tuple((name, texture.glid)
+                        for name, texture in (textures or {}).items())
+    return (id(mesh.shader), texture_ids, uniforms,
+            tuple(sorted(mesh.vertex_array.attributes)))
+
+
+def merge_meshes(parts):
+    """ Merged attributes & index of (transform, mesh) parts, positions and
+        normals taken to the common frame of the transforms """
+    attributes = {name: [] for name in parts[0][1].vertex_array.attributes}
+    indices, offset = [], 0
+    for transform, mesh in parts:
+        vertex_array = mesh.vertex_array
+        linear, translation = transform[:3, :3], transform[:3, 3]
+        for name, data in vertex_array.attributes.items():
+            data = np.asarray(data, np.float32)
+            if name == 'position':
+                data = data @ linear.T + translation
+            elif name == 'normal':    # inverse transpose, as in the shaders
+                data = data @ np.linalg.inv(linear)
+                length = np.linalg.norm(data, axis=1, keepdims=True)
+                data = np.divide(data, length, out=data, where=length > 0)
+            attributes[name].append(data.astype(np.float32))
+        nb_vertices = len(vertex_array.attributes['position'])
+        index = vertex_array.index
+        if index is None:
+            index = np.arange(nb_vertices, dtype=np.uint32)
+        indices.append(np.asarray(index, np.uint32).reshape(-1) + offset)
+        offset += nb_vertices
+    return ({name: np.concatenate(arrays) for name, arrays in attributes.items()},
+            np.concatenate(indices))
+
+
+def bake_static(node):
+    """ Replace, in place, the meshes of static subtrees below node by merged
+        meshes, one per shader, textures and material. Animated nodes and
+        skinned meshes are left as is, baking continues below them. Returns
+        the number of draw calls (before, after) for the baked subtrees """
+    try:
+        meshes = list(static_meshes(node.children))
+    except ValueError:          # dynamic parts: bake each static child alone
+        before, after = 0, 0
+        for child in node.children:
+            if isinstance(child, Node):
+                counts = bake_static(child)
+                before, after = before + counts[0], after + counts[1]
+        return before, after
+
+    groups = {}
+    for transform, mesh, textures in meshes:
+        key = material_key(mesh, textures)
+        groups.setdefault(key, (mesh, textures, []))[2].append((transform, mesh))
+
+    merged = []
+    for mesh, textures, parts in groups.values():
+        attributes, index = merge_meshes(parts)
+        drawable = Mesh(mesh.shader, attributes, dict(mesh.uniforms), index)
+        merged.append(Textured(drawable, **textures) if textures else drawable)
+    # replaced subtrees stay referenced: as live instances of their models,
+    # they keep the model cache from evicting textures the merged meshes bind
+    node.sources = getattr(node, 'sources', []) + node.children
+    node.children = []
+    node.add(*merged)
+    return len(meshes), len(merged)
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks for the CPU side of the scene setup and update code.
+Run all of them with `python3 benchmarks.py`, or a subset by name, e.g.
+`python3 benchmarks.py terrain`.
+"""
+# Python built-in modules
+import sys                          # command line benchmark selection
+import time                         # wall clock timing
+import tracemalloc                  # peak memory of allocations
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+import assimpcy                     # 3D resource loader
+
+from animation import (BakedClip, ClipKeyFrames, KeyFrameControlNode, Skeleton,
+                       Skinned, TransformKeyFrames)
+from core import (bone_weight_arrays, skinning_attributes, IMPORT_FLAGS,
+                  MAX_BONES, Node, frame_stats)
+from ground import build_terrain
+from heightfield import Heightfield, MAX_HEIGHT
+from hierarchy import TransformHierarchy
+from pipeline import UpdatePipeline
+from raycast import HeightPyramid, TriangleBVH, ray_triangles
+from texture import decode_image
+from transform import (identity, translate, rotate, quaternion,
+                       quaternion_from_euler, vec)
+
+
+def timed(function, *args, repeat=3):
+    """ best wall clock time in seconds of a few calls, and the last result """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_memory(function, *args):
+    """ peak bytes allocated during one call """
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+# -------------- terrain builder ----------------------------------------------
+def build_terrain_per_vertex(hmap, size, wrap=False):
+    """ Reference nested loop terrain builder, as Ground used to do it, but
+        for its heights: Ground multiplied a uint8 texel by 25, which wraps
+        around under numpy 2 for texels above 10. Heights are computed from
+        the int texel, as build_terrain does, unless wrap reproduces that """
+    def get_height(x, z):
+        if wrap:
+            return (int(hmap[x, z, 0]) * MAX_HEIGHT) % 256 / 256
+        return int(hmap[x, z, 0]) * MAX_HEIGHT / 256
+
+    def calc_normal(x, z):
+        if x == 0 or x == size - 1 or z == 0 or z == size - 1:
+            return [0.0, 1.0, 0.0]
+        vec_z = (get_height(x, z - 1) - get_height(x, z + 1)) / 2
+        vec_x = (get_height(x - 1, z) - get_height(x + 1, z)) / 2
+        vector = np.array([vec_x, 1.0, vec_z])
+        return vector / np.sqrt(sum(vector * vector))
+
+    vertices, normals, tex_coords, indices = [], [], [], []
+    for z in range(size):
+        for x in range(size):
+            vertices.append([x, get_height(x, z), z])
+            normals.append(calc_normal(x, z))
+            tex_coords.append([x, z])
+    for z in range(size - 1):
+        for x in range(size - 1):
+            top_left, bottom_left = z * size + x, (z + 1) * size + x
+            indices.append([top_left, bottom_left, top_left + 1,
+                            top_left + 1, bottom_left, bottom_left + 1])
+    return (np.array(vertices, np.float32), np.array(normals, np.float32),
+            np.array(tex_coords, np.float32), np.array(indices, np.uint32))
+
+
+def bench_terrain(sizes=(256, 512, 1024, 2048, 4096), reference_max=512,
+                  scene_map='mappings/ground_hmap_256.png'):
+    """ Time the vectorized terrain builder on random height maps, checking
+        it against the per vertex builder on the smaller sizes, and count the
+        heights of the scene map changed since Ground's uint8 overflow """
+    print('terrain builder (vectorized vs per vertex reference)')
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        hmap = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        seconds, arrays = timed(build_terrain, hmap, size)
+        nbytes = sum(array.nbytes for array in arrays)
+        line = '  %5dx%-5d %8.3fs %8.1f MB' % (size, size, seconds, nbytes / 2**20)
+        if size <= reference_max:
+            ref_seconds, reference = timed(build_terrain_per_vertex, hmap, size,
+                                           repeat=1)
+            same = all(np.array_equal(a.reshape(-1), b.reshape(-1))
+                       for a, b in zip(arrays, reference))
+            line += '   reference %8.3fs  x%-6.0f identical=%s' % (
+                ref_seconds, ref_seconds / seconds, same)
+        print(line)
+
+    # heights of the scene map changed by the fixed uint8 overflow of Ground
+    hmap = decode_image(scene_map)
+    size = len(hmap)
+    heights = build_terrain(hmap, size)[0][:, 1]
+    wrapped = build_terrain_per_vertex(hmap, size, wrap=True)[0][:, 1]
+    changed = heights != wrapped
+    print('  %s: %d of %d heights differ from the wrapping uint8 builder, '
+          'by up to %.2f' % (scene_map, changed.sum(), changed.size,
+                             np.abs(heights - wrapped).max()))
+
+
+# -------------- skinning attributes -------------------------------------------
+def skinning_per_weight(nb_vertices, bones):
+    """ Reference skinning attributes builder, as load() used to do it: a
+        MAX_BONES wide (weight, id) table filled per weight and sorted """
+    vbone = np.array([[(0, 0)] * MAX_BONES] * nb_vertices,
+                     dtype=[('weight', 'f4'), ('id', 'u4')])
+    for bone_id, (vertex_ids, weights) in enumerate(bones):
+        for vertex_id, weight in zip(vertex_ids, weights):
+            vbone[vertex_id][bone_id] = (weight, bone_id)
+    vbone.sort(order='weight')
+    vbone = vbone[:, -4:]
+    return vbone['id'], vbone['weight']
+
+
+def bench_skinning(files=('models/Musketeer/Musketeer_idle.fbx',
+                          'models/seagull/seagul.FBX')):
+    """ Time and peak memory of the skinning attributes builders, on the
+        skinned meshes of the characters of the scene """
+    print('skinning attributes (vectorized vs MAX_BONES table reference)')
+    for file in files:
+        scene = assimpcy.aiImportFile(file, IMPORT_FLAGS)
+        for mesh in (mesh for mesh in scene.mMeshes if mesh.HasBones):
+            bones = [bone_weight_arrays(bone) for bone in mesh.mBones[:MAX_BONES]]
+            args = (mesh.mNumVertices, bones)
+            seconds, (ids, weights) = timed(skinning_attributes, *args)
+            ref_seconds, (ref_ids, ref_weights) = timed(skinning_per_weight,
+                                                        *args, repeat=1)
+            same = all(set(a[a_weights > 0]) == set(b[b_weights > 0])
+                       for a, a_weights, b, b_weights
+                       in zip(ids, weights, ref_ids, ref_weights))
+            print('  %-40s %6d vertices %3d bones' % (file, mesh.mNumVertices,
+                                                     len(bones)))
+            print('    vectorized %8.4fs %8.2f MB   reference %8.4fs %8.2f MB'
+                  '   same bones=%s' % (
+                      seconds, peak_memory(skinning_attributes, *args) / 2**20,
+                      ref_seconds, peak_memory(skinning_per_weight, *args) / 2**20,
+                      same))
+
+
+# -------------- scene graph traversal -----------------------------------------
+def static_hierarchy(depth, branching):
+    """ full tree of nodes with non trivial transforms, and its node count """
+    def make_node(level):
+        node = Node(transform=translate(1, 0, 0) @ rotate((0, 1, 0), 10 * level))
+        if level < depth:
+            node.add(*(make_node(level + 1) for _ in range(branching)))
+        return node
+    return make_node(0), sum(branching ** level for level in range(depth + 1))
+
+
+def bench_traversal(shapes=((6, 4), (8, 3), (12, 2), (200, 1)), frames=20):
+    """ Time a frame of traversal of deep static hierarchies, with cached world
+        transforms versus recomputing them all, as when the root matrix is a
+        new object every frame """
+    print('scene graph traversal (cached world transforms vs recomputed)')
+    for depth, branching in shapes:
+        root, nb_nodes = static_hierarchy(depth, branching)
+        root.draw()                     # first frame computes every transform
+
+        def cached_frames():
+            for _ in range(frames):
+                root.draw()
+
+        def recomputed_frames():
+            for _ in range(frames):
+                root.draw(model=identity())
+
+        frame_stats.clear()
+        seconds, _ = timed(cached_frames)
+        updates = frame_stats['world_updates']
+        ref_seconds, _ = timed(recomputed_frames)
+        print('  depth %3d x%d %6d nodes  %8.3f ms/frame (%d updates)'
+              '   recomputed %8.3f ms/frame  x%.1f' % (
+                  depth, branching, nb_nodes, 1000 * seconds / frames, updates,
+                  1000 * ref_seconds / frames, ref_seconds / seconds))
+
+
+def bench_hierarchy(shapes=((5, 4), (6, 5), (9, 3), (14, 2)), frames=5):
+    """ Time a full world transform update, each frame moving the root, for
+        per node updates versus a TransformHierarchy of the same tree """
+    print('transform propagation (array hierarchy vs per node)')
+    for depth, branching in shapes:
+        nodes, nb_nodes = static_hierarchy(depth, branching)
+        flat, _ = static_hierarchy(depth, branching)
+        hierarchy = TransformHierarchy(flat)
+
+        def moving_frames(root):
+            for frame in range(frames):
+                root.transform = translate(frame, 0, 0)
+                root.draw()
+
+        def updates():
+            for frame in range(frames):
+                flat.transform = translate(frame, 0, 0)
+                hierarchy.update()
+
+        seconds, _ = timed(moving_frames, flat)
+        update_seconds, _ = timed(updates)
+        ref_seconds, _ = timed(moving_frames, nodes)
+        print('  depth %2d x%d %7d nodes  %8.2f ms/frame (update %6.2f ms)'
+              '   per node %8.2f ms/frame  x%.1f' % (
+                  depth, branching, nb_nodes, 1000 * seconds / frames,
+                  1000 * update_seconds / frames, 1000 * ref_seconds / frames,
+                  ref_seconds / seconds))
+
+
+# -------------- keyframe evaluation ------------------------------------------
+def random_clip(rng, nb_channels, nb_keys, duration=10.0, regular=False):
+    """ channels of random TRS keys, in the scene description layout, at
+        random times or evenly spaced ones as in exported animations """
+    def track(values):
+        times = (np.linspace(0, duration, len(values)) if regular else
+                 np.sort(rng.random(len(values)) * duration)).astype('f')
+        return dict(times=times, values=np.asarray(values, 'f'))
+    return {'bone%d' % channel: dict(
+        position=track(rng.random((nb_keys, 3))),
+        rotation=track([quaternion_from_euler(*angles)
+                        for angles in rng.random((nb_keys, 3)) * 360]),
+        scale=track(1 + rng.random((nb_keys, 3))))
+        for channel in range(nb_channels)}
+
+
+def bench_keyframes(sizes=(20, 60, 240, 1000), nb_keys=30, frames=100):
+    """ Time the evaluation of every channel of a clip for a frame, batched
+        versus one TransformKeyFrames per channel, on forward playback """
+    print('keyframe evaluation (batched clip vs per channel)')
+    rng = np.random.default_rng(0)
+    times = np.linspace(0, 10, frames)
+    for nb_channels in sizes:
+        channels = random_clip(rng, nb_channels, nb_keys)
+        clip = ClipKeyFrames(channels)
+        per_channel = [TransformKeyFrames(*(
+            dict(zip(channel[kind]['times'].tolist(), channel[kind]['values']))
+            for kind in ('position', 'rotation', 'scale')))
+            for channel in channels.values()]
+
+        def batched():
+            return [clip.evaluate(time).copy() for time in times]
+
+        def reference():
+            return [np.array([keys.value(time) for keys in per_channel])
+                    for time in times]
+
+        seconds, matrices = timed(batched)
+        ref_seconds, ref_matrices = timed(reference, repeat=1)
+        error = max(np.abs(a - b).max() for a, b in zip(matrices, ref_matrices))
+        print('  %5d channels  %8.3f ms/frame   per channel %8.3f ms/frame'
+              '  x%-5.0f max error %.1e' % (
+                  nb_channels, 1000 * seconds / frames,
+                  1000 * ref_seconds / frames, ref_seconds / seconds, error))
+
+
+def bench_baking(rates=(10, 30, 60, 120), nb_channels=60, nb_keys=30,
+                 frames=100):
+    """ Time the lookup of a clip baked at several sample rates versus its
+        keyframe evaluation, with the table size and max error of each rate """
+    print('baked animation tables (table lookup vs keyframe evaluation)')
+    rng = np.random.default_rng(0)
+    clip = ClipKeyFrames(random_clip(rng, nb_channels, nb_keys, regular=True))
+    times = np.linspace(0, clip.duration, frames)
+    ref_seconds, _ = timed(lambda: [clip.evaluate(time) for time in times])
+    print('  %d channels, keyframes %8.3f ms/frame' % (
+        nb_channels, 1000 * ref_seconds / frames))
+    for rate in rates:
+        baked = BakedClip(BakedClip.bake(clip, rate), clip.names)
+        seconds, _ = timed(lambda: [baked.evaluate(time) for time in times])
+        print('  %4d/s %8.3f ms/frame  x%-5.1f %s' % (
+            rate, 1000 * seconds / frames, ref_seconds / seconds,
+            baked.table.report()))
+
+
+# -------------- bone palettes --------------------------------------------------
+class NullMesh:
+    """ drawable standing for a skinned mesh, keeps its bone matrices """
+    def draw(self, **uniforms):
+        self.bone_matrix = uniforms['bone_matrix']
+
+
+def skinned_rig(clip, parents, nb_meshes, skeleton):
+    """ one node per clip channel, each child of the node of index parents[i]
+        (the first one is the root), the root holding nb_meshes skinned
+        meshes all using every bone. Returns the node to draw """
+    nodes = {}
+    for name, parent in zip(clip.names, parents):
+        node = (Node(transform=translate(0, 1, 0)) if skeleton else
+                KeyFrameControlNode(transform=translate(0, 1, 0),
+                                    keyframes=clip.channel(name)))
+        if nodes:
+            list(nodes.values())[parent].add(node)
+        nodes[name] = node
+    bones = list(nodes.values())
+    root = Skeleton(bones[0], clip, nodes) if skeleton else bones[0]
+    offsets = np.tile(identity(), (len(bones), 1, 1))
+    bones[0].add(*(Skinned(NullMesh(), bones, offsets,
+                           root if skeleton else None, palettes=None)
+                   for _ in range(nb_meshes)))
+    return root
+
+
+def bench_palette(sizes=(20, 60, 120), nb_meshes=3, frames=100):
+    """ Time a frame of bone animation & palettes of meshes sharing the
+        bones of random rigs, a Skeleton versus keyframe nodes with per mesh
+        palettes """
+    print('bone palettes (skeleton vs keyframe nodes)')
+    rng = np.random.default_rng(0)
+    times = np.linspace(0, 10, frames)
+    for nb_bones in sizes:
+        channels = random_clip(rng, nb_bones, 30, regular=True)
+        parents = [0] + [rng.integers(index) for index in range(1, nb_bones)]
+        skeleton = skinned_rig(ClipKeyFrames(channels), parents, nb_meshes, True)
+        nodes = skinned_rig(ClipKeyFrames(channels), parents, nb_meshes, False)
+
+        def animate(root):
+            for time in times:
+                root.draw(time=time)
+
+        seconds, _ = timed(animate, skeleton)
+        ref_seconds, _ = timed(animate, nodes)
+        print('  %4d bones x%d meshes  %8.3f ms/frame   nodes %8.3f ms/frame'
+              '  x%.1f' % (nb_bones, nb_meshes, 1000 * seconds / frames,
+                           1000 * ref_seconds / frames, ref_seconds / seconds))
+
+
+# -------------- pipelined update ----------------------------------------------
+def animated_rigs(rng, nb_rigs, nb_bones):
+    """ skinned rigs, each below a moving keyframe node """
+    root = Node()
+    for _ in range(nb_rigs):
+        clip = ClipKeyFrames(random_clip(rng, nb_bones, 30, regular=True))
+        parents = [0] + [rng.integers(index) for index in range(1, nb_bones)]
+        mover = KeyFrameControlNode({0: vec(0, 0, 0), 10: vec(10, 0, 0)},
+                                    {0: quaternion()}, {0: 1})
+        mover.add(skinned_rig(clip, parents, 2, True))
+        root.add(mover)
+    return root
+
+
+def bench_pipeline(nb_rigs=8, nb_bones=60, submit_ms=(0, 2, 5), frames=60):
+    """ Time frames of animated rigs, updated during the traversal versus on
+        the pipeline worker thread. GL submission is stood in for by a
+        sleep, which like driver calls releases the GIL """
+    print('pipelined update (update thread vs serial)')
+    times = np.linspace(0, 10, frames)
+    for submit in submit_ms:
+        serial = animated_rigs(np.random.default_rng(0), nb_rigs, nb_bones)
+        piped = animated_rigs(np.random.default_rng(0), nb_rigs, nb_bones)
+        pipeline = UpdatePipeline()
+        pipeline.collect(piped)
+
+        def serial_frames():
+            for frame_time in times:
+                serial.draw(time=frame_time)
+                time.sleep(submit / 1000)
+
+        def pipelined_frames():
+            for frame_time in times:
+                piped.draw(time=pipeline.frame(frame_time))
+                time.sleep(submit / 1000)
+
+        seconds, _ = timed(pipelined_frames)
+        ref_seconds, _ = timed(serial_frames)
+        print('  %d rigs x%d bones, submit %d ms  %8.2f ms/frame'
+              ' (update %.2f ms)   serial %8.2f ms/frame  x%.2f' % (
+                  nb_rigs, nb_bones, submit, 1000 * seconds / frames,
+                  1000 * pipeline.update_seconds, 1000 * ref_seconds / frames,
+                  ref_seconds / seconds))
+        pipeline.shutdown()
+
+
+# -------------- heightfield queries -------------------------------------------
+def bench_heightfield(size=1024, nb_props=10000, nb_moves=1000):
+    """ Time height queries on a random map: placing props in one batched
+        query, and moving a character one scalar query at a time """
+    print('heightfield queries (batched & scalar bilinear)')
+    rng = np.random.default_rng(0)
+    hmap = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    field = Heightfield(hmap[..., 0].astype(np.float32) * MAX_HEIGHT / 256)
+    x, z = rng.random((2, nb_props)) * (size - 1)
+    seconds, heights = timed(field.height, x, z)
+    normal_seconds, _ = timed(field.normal, x, z)
+    inside = np.all((heights >= 0) & (heights <= MAX_HEIGHT))
+    print('  %d props  heights %6.2f ms  normals %6.2f ms   in range=%s' % (
+        nb_props, 1000 * seconds, 1000 * normal_seconds, inside))
+
+    def moves():
+        for x_move, z_move in zip(x[:nb_moves], z[:nb_moves]):
+            field.height(float(x_move), float(z_move))
+    seconds, _ = timed(moves)
+    print('  %d scalar queries  %6.2f us/query' % (nb_moves,
+                                                   1e6 * seconds / nb_moves))
+
+
+def terrain_rays(rng, size, nb_rays, kind):
+    """ rays across a size x size terrain: from above looking 'downward' or
+        'grazing' nearly level, or 'aligned' with the axes, alternately
+        straight down on grid vertices and level along grid lines, edges
+        included, which lie in the faces of bounding boxes """
+    if kind == 'aligned':
+        lines = rng.integers(0, size, (nb_rays, 2)).astype(np.float64)
+        down = np.arange(nb_rays) % 2 == 0
+        origins = np.stack((np.where(down, lines[:, 0], -1.0),
+                            np.where(down, MAX_HEIGHT + 1.0,
+                                     rng.random(nb_rays) * MAX_HEIGHT),
+                            lines[:, 1]), axis=-1)
+        directions = np.where(down[:, None], (0.0, -1.0, 0.0), (1.0, 0.0, 0.0))
+        return origins, directions
+    origins = np.stack((rng.random(nb_rays) * (size - 1),
+                        np.full(nb_rays, MAX_HEIGHT + 1.0),
+                        rng.random(nb_rays) * (size - 1)), axis=-1)
+    directions = rng.normal(size=(nb_rays, 3))
+    directions[:, 1] = -np.abs(directions[:, 1]) * (0.05 if kind == 'grazing' else 4)
+    return origins, directions
+
+
+def bench_raycast(size=512, mesh_size=128, nb_rays=100000, nb_checked=200):
+    """ Ray throughput against a random terrain, with the min-max pyramid of
+        its heights and with a BVH of its mesh, checked against each other
+        and against brute force on a subset of the rays """
+    print('ray casting (height pyramid & triangle BVH)')
+    rng = np.random.default_rng(0)
+    for grid in (size, mesh_size):
+        hmap = rng.integers(0, 256, (grid, grid, 3), dtype=np.uint8)
+        heights = hmap[..., 0].astype(np.float32) * np.float32(MAX_HEIGHT / 256)
+        build_seconds, pyramid = timed(HeightPyramid, Heightfield(heights))
+        print('  %4dx%-4d pyramid build %7.3fs' % (grid, grid, build_seconds))
+        if grid == mesh_size:
+            positions, _, _, index = build_terrain(hmap, grid)
+            build_seconds, bvh = timed(TriangleBVH, positions, index, repeat=1)
+            print('  %4dx%-4d BVH build     %7.3fs  %d triangles' % (
+                grid, grid, build_seconds, len(bvh.triangles)))
+        for kind in ('downward', 'grazing', 'aligned'):
+            origins, directions = terrain_rays(rng, grid, nb_rays, kind)
+            seconds, t = timed(pyramid.raycast, origins, directions, repeat=1)
+            line = '    %-8s pyramid %9.0f rays/s  hits %5.1f%%' % (
+                kind, nb_rays / seconds, 100 * np.isfinite(t).mean())
+            if grid == mesh_size:
+                bvh_seconds, bvh_t = timed(bvh.raycast, origins, directions,
+                                           repeat=1)
+                line += '   BVH %9.0f rays/s  same=%s' % (
+                    nb_rays / bvh_seconds, np.allclose(t, bvh_t, rtol=1e-4))
+                a, b, c = bvh.triangles.transpose(1, 0, 2)
+                reference = [np.min(ray_triangles(np.broadcast_to(origin, a.shape),
+                                                  np.broadcast_to(direction, a.shape),
+                                                  a, b, c))
+                             for origin, direction in zip(origins[:nb_checked],
+                                                          directions[:nb_checked])]
+                line += ' brute force=%s' % np.allclose(t[:nb_checked], reference,
+                                                        rtol=1e-4)
+            print(line)
+
+
+BENCHMARKS = dict(terrain=bench_terrain, skinning=bench_skinning,
+                  traversal=bench_traversal, hierarchy=bench_hierarchy,
+                  keyframes=bench_keyframes, baking=bench_baking,
+                  palette=bench_palette, pipeline=bench_pipeline,
+                  heightfield=bench_heightfield, raycast=bench_raycast)
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
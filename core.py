@@ -1,6 +1,10 @@
 # Python built-in modules
 import os                           # os function, i.e. checking file status
 import atexit                       # launch a function at exit
+import gc                           # collect unused scene graphs
+import weakref                      # track live instances of cached models
+from collections import Counter     # per frame statistics
+from itertools import count         # world transform version numbers
 
 # External, non built-in modules
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
@@ -8,17 +12,32 @@ import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 import assimpcy                     # 3D resource loader
 
+import disk_cache                   # on-disk cache of imported scenes
+from asset_loader import asset_loader
+
 # our transform functions
-from transform import identity
+from transform import (identity, bounds, bounds_union, transform_bounds,
+                       bounds_outside, empty_bounds)
 
 # initialize and automatically terminate glfw on exit
 glfw.init()
 atexit.register(glfw.terminate)
 
+# per frame counters (drawn meshes, culled nodes...), reset by the viewer
+frame_stats = Counter()
+
+# world matrices get a new number each time they are recomputed
+world_versions = count(1)
+
+# uniform blocks shared by all programs, and their buffer binding points
+UNIFORM_BLOCKS = dict(FrameData=0)
+
 
 # ------------ low level OpenGL object wrappers ----------------------------
 class Shader:
     """ Helper class to create and automatically destroy shader program """
+    current = None      # program currently bound, shared by all shaders
+
     @staticmethod
     def _compile_shader(src, shader_type):
         src = open(src, 'r').read() if os.path.exists(src) else src
@@ -52,30 +71,63 @@ class Shader:
                 print(GL.glGetProgramInfoLog(self.glid).decode('ascii'))
                 os._exit(1)
 
+        # connect the shared uniform blocks this program uses to their buffers
+        for block, binding in UNIFORM_BLOCKS.items():
+            index = GL.glGetUniformBlockIndex(self.glid, block)
+            if index != GL.GL_INVALID_INDEX:
+                GL.glUniformBlockBinding(self.glid, index, binding)
+
         # get location, size & type for uniform variables using GL introspection
         self.uniforms = {}
+        self.values = {}        # uniform name -> bytes of the last upload
         self.debug = debug
         get_name = {int(k): str(k).split()[0] for k in self.GL_SETTERS.keys()}
         for var in range(GL.glGetProgramiv(self.glid, GL.GL_ACTIVE_UNIFORMS)):
             name, size, type_ = GL.glGetActiveUniform(self.glid, var)
             name = name.decode().split('[')[0]   # remove array characterization
             args = [GL.glGetUniformLocation(self.glid, name), size]
+            if args[0] < 0:     # uniform block members are set by buffers
+                continue
             # add transpose=True as argument for matrix types
             if type_ in {GL.GL_FLOAT_MAT2, GL.GL_FLOAT_MAT3, GL.GL_FLOAT_MAT4}:
                 args.append(True)
             if debug:
                 call = self.GL_SETTERS[type_].__name__
                 print(f'uniform {get_name[type_]} {name}: {call}{tuple(args)}')
-            self.uniforms[name] = (self.GL_SETTERS[type_], args)
-
-    def set_uniforms(self, uniforms):
-        """ set only uniform variables that are known to shader """
-        for name in uniforms.keys() & self.uniforms.keys():
-            set_uniform, args = self.uniforms[name]
-            set_uniform(*args, uniforms[name])
+            dtype = self.GL_TYPES.get(self.GL_SETTERS[type_], np.float32)
+            self.uniforms[name] = (self.GL_SETTERS[type_], args, dtype)
+
+    def use(self):
+        """ make this program current, unless it already is """
+        if Shader.current == self.glid:
+            frame_stats['program_binds_skipped'] += 1
+            return
+        GL.glUseProgram(self.glid)
+        Shader.current = self.glid
+        frame_stats['program_binds'] += 1
+
+    def set_uniforms(self, uniforms, defaults=None):
+        """ set only uniform variables that are known to shader, taking values
+            from uniforms first then defaults. Values equal to the last ones
+            uploaded to the program are skipped, programs keep uniform state """
+        defaults = defaults or {}
+        for name, (set_uniform, args, dtype) in self.uniforms.items():
+            value = uniforms.get(name, defaults.get(name))
+            if value is None:
+                continue
+            data = np.asarray(value, dtype)
+            key = data.tobytes()
+            if self.values.get(name) == key:
+                frame_stats['uniforms_skipped'] += 1
+                continue
+            set_uniform(*args, data)
+            self.values[name] = key
+            frame_stats['uniforms_set'] += 1
 
     def __del__(self):
         GL.glDeleteProgram(self.glid)  # object dies => destroy GL object
+        if Shader.current == self.glid:
+            Shader.current = None
 
     GL_SETTERS = {
         GL.GL_UNSIGNED_INT:      GL.glUniform1uiv,
@@ -88,11 +140,54 @@ class Shader:
         GL.GL_INT_VEC3:   GL.glUniform3iv, GL.GL_INT_VEC4:     GL.glUniform4iv,
         GL.GL_SAMPLER_1D: GL.glUniform1iv, GL.GL_SAMPLER_2D:   GL.glUniform1iv,
         GL.GL_SAMPLER_3D: GL.glUniform1iv, GL.GL_SAMPLER_CUBE: GL.glUniform1iv,
+        GL.GL_SAMPLER_BUFFER: GL.glUniform1iv,
         GL.GL_FLOAT_MAT2: GL.glUniformMatrix2fv,
         GL.GL_FLOAT_MAT3: GL.glUniformMatrix3fv,
         GL.GL_FLOAT_MAT4: GL.glUniformMatrix4fv,
     }
 
+    # array types converted to before upload, to compare with the last values
+    GL_TYPES = {
+        GL.glUniform1uiv: np.uint32, GL.glUniform2uiv: np.uint32,
+        GL.glUniform3uiv: np.uint32, GL.glUniform4uiv: np.uint32,
+        GL.glUniform1iv: np.int32, GL.glUniform2iv: np.int32,
+        GL.glUniform3iv: np.int32, GL.glUniform4iv: np.int32,
+    }
+
+
+class UniformBuffer:
+    """ Uniform buffer object for a std140 uniform block of float, vec and
+        mat4 fields, given as name=number of floats in declaration order.
+        Matrices are row major, as declared in the shaders' blocks """
+    def __init__(self, binding, **fields):
+        self.fields, offset = {}, 0
+        for name, size in fields.items():
+            align = 4 if size >= 3 else size    # std140 alignment, in floats
+            offset = -(-offset // align) * align
+            self.fields[name] = slice(offset, offset + size)
+            offset += size
+        self.data = np.zeros(-(-offset // 4) * 4, np.float32)
+        self.uploaded = None
+
+        self.glid = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferData(GL.GL_UNIFORM_BUFFER, self.data, GL.GL_DYNAMIC_DRAW)
+        GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER, binding, self.glid)
+
+    def update(self, **values):
+        """ set block fields, uploading the buffer only if it changed """
+        for name, value in values.items():
+            self.data[self.fields[name]] = np.asarray(value).reshape(-1)
+        if self.uploaded != self.data.tobytes():
+            GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+            GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, self.data.nbytes,
+                               self.data)
+            self.uploaded = self.data.tobytes()
+            frame_stats['uniform_buffer_updates'] += 1
+
+    def __del__(self):
+        GL.glDeleteBuffers(1, [self.glid])
+
 
 class VertexArray:
     """ helper class to create and self destroy OpenGL vertex array objects."""
@@ -104,6 +199,8 @@ class VertexArray:
         self.glid = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(self.glid)
         self.buffers = []  # we will store buffers in a list
+        self.layout = []   # (location, buffer, size) per enabled attribute
+        self.index_buffer = None
         nb_primitives, size = 0, 0
 
         # load buffer per vertex attribute (in list with index = shader layout)
@@ -112,28 +209,41 @@ class VertexArray:
             if loc >= 0:
                 # bind a new vbo, upload its data to GPU, declare size and type
                 self.buffers.append(GL.glGenBuffers(1))
-                data = np.array(data, np.float32, copy=False)  # ensure format
+                data = np.asarray(data, np.float32)  # ensure format, no copy if ok
                 nb_primitives, size = data.shape
                 GL.glEnableVertexAttribArray(loc)
                 GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
                 GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
                 GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
+                self.layout.append((loc, self.buffers[-1], size))
 
         # optionally create and upload an index buffer for this object
         self.draw_command = GL.glDrawArrays
         self.arguments = (0, nb_primitives)
+        self.nb_triangles = nb_primitives // 3
         if index is not None:
             self.buffers += [GL.glGenBuffers(1)]
-            index_buffer = np.array(index, np.int32, copy=False)  # good format
+            index_buffer = np.asarray(index, np.uint32)  # good format, no copy if ok
             GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers[-1])
             GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, usage)
+            self.index_buffer = self.buffers[-1]
             self.draw_command = GL.glDrawElements
             self.arguments = (index_buffer.size, GL.GL_UNSIGNED_INT, None)
+            self.nb_triangles = index_buffer.size // 3
+
+        # CPU side arrays, kept for static geometry baking
+        self.attributes, self.index = attributes, index
+
+        # local space bounding box, None if unknown: never culled
+        position = attributes.get('position')
+        self.bounds = bounds(position) if position is not None else None
 
     def execute(self, primitive):
         """ draw a vertex array, either as direct array or indexed array """
         GL.glBindVertexArray(self.glid)
         self.draw_command(primitive, *self.arguments)
+        frame_stats['draw_calls'] += 1
+        frame_stats['triangles'] += self.nb_triangles
 
     def __del__(self):  # object dies => kill GL array and buffers from GPU
         GL.glDeleteVertexArrays(1, [self.glid])
@@ -142,35 +252,227 @@ class VertexArray:
 
 # ------------  Mesh is the core drawable -------------------------------------
 class Mesh:
-    """ Basic mesh class, attributes and uniforms passed as arguments """
-    def __init__(self, shader, attributes, uniforms=None, index=None):
+    """ Basic mesh class, attributes and uniforms passed as arguments. Meshes
+        can share the GPU buffers of an existing vertex_array instead """
+    def __init__(self, shader, attributes=None, uniforms=None, index=None,
+                 vertex_array=None):
         self.shader = shader
         self.uniforms = uniforms or dict()
-        self.vertex_array = VertexArray(shader, attributes, index)
-
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
-        GL.glUseProgram(self.shader.glid)
-        self.shader.set_uniforms({**self.uniforms, **uniforms})
+        self.vertex_array = vertex_array or VertexArray(shader, attributes, index)
+        self.bounds = self.vertex_array.bounds
+
+    def draw(self, primitives=GL.GL_TRIANGLES, render_queue=None,
+             textures=None, **uniforms):
+        if render_queue is not None:    # drawn later, in state sorted order
+            render_queue.submit(self.shader, self.vertex_array, primitives,
+                                uniforms, self.uniforms, textures)
+            return
+        self.shader.use()
+        self.shader.set_uniforms(uniforms, self.uniforms)
         self.vertex_array.execute(primitives)
+        frame_stats['drawn'] += 1
+
+
+# ------------  Render queue, draws sorted to minimize GL state changes -------
+class DrawItem:
+    """ Everything needed to issue one draw: program, textures by sampler
+        name, vertex array, uniforms, and an optional custom draw command """
+    def __init__(self, shader, vertex_array, primitives, uniforms, defaults,
+                 textures, command, depth):
+        self.shader, self.vertex_array = shader, vertex_array
+        self.primitives, self.command = primitives, command
+        self.uniforms, self.defaults = uniforms, defaults
+        self.textures = textures or {}
+        self.texture_ids = tuple(texture.glid for texture in self.textures.values())
+        self.depth = depth
+
+    def sort_key(self):
+        """ program first, then texture set, then opaque front to back """
+        return (self.shader.glid, self.texture_ids, self.depth)
+
+
+class RenderQueue:
+    """ Collects draw items during a scene traversal, then sorts them by
+        program, textures and depth to issue them with few state changes """
+    def __init__(self):
+        self.items = []
+        self.uploads = {}       # callables run once before the next flush
+        self.camera_position = np.zeros(3)
+
+    def submit(self, shader, vertex_array, primitives, uniforms, defaults=None,
+               textures=None, command=None):
+        """ queue a draw, command(primitives) replaces vertex_array.execute """
+        model = uniforms.get('model')
+        depth = 0 if model is None else float(np.sum(
+            (np.asarray(model)[:3, 3] - self.camera_position) ** 2))
+        self.items.append(DrawItem(shader, vertex_array, primitives, uniforms,
+                                   defaults, textures, command, depth))
+
+    def prepare(self, upload):
+        """ run upload() once before the queued draws are executed, e.g. to
+            send buffers written during the traversal in a single call """
+        self.uploads[upload] = True
+
+    @staticmethod
+    def state_changes(items):
+        """ number of program, texture set and vertex array switches """
+        changes, previous = 0, None
+        for item in items:
+            if previous is not None:
+                changes += ((item.shader is not previous.shader)
+                            + (item.texture_ids != previous.texture_ids)
+                            + (item.vertex_array is not previous.vertex_array))
+            previous = item
+        return changes
+
+    def flush(self):
+        """ sort and execute all queued draws, leaving the queue empty """
+        frame_stats['state_changes_unsorted'] += self.state_changes(self.items)
+        self.items.sort(key=DrawItem.sort_key)
+        frame_stats['state_changes'] += self.state_changes(self.items)
+
+        for upload in self.uploads:
+            upload()
+        self.uploads.clear()
+
+        bound_textures = None
+        for item in self.items:
+            item.shader.use()
+            if item.texture_ids != bound_textures:
+                for index, texture in enumerate(item.textures.values()):
+                    GL.glActiveTexture(GL.GL_TEXTURE0 + index)
+                    GL.glBindTexture(texture.type, texture.glid)
+                frame_stats['texture_binds'] += len(item.textures)
+                bound_textures = item.texture_ids
+            samplers = {name: index for index, name in enumerate(item.textures)}
+            item.uniforms.update(samplers)
+            item.shader.set_uniforms(item.uniforms, item.defaults)
+            if item.command is not None:
+                item.command(item.primitives)
+            else:
+                item.vertex_array.execute(item.primitives)
+            frame_stats['drawn'] += 1
+        self.items.clear()
 
 
 # ------------  Node is the core drawable for hierarchical scene graphs -------
 class Node:
     """ Scene graph transform and parameter broadcast node """
     def __init__(self, children=(), transform=identity()):
+        self.parents = []              # nodes can be shared by several parents
+        self.cullable = True           # False for nodes others depend on
+        self._bounds, self._bounds_valid = None, False
+        self._parent_world = None      # parent world matrix used last update
+        self.hierarchy = None          # TransformHierarchy holding our matrices
         self.transform = transform
         self.world_transform = identity()
-        self.children = list(iter(children))
+        self.world_version = 0         # changes each time world_transform does
+        self.world_bounds, self._bounds_key = None, None
+        self.children = []
+        self.add(*children)
+
+    @property
+    def transform(self):
+        """ local transform, relative to the parent node """
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        """ set local transform, marking this subtree's world transforms dirty:
+            children see a new parent world matrix object once it's updated """
+        if self.hierarchy is not None:      # we are a view in its arrays
+            self._transform[...] = transform
+            self.hierarchy.dirty = True
+        else:
+            self._transform = transform
+        self._world_dirty = True
+        for parent in self.parents:   # bounds of parents hold our transform
+            parent.invalidate_bounds()
 
     def add(self, *drawables):
         """ Add drawables to this node, simply updating children list """
         self.children.extend(drawables)
-
-    def draw(self, model=identity(), **other_uniforms):
-        """ Recursive draw, passing down updated model matrix. """
-        self.world_transform = model @ self.transform
+        for child in drawables:
+            if isinstance(child, Node):
+                child.parents.append(self)
+                if self.hierarchy is not None:  # updated by traversal below us
+                    self.hierarchy.boundary.append(child)
+        self.invalidate_bounds()
+
+    @property
+    def bounds(self):
+        """ Bounding box of the subtree in this node's frame, computed on
+            demand and cached until a descendant transform changes. None if
+            some drawable below has no bounds, the subtree is then never
+            culled """
+        if not self._bounds_valid:
+            boxes = []
+            for child in self.children:
+                box = getattr(child, 'bounds', None)
+                if box is None:
+                    boxes = None
+                    break
+                if isinstance(child, Node):
+                    box = transform_bounds(box, child.transform)
+                boxes.append(box)
+            if boxes is None or not self.cullable:
+                self._bounds = None
+            else:
+                self._bounds = bounds_union(empty_bounds(), *boxes)
+            self._bounds_valid = True
+        return self._bounds
+
+    def invalidate_bounds(self):
+        """ Forget cached bounds of this node and of all its ancestors """
+        if self._bounds_valid:
+            self._bounds_valid = False
+            for parent in self.parents:
+                parent.invalidate_bounds()
+
+    def update_world_transform(self, model):
+        """ Cached world transform, recomputed only if our transform changed or
+            the parent world matrix is another object than at the last update.
+            Static subtrees thus reuse the same matrices frame after frame.
+            Nodes of a TransformHierarchy are updated all at once by it, but
+            transforms set during the traversal are propagated right away """
+        if self.hierarchy is None:
+            if self._world_dirty or model is not self._parent_world:
+                self.world_transform = model @ self.transform
+                self._parent_world, self._world_dirty = model, False
+                self.world_version = next(world_versions)
+                frame_stats['world_updates'] += 1
+        elif self is self.hierarchy.root:
+            self.hierarchy.update(model)
+            self.world_version, self._world_dirty = self.hierarchy.version, False
+        elif self._world_dirty:         # matrices are updated in place
+            np.matmul(model, self._transform, out=self.world_transform)
+            self.world_version, self._world_dirty = next(world_versions), False
+            for child in (c for c in self.children if isinstance(c, Node)):
+                child._world_dirty = True
+            frame_stats['world_updates'] += 1
+        else:
+            self.world_version = self.hierarchy.version
+        return self.world_transform
+
+    def update_world_bounds(self):
+        """ World bounding box, cached like the world transform """
+        box, key = self.bounds, self._bounds_key
+        if key is None or key[0] is not box or key[1] != self.world_version:
+            self.world_bounds = transform_bounds(box, self.world_transform)
+            self._bounds_key = (box, self.world_version)
+        return self.world_bounds
+
+    def draw(self, model=identity(), frustum=None, **other_uniforms):
+        """ Recursive draw, passing down updated model matrix. Subtrees whose
+            world bounds are outside the optional frustum planes are skipped """
+        self.update_world_transform(model)
+        if frustum is not None and self.bounds is not None:
+            if bounds_outside(self.update_world_bounds(), frustum):
+                frame_stats['culled'] += 1
+                return
         for child in self.children:
-            child.draw(model=self.world_transform, **other_uniforms)
+            child.draw(model=self.world_transform, frustum=frustum,
+                       **other_uniforms)
 
     def key_handler(self, key):
         """ Dispatch keyboard events to children with key handler """
@@ -179,148 +481,365 @@ class Node:
 
 
 # -------------- 3D resource loader -------------------------------------------
-MAX_BONES = 128
+MAX_BONES = 128         # bone_matrix uniform array size, without palette buffer
 
 # optionally load texture module
 try:
-    from texture import Texture, Textured
+    from texture import Texture, Textured, texture_registry
 except ImportError:
-    Texture, Textured = None, None
+    Texture, Textured, texture_registry = None, None, None
 
 # optionally load animation module
 try:
-    from animation import KeyFrameControlNode, Skinned
+    from animation import (KeyFrameControlNode, Skinned, Skeleton, Animator,
+                           ClipKeyFrames, BakedClip)
 except ImportError:
-    KeyFrameControlNode, Skinned = None, None
-
-
-def load(file, shader, tex_file=None, **params):
-    """load resources from file using assimp, return node hierarchy """
-    try:
-        pp = assimpcy.aiPostProcessSteps
-        flags = pp.aiProcess_JoinIdenticalVertices | pp.aiProcess_FlipUVs
-        flags |= pp.aiProcess_OptimizeMeshes | pp.aiProcess_Triangulate
-        flags |= pp.aiProcess_GenSmoothNormals
-        flags |= pp.aiProcess_ImproveCacheLocality
-        flags |= pp.aiProcess_RemoveRedundantMaterials
-        scene = assimpcy.aiImportFile(file, flags)
-    except assimpcy.all.AssimpError as exception:
-        print('ERROR loading', file + ': ', exception.args[0].decode())
-        return []
+    KeyFrameControlNode, Skinned, Skeleton, Animator = None, None, None, None
+    ClipKeyFrames, BakedClip = None, None
+
+
+# assimp post processing applied to all imported files
+_pp = assimpcy.aiPostProcessSteps
+IMPORT_FLAGS = (_pp.aiProcess_JoinIdenticalVertices | _pp.aiProcess_FlipUVs
+                | _pp.aiProcess_OptimizeMeshes | _pp.aiProcess_Triangulate
+                | _pp.aiProcess_GenSmoothNormals
+                | _pp.aiProcess_ImproveCacheLocality
+                | _pp.aiProcess_RemoveRedundantMaterials)
+
+
+def import_scene(file, flags=IMPORT_FLAGS, use_cache=True):
+    """ Import a 3D file as a plain scene description made of dicts, lists and
+        numpy arrays. Descriptions are kept in the on-disk cache, keyed by file
+        content and import flags, so that later imports skip assimp entirely.
+        Raises OSError if the file cannot be read, for its content hash, and
+        assimpcy.all.AssimpError if it cannot be imported """
+    key = disk_cache.cache_key(file, int(flags))
+    scene = disk_cache.load_entry('models', key) if use_cache else None
+    if scene is None:
+        scene = describe_scene(assimpcy.aiImportFile(file, flags))
+        if use_cache:
+            disk_cache.save_entry('models', key, scene)
+    return scene
+
+
+def prefetch_scene(file):
+    """ start importing a 3D file on the default asset loader, load() then
+        only waits for its scene description and uploads it """
+    asset_loader.submit('scene', file, import_scene)
+
+
+def _name(name):
+    """ assimp names as python strings """
+    return name.decode() if isinstance(name, bytes) else str(name)
+
+
+def bone_weight_arrays(bone):
+    """ vertex ids and weights of an assimp bone, as two arrays """
+    count = len(bone.mWeights)
+    return (np.fromiter((entry.mVertexId for entry in bone.mWeights), 'u4', count),
+            np.fromiter((entry.mWeight for entry in bone.mWeights), 'f4', count))
+
+
+def skinning_attributes(nb_vertices, bones, slots=4):
+    """ Per vertex bone_ids & bone_weights (nb_vertices x slots float32) from
+        per bone (vertex ids, weights) arrays: keep the highest weights of each
+        vertex and renormalize them to sum to one """
+    vertex_ids = np.concatenate([ids for ids, _ in bones]
+                                + [np.zeros(0, 'u4')]).astype(np.int64)
+    weights = np.concatenate([weights for _, weights in bones]
+                             + [np.zeros(0, 'f4')])
+    bone_ids = np.repeat(np.arange(len(bones), dtype='f4'),
+                         [len(ids) for ids, _ in bones])
+
+    # group entries by vertex, highest weight first, then rank them in group
+    order = np.lexsort((-weights, vertex_ids))
+    vertex_ids, weights, bone_ids = (vertex_ids[order], weights[order],
+                                     bone_ids[order])
+    starts = np.flatnonzero(np.diff(vertex_ids, prepend=-1))
+    ranks = np.arange(len(vertex_ids)) - np.repeat(starts, np.diff(
+        np.append(starts, len(vertex_ids))))
+    keep = ranks < slots
+
+    slot_ids = np.zeros((nb_vertices, slots), 'f4')
+    slot_weights = np.zeros((nb_vertices, slots), 'f4')
+    slot_ids[vertex_ids[keep], ranks[keep]] = bone_ids[keep]
+    slot_weights[vertex_ids[keep], ranks[keep]] = weights[keep]
+    total = slot_weights.sum(axis=1, keepdims=True)
+    np.divide(slot_weights, total, out=slot_weights, where=total > 0)
+    return slot_ids, slot_weights
+
+
+def describe_scene(scene):
+    """ Convert an assimp scene to a plain description: vertex arrays, indices,
+        skinning attributes, materials, node hierarchy and keyframes """
+    materials = []
+    for mat in scene.mMaterials:
+        props = mat.properties
+        materials.append(dict(
+            k_d=np.asarray(props.get('COLOR_DIFFUSE', (1, 1, 1)), 'f'),
+            k_s=np.asarray(props.get('COLOR_SPECULAR', (1, 1, 1)), 'f'),
+            k_a=np.asarray(props.get('COLOR_AMBIENT', (0, 0, 0)), 'f'),
+            s=float(props.get('SHININESS', 16.)),
+            texture=props.get('TEXTURE_BASE')))  # texture token, if any
+
+    meshes = []
+    for mesh in scene.mMeshes:
+        attributes = dict(position=np.asarray(mesh.mVertices, 'f'),
+                          normal=np.asarray(mesh.mNormals, 'f'))
+
+        # ---- optionally add texture coordinates attribute if present
+        if mesh.HasTextureCoords[0]:
+            attributes.update(tex_coord=np.asarray(mesh.mTextureCoords[0], 'f'))
+
+        # --- optionally add vertex colors as attributes if present
+        if mesh.HasVertexColors[0]:
+            attributes.update(color=np.asarray(mesh.mColors[0], 'f'))
+
+        # ---- compute and add optional skinning vertex attributes
+        bones, bone_offsets = [], np.zeros((0, 4, 4), 'f')
+        if mesh.HasBones:
+            # skinned mesh: weights given per bone => convert per vertex for GPU
+            bone_ids, bone_weights = skinning_attributes(
+                mesh.mNumVertices, [bone_weight_arrays(bone)
+                                    for bone in mesh.mBones])
+            attributes.update(bone_ids=bone_ids, bone_weights=bone_weights)
+            bones = [_name(bone.mName) for bone in mesh.mBones]
+            bone_offsets = np.array([bone.mOffsetMatrix for bone in mesh.mBones],
+                                    'f')
+
+        meshes.append(dict(attributes=attributes,
+                           index=np.asarray(mesh.mFaces, np.uint32),
+                           material=int(mesh.mMaterialIndex),
+                           bones=bones, bone_offsets=bone_offsets))
+
+    def describe_node(node):
+        return dict(name=_name(node.mName),
+                    transform=np.asarray(node.mTransformation, 'f'),
+                    meshes=[int(mesh_id) for mesh_id in node.mMeshes],
+                    children=[describe_node(child) for child in node.mChildren])
+
+    def keys(assimp_keys, ticks_per_second):
+        """ keyframe times in seconds and values, as two arrays """
+        times = [key.mTime / ticks_per_second for key in assimp_keys]
+        values = [key.mValue for key in assimp_keys]
+        return dict(times=np.asarray(times, 'f8'), values=np.asarray(values, 'f'))
+
+    animations = []
+    for anim in scene.mAnimations if scene.HasAnimations else ():
+        ticks = anim.mTicksPerSecond or 25.0   # 0 means unspecified in assimp
+        animations.append(dict(
+            name=_name(getattr(anim, 'mName', '')),
+            channels={_name(channel.mNodeName): dict(
+                position=keys(channel.mPositionKeys, ticks),
+                rotation=keys(channel.mRotationKeys, ticks),
+                scale=keys(channel.mScalingKeys, ticks))
+                for channel in anim.mChannels}))
+
+    return dict(meshes=meshes, materials=materials,
+                root=describe_node(scene.mRootNode), animations=animations)
+
+
+class ModelCache:
+    """ GPU resources of loaded models, so that loading a file again builds a
+        new scene graph instance backed by the same vertex arrays & textures """
+    def __init__(self):
+        self.models = {}        # (file path, shader) -> model entry
+
+    def get(self, file, shader):
+        """ cached model entry for file and shader, or None """
+        return self.models.get((os.path.realpath(file), shader))
+
+    def add(self, file, shader, scene):
+        """ upload the meshes of a scene description, return the new entry """
+        entry = dict(scene=scene, diffuse_maps={}, instances=weakref.WeakSet(),
+                     vertex_arrays=[VertexArray(shader, mesh['attributes'],
+                                                mesh['index'])
+                                    for mesh in scene['meshes']])
+        self.models[(os.path.realpath(file), shader)] = entry
+        return entry
+
+    def evict(self, unused_only=True):
+        """ drop models, by default only those without live instances. The
+            GPU buffers are freed once no mesh uses them anymore """
+        gc.collect()            # scene graphs hold parent <-> child cycles
+        for key, entry in list(self.models.items()):
+            if not unused_only or not entry['instances']:
+                del self.models[key]
+                for diffuse_maps in entry['diffuse_maps'].values():
+                    for texture in filter(None, diffuse_maps):
+                        if texture_registry is not None:
+                            texture_registry.release(texture)
+
+
+# default model cache, used by load()
+model_cache = ModelCache()
+
+
+def make_clip(model, key, channels, bake_rate=None):
+    """ clip of animation channels for a new instance: keyframes of its own,
+        or a view of a table baked once per model and animation key """
+    if not bake_rate:
+        return ClipKeyFrames(channels)
+    if ('baked', key, bake_rate) not in model:
+        baked = BakedClip.bake(ClipKeyFrames(channels), bake_rate)
+        model['baked', key, bake_rate] = baked
+        print('Baked animation:', baked.report())
+    return BakedClip(model['baked', key, bake_rate], list(channels))
+
+
+def animation_channels(model, file, animation=0):
+    """ channels of an animation of file, given by index or name, kept in
+        the model entry. The file is imported for its keyframes only, its
+        meshes are not uploaded. None if it cannot be found """
+    key = ('animation', os.path.realpath(file), animation)
+    if key not in model:
+        try:
+            scene = asset_loader.result('scene', file) or import_scene(file)
+        except assimpcy.all.AssimpError as exception:
+            print('ERROR loading', file + ': ', exception.args[0].decode())
+            return None
+        except OSError as exception:    # missing or unreadable file
+            print('ERROR loading', file + ': ', exception.strerror)
+            return None
+        animations = scene['animations']
+        found = (animations[animation:animation + 1] if isinstance(animation, int)
+                 else [anim for anim in animations if anim['name'] == animation])
+        if not found:
+            print('ERROR no animation %r in %s' % (animation, file))
+            return None
+        model[key] = found[0]['channels']
+    return model[key]
+
+
+def load(file, shader, tex_file=None, bake_rate=None, clips=None, **params):
+    """load resources from file using assimp, return node hierarchy. Loading
+       an already loaded file only builds a new instance of the cached model.
+       With a bake_rate, the animation is sampled once per model into a table
+       at that many samples per second, shared by its instances.
+       clips maps names to files, or (file, animation index or name) pairs,
+       of animations of the same rig: the root is then an Animator playing
+       them on the one mesh of file, instead of the file's first animation """
+    model = model_cache.get(file, shader)
+    if model is None:
+        try:
+            scene = asset_loader.result('scene', file) or import_scene(file)
+            model = model_cache.add(file, shader, scene)
+        except assimpcy.all.AssimpError as exception:
+            print('ERROR loading', file + ': ', exception.args[0].decode())
+            return []
+        except OSError as exception:    # missing or unreadable file
+            print('ERROR loading', file + ': ', exception.strerror)
+            return []
+    scene = model['scene']
 
     # ----- Pre-load textures; embedded textures not supported at the moment
-    path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
-    for mat in scene.mMaterials:
-        if tex_file:
-            tfile = tex_file
-        elif 'TEXTURE_BASE' in mat.properties:  # texture token
-            name = mat.properties['TEXTURE_BASE'].split('/')[-1].split('\\')[-1]
-            # search texture in file's whole subdir since path often screwed up
-            paths = os.walk(path, followlinks=True)
-            tfile = next((os.path.join(d, f) for d, _, n in paths for f in n
-                     if name.startswith(f) or f.startswith(name)), None)
-            assert tfile, 'Cannot find texture %s in %s subtree' % (name, path)
-        else:
-            tfile = None
-        if Texture is not None and tfile:
-            mat.properties['diffuse_map'] = Texture(tex_file=tfile)
-            print("Texture Loaded : ", tfile)
+    if tex_file not in model['diffuse_maps']:
+        model['diffuse_maps'][tex_file] = find_textures(file, scene, tex_file)
+    diffuse_maps = model['diffuse_maps'][tex_file]
 
     # ----- load animations
-    def conv(assimp_keys, ticks_per_second):
-        """ Conversion from assimp key struct to our dict representation """
-        return {key.mTime / ticks_per_second: key.mValue for key in assimp_keys}
-
-    # load first animation in scene file (could be a loop over all animations)
-    transform_keyframes = {}
-    if scene.HasAnimations:
+    # named clips from any files, each clip's channels evaluated at once
+    named_clips = {}
+    for name, source in (clips.items() if clips and Animator else ()):
+        clip_file, animation = (source, 0) if isinstance(source, str) else source
+        channels = animation_channels(model, clip_file, animation)
+        if channels is not None:
+            key = (os.path.realpath(clip_file), animation)
+            named_clips[name] = make_clip(model, key, channels, bake_rate)
+
+    # else first animation in scene file, all channels evaluated at once
+    clip = None
+    if not named_clips and scene['animations'] and KeyFrameControlNode:
         print("Animation detected in file ", file)
-        anim = scene.mAnimations[0]
-        for channel in anim.mChannels:
-            # for each animation bone, store TRS dict with {times: transforms}
-            transform_keyframes[channel.mNodeName] = (
-                conv(channel.mPositionKeys, anim.mTicksPerSecond),
-                conv(channel.mRotationKeys, anim.mTicksPerSecond),
-                conv(channel.mScalingKeys, anim.mTicksPerSecond)
-            )
+        channels = scene['animations'][0]['channels']
+        clip = make_clip(model, (os.path.realpath(file), 0), channels, bake_rate)
+
+    # skinned & animated: a skeleton poses all nodes and shares bone palettes
+    skinned = Skinned and any(mesh['bones'] for mesh in scene['meshes'])
+    use_skeleton = bool(named_clips) or (clip is not None and skinned)
 
     # ---- prepare scene graph nodes
-    nodes = {}                                       # nodes name -> node lookup
-    nodes_per_mesh_id = [[] for _ in scene.mMeshes]  # nodes holding a mesh_id
-
-    def make_nodes(assimp_node):
-        """ Recursively builds nodes for our graph, matching assimp nodes """
-        keyframes = transform_keyframes.get(assimp_node.mName, None)
-        if keyframes and KeyFrameControlNode:
-            node = KeyFrameControlNode(*keyframes, assimp_node.mTransformation)
+    nodes = {}                                          # nodes name -> node lookup
+    nodes_per_mesh_id = [[] for _ in scene['meshes']]   # nodes holding a mesh_id
+
+    def make_nodes(description):
+        """ Recursively builds nodes for our graph, matching scene nodes """
+        if (clip is not None and not use_skeleton
+                and description['name'] in clip.index):
+            node = KeyFrameControlNode(transform=description['transform'],
+                                       keyframes=clip.channel(description['name']))
         else:
-            node = Node(transform=assimp_node.mTransformation)
-        nodes[assimp_node.mName] = node
-        for mesh_index in assimp_node.mMeshes:
+            node = Node(transform=description['transform'])
+        nodes[description['name']] = node
+        for mesh_index in description['meshes']:
             nodes_per_mesh_id[mesh_index] += [node]
-        node.add(*(make_nodes(child) for child in assimp_node.mChildren))
+        node.add(*(make_nodes(child) for child in description['children']))
         return node
 
-    root_node = make_nodes(scene.mRootNode)
+    root_node = make_nodes(scene['root'])
+    skeleton = None
+    if named_clips:
+        skeleton = Animator(root_node, named_clips, nodes)
+        print('Animator clips:', ', '.join(named_clips))
+    elif use_skeleton:
+        skeleton = Skeleton(root_node, clip, nodes)
 
     # ---- create optionally decorated (Skinned, Textured) Mesh objects
-    for mesh_id, mesh in enumerate(scene.mMeshes):
+    for mesh_id, mesh in enumerate(scene['meshes']):
         # retrieve materials associated to this mesh
-        mat = scene.mMaterials[mesh.mMaterialIndex].properties
+        mat = scene['materials'][mesh['material']]
 
         # initialize mesh with args from file, merge and override with params
-        index = mesh.mFaces
-        uniforms = dict(
-            k_d=mat.get('COLOR_DIFFUSE', (1, 1, 1)),
-            k_s=mat.get('COLOR_SPECULAR', (1, 1, 1)),
-            k_a=mat.get('COLOR_AMBIENT', (0, 0, 0)),
-            s=mat.get('SHININESS', 16.),
-        )
-        attributes = dict(
-            position=mesh.mVertices,
-            normal=mesh.mNormals,
-        )
+        uniforms = dict(k_d=mat['k_d'], k_s=mat['k_s'], k_a=mat['k_a'],
+                        s=mat['s'])
 
-        # ---- optionally add texture coordinates attribute if present
-        if mesh.HasTextureCoords[0]:
-            attributes.update(tex_coord=mesh.mTextureCoords[0])
+        new_mesh = Mesh(shader=shader, uniforms={**uniforms, **params},
+                        vertex_array=model['vertex_arrays'][mesh_id])
 
-        # --- optionally add vertex colors as attributes if present
-        if mesh.HasVertexColors[0]:
-            attributes.update(color=mesh.mColors[0])
-
-        # ---- compute and add optional skinning vertex attributes
-        if mesh.HasBones:
-            # skinned mesh: weights given per bone => convert per vertex for GPU
-            # first, populate an array with MAX_BONES entries per vertex
-            vbone = np.array([[(0, 0)] * MAX_BONES] * mesh.mNumVertices,
-                             dtype=[('weight', 'f4'), ('id', 'u4')])
-            for bone_id, bone in enumerate(mesh.mBones[:MAX_BONES]):
-                for entry in bone.mWeights:  # need weight,id pairs for sorting
-                    vbone[entry.mVertexId][bone_id] = (entry.mWeight, bone_id)
-
-            vbone.sort(order='weight')   # sort rows, high weights last
-            vbone = vbone[:, -4:]        # limit bone size, keep highest 4
-
-            attributes.update(bone_ids=vbone['id'],
-                              bone_weights=vbone['weight'])
-
-        new_mesh = Mesh(shader=shader, attributes=attributes,
-                        uniforms={**uniforms, **params}, index=index)
-
-        if Textured is not None and 'diffuse_map' in mat:
-            new_mesh = Textured(new_mesh, diffuse_map=mat['diffuse_map'])
-            print("Binded diffuse map : ", mat['diffuse_map'])
-        if Skinned and mesh.HasBones:
+        diffuse_map = diffuse_maps[mesh['material']]
+        if Textured is not None and diffuse_map is not None:
+            new_mesh = Textured(new_mesh, diffuse_map=diffuse_map)
+            print("Binded diffuse map : ", diffuse_map)
+        if Skinned and mesh['bones']:
             # make bone lookup array & offset matrix, indexed by bone index (id)
-            bone_nodes = [nodes[bone.mName] for bone in mesh.mBones]
-            bone_offsets = [bone.mOffsetMatrix for bone in mesh.mBones]
-            new_mesh = Skinned(new_mesh, bone_nodes, bone_offsets)
+            bone_nodes = [nodes[bone] for bone in mesh['bones']]
+            for bone_node in bone_nodes:  # bones update even when unseen
+                bone_node.cullable = False
+                bone_node.invalidate_bounds()
+            new_mesh = Skinned(new_mesh, bone_nodes, mesh['bone_offsets'],
+                               skeleton)
             print("Skinned & hasbones")
         for node_to_populate in nodes_per_mesh_id[mesh_id]:
             node_to_populate.add(new_mesh)
 
-    nb_triangles = sum((mesh.mNumFaces for mesh in scene.mMeshes))
-    print('Loaded', file, '\t(%d meshes, %d faces, %d nodes, %d animations)' %
-          (scene.mNumMeshes, nb_triangles, len(nodes), scene.mNumAnimations))
-    return [root_node]
\ No newline at end of file
+    root_node = skeleton or root_node
+    model['instances'].add(root_node)
+    nb_triangles = sum((len(mesh['index']) for mesh in scene['meshes']))
+    print('Loaded', file, '\t(%d meshes, %d faces, %d nodes, %d animations, '
+          'instance %d)' % (len(scene['meshes']), nb_triangles, len(nodes),
+                            len(scene['animations']), len(model['instances'])))
+    return [root_node]
+
+
+def find_textures(file, scene, tex_file=None):
+    """ Diffuse map of each scene material, tex_file overriding them all """
+    path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
+    diffuse_maps = []
+    for mat in scene['materials']:
+        if tex_file:
+            tfile = tex_file
+        elif mat['texture']:  # texture token
+            name = mat['texture'].split('/')[-1].split('\\')[-1]
+            # search texture in file's whole subdir since path often screwed up
+            paths = os.walk(path, followlinks=True)
+            tfile = next((os.path.join(d, f) for d, _, n in paths for f in n
+                     if name.startswith(f) or f.startswith(name)), None)
+            assert tfile, 'Cannot find texture %s in %s subtree' % (name, path)
+        else:
+            tfile = None
+        if Texture is not None and tfile:
+            diffuse_maps.append(texture_registry.acquire(tfile))
+            print("Texture Loaded : ", tfile)
+        else:
+            diffuse_maps.append(None)
+    return diffuse_maps
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Persistent on-disk cache for imported assets.
+Entries are trees of dicts, lists, JSON values and numpy arrays. Each entry is
+a directory with an index.json tree, and one .npy file per array, loaded back
+as read-only memory maps.
+"""
+# Python built-in modules
+import hashlib                      # content hash of cached source files
+import json                         # cache entry tree structure
+import os                           # os function, i.e. checking file status
+import shutil                       # cleanup of half written entries
+import tempfile                     # entries are written then renamed
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+CACHE_VERSION = 3                   # bump when cached data layout changes
+
+
+def cache_key(file, *salt):
+    """ Cache key from the content of file, and any extra hashable settings
+        (import flags...) that change what is derived from it """
+    digest = hashlib.sha1()
+    with open(file, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(repr((CACHE_VERSION,) + salt).encode())
+    return digest.hexdigest()
+
+
+def load_entry(category, key):
+    """ Cached tree for key, arrays memory mapped, or None on cache miss """
+    path = os.path.join(CACHE_DIR, category, key)
+    try:
+        with open(os.path.join(path, 'index.json')) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+    def restore(value):
+        if isinstance(value, dict) and '__array__' in value:
+            array_file = os.path.join(path, value['__array__'])
+            try:
+                return np.load(array_file, mmap_mode='r')
+            except ValueError:          # empty arrays cannot be mapped
+                return np.load(array_file)
+        if isinstance(value, dict):
+            return {key: restore(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [restore(item) for item in value]
+        return value
+    return restore(index)
+
+
+def save_entry(category, key, tree):
+    """ Store tree for key, atomically: readers see all of it or nothing """
+    arrays = []
+
+    def flatten(value):
+        if isinstance(value, np.ndarray):
+            arrays.append(('%d.npy' % len(arrays), value))
+            return {'__array__': arrays[-1][0]}
+        if isinstance(value, dict):
+            return {str(key): flatten(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [flatten(item) for item in value]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+    index = flatten(tree)
+
+    directory = os.path.join(CACHE_DIR, category)
+    os.makedirs(directory, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=directory)
+    try:
+        for name, array in arrays:
+            np.save(os.path.join(staging, name), np.ascontiguousarray(array))
+        with open(os.path.join(staging, 'index.json'), 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(staging, os.path.join(directory, key))
+    except OSError:                     # concurrent writer won, or disk error
+        shutil.rmtree(staging, ignore_errors=True)
@@ -1,15 +1,123 @@
 #!/usr/bin/env python3
+import ctypes                       # byte offsets into the index buffer
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import numpy as np                  # all matrix manipulations & OpenGL args
-from core import Mesh
-from texture import Texture
+from core import Mesh, frame_stats
+from heightfield import load_heightfield, MAX_HEIGHT
+from texture import texture_registry
 from PIL import Image
 
-from transform import normalized
+from transform import bounds_outside
+
+
+# ground textures blended by the texture map, by shader name
+TERRAIN_TEXTURES = dict(water_tex="textures/water2.jpg",
+                        beach_tex="textures/beach.jpg",
+                        grass_tex="textures/grass.png")
+
+
+def build_terrain(hmap, size, max_height=MAX_HEIGHT):
+    """ Vectorized terrain builder from the red channel of a height map.
+        Returns float32 positions, normals, tex coords and a uint32 index
+        buffer for a size x size vertex grid, vertex (x, z) at z * size + x """
+    return (*terrain_vertices(hmap, size, max_height), grid_indices(size))
+
+
+def terrain_vertices(hmap, size, max_height=MAX_HEIGHT):
+    """ float32 positions, normals and tex coords of the terrain vertex grid """
+    # heights[z, x] is hmap[x, z]: exact in float32 since hmap holds bytes,
+    # where the old per vertex uint8 * 25 wrapped around above texel 10
+    heights = hmap[:size, :size, 0].T.astype(np.float32) * max_height / 256
+    return grid_vertices(heights)
+
+
+def grid_vertices(heights):
+    """ float32 positions, normals and tex coords of a vertex grid, vertex
+        (x, z) at height heights[z, x] """
+    size = len(heights)
+    grid_z, grid_x = np.indices((size, size), dtype=np.float32)
+
+    positions = np.stack((grid_x, heights, grid_z), axis=-1).reshape(-1, 3)
+    tex_coords = np.stack((grid_x, grid_z), axis=-1).reshape(-1, 2)
+
+    # central differences on inner vertices, border vertices point up (0, 1, 0)
+    normals = np.zeros((size, size, 3), np.float32)
+    normals[..., 1] = 1
+    vec_x = (heights[1:-1, :-2] - heights[1:-1, 2:]) / 2
+    vec_z = (heights[:-2, 1:-1] - heights[2:, 1:-1]) / 2
+    # normalize in double precision, as the per vertex version used to do
+    norm = np.sqrt(np.square(vec_x, dtype=np.float64) + 1.0
+                   + np.square(vec_z, dtype=np.float64))
+    normals[1:-1, 1:-1, 0] = vec_x / norm
+    normals[1:-1, 1:-1, 1] = 1.0 / norm
+    normals[1:-1, 1:-1, 2] = vec_z / norm
+    normals = normals.reshape(-1, 3)
+
+    return positions, normals, tex_coords
+
+
+def grid_indices(size):
+    """ uint32 triangle indices of a size x size vertex grid, two triangles
+        per grid cell, vertex (x, z) at z * size + x """
+    top_left = np.arange(size * (size - 1), dtype=np.uint32).reshape(size - 1, size)
+    top_left = top_left[:, :-1]
+    bottom_left = top_left + size
+    indices = np.stack((top_left, bottom_left, top_left + 1,
+                        top_left + 1, bottom_left, bottom_left + 1), axis=-1)
+    return indices.reshape(-1)
+
+
+# -------------- Quadtree terrain tiles with levels of detail -----------------
+TILE_SIZE = 32     # grid cells per tile edge, the same at every level of detail
+
+# tile edges flags: north is z = 0, east is x = TILE_SIZE, etc.
+NORTH, EAST, SOUTH, WEST = 1, 2, 4, 8
+
+
+def stitched_tile_indices(tile_size, mask):
+    """ Triangle indices of a (tile_size + 1)^2 vertex tile whose edges
+        flagged in mask skip their odd vertices, so that they match the edge
+        of a twice coarser neighbour tile. Odd edge vertices are snapped onto
+        their even neighbour, which turns the edge cells into triangle fans """
+    z, x = np.indices((tile_size + 1, tile_size + 1))
+    odd_x, odd_z = x % 2 == 1, z % 2 == 1
+    snap_x, snap_z = x.copy(), z.copy()
+    if mask & NORTH:
+        snap_x[(z == 0) & odd_x] -= 1
+    if mask & SOUTH:
+        snap_x[(z == tile_size) & odd_x] -= 1
+    if mask & WEST:
+        snap_z[(x == 0) & odd_z] -= 1
+    if mask & EAST:
+        snap_z[(x == tile_size) & odd_z] -= 1
+    remap = (snap_z * (tile_size + 1) + snap_x).reshape(-1).astype(np.uint32)
+    triangles = remap[grid_indices(tile_size + 1)].reshape(-1, 3)
+    a, b, c = triangles.T
+    return triangles[(a != b) & (b != c) & (a != c)].reshape(-1)
+
+
+class TerrainTile:
+    """ Quadtree node covering a square of cells terrain cells from (x, z),
+        sampled with (TILE_SIZE + 1)^2 vertices whatever its size """
+    def __init__(self, x, z, cells, depth, height_range=(0., 0.)):
+        self.x, self.z, self.cells, self.depth = x, z, cells, depth
+        self.children = []
+        self.base_vertex = 0
+        self.bounds = np.array(((x, height_range[0], z),
+                                (x + cells, height_range[1], z + cells)), 'f')
+
+    def distance(self, position):
+        """ distance from a local space position to the tile bounding box """
+        gap = np.maximum(np.maximum(self.bounds[0] - position,
+                                    position - self.bounds[1]), 0)
+        return np.sqrt(gap @ gap)
+
 
 class Ground(Mesh):
-    """ Simple first textured object """
-    def __init__(self, shader, texmap_file, hmap_file, size, light):
+    """ Height map terrain, split in a quadtree of tiles. Each frame, every
+        drawn tile gets a level of detail from its distance to the camera """
+    def __init__(self, shader, texmap_file, hmap_file, size, light,
+                 tile_size=TILE_SIZE, lod_distance=2.0):
         # prepare texture modes cycling variables for interactive toggling
         # self.wraps = cycle([GL.GL_REPEAT, GL.GL_MIRRORED_REPEAT,
         #                     GL.GL_CLAMP_TO_BORDER, GL.GL_CLAMP_TO_EDGE])
@@ -24,8 +132,16 @@ class Ground(Mesh):
         self.hmap_file = hmap_file
         self.light = light
 
-        # Get height map for ground generation
-        self.hmap = np.asarray(Image.open(hmap_file).convert('RGB'))
+        # tiles are split while the camera is closer than lod_distance times
+        # their edge length, so the number of drawn tiles grows with log(size)
+        assert tile_size % 2 == 0, 'tile stitching needs an even tile size'
+        self.tile_size = tile_size
+        self.lod_distance = lod_distance
+        self.nb_triangles = 0
+
+        # Get heights for ground generation from the shared heightfield, whose
+        # height map is decoded once, in the background if it was prefetched
+        self.heights = load_heightfield(hmap_file).heights[:size, :size].T
         texmap_image = Image.open(texmap_file).convert('RGB')
         water_image, beach_image, grass_image = texmap_image.split()
 
@@ -39,106 +155,173 @@ class Ground(Mesh):
         # indices = np.array((0, 2, 1, 0, 3, 2), np.uint32)
 
         self.init_ground()
-        
-        mesh = Mesh(shader, 
-                    attributes=dict(position=self.vertice_array, 
-                                    normal=self.normal_array, 
-                                    tex_coords=self.tex_coords_array
-                                    ), 
-                    index=self.indices)
-        self.drawable = mesh
 
         # setup & upload texture to GPU, bind it to shader name 'diffuse_map'
-        water_tex = Texture("textures/water2.jpg", self.wrap, *self.filter)
-        beach_tex = Texture("textures/beach.jpg", self.wrap, *self.filter)
-        grass_tex = Texture("textures/grass.png", self.wrap, *self.filter)
-        texmap_tex = Texture(self.texmap_file, self.wrap, *self.filter)
-        self.textures = dict(water_tex=water_tex, 
-                             beach_tex=beach_tex, 
-                             grass_tex=grass_tex, 
-                             texmap=texmap_tex
-                             )
+        acquire = texture_registry.acquire
+        self.textures = {name: acquire(file, self.wrap, *self.filter)
+                         for name, file in TERRAIN_TEXTURES.items()}
+        self.textures['texmap'] = acquire(self.texmap_file, self.wrap, *self.filter)
 
         super().__init__(shader, 
                          attributes=dict(position=self.vertice_array, 
                                          normal=self.normal_array, 
                                          tex_coords=self.tex_coords_array
                                          ), 
+                         uniforms=dict(k_d=(0.9, 0.9, 0.9), s=100.0),
                          index=self.indices
                          )
 
     def init_ground(self):
-        vertices = []
-        normals = []
-        tex_coords = []
-        indices = []
-
-        for currentZ in range(0, self.size):
-            for currentX in range(0, self.size):
-                vertex_coord = [currentX,
-                                self.get_height(self.hmap, currentX, currentZ),
-                                currentZ]
-                vertices.append(vertex_coord)
-                normals.append(self.calc_normal(self.hmap, currentX, currentZ))
-                tex_coords.append([currentX, currentZ])
-                # print("Vcoord : ", vertex_coord)
-        
-        indices = []
-        for currentZ in range(0, self.size - 1):
-            for currentX in range(0, self.size - 1):
-                top_left = (currentZ * self.size) + currentX
-                top_right = top_left + 1
-                bottom_left = ((currentZ + 1) * self.size) + currentX
-                bottom_right = bottom_left + 1
-                indices.append([top_left, bottom_left, top_right, top_right, bottom_left, bottom_right])
-
-        self.indices = np.array(indices)
-
-        self.vertice_array = np.array(vertices)
-        self.normal_array = np.array(normals)
-        self.tex_coords_array = np.array(tex_coords)
-
-    def get_height(self, hmap, x, z):
-        # Get the height from the input heightmap
-        height = hmap[x, z, 0]
-        height = height * 25 / 256    # 25 is the max height of the ground
-        return height
-
-    def calc_normal(self, hmap, x, z):
-        # if vertex on border then set normal as (0, 1, 0)
-        if x==0 or x==self.size-1 or z==0 or z==self.size-1 :
-            return np.array([0.0, 1.0, 0.0])
-        else:
-            # Calculate the normal of a vertex from its top / bottom / left / right neighbour vertex coords
-            top_neighbour_height = self.get_height(hmap, x, z-1)
-            bot_neighbour_height = self.get_height(hmap, x, z+1)
-            # The actual vector on z axis should be half the difference, hence the "/ 2"
-            # The actual vector is actually (0, 0, vecZ) so we leave only vecZ here
-            vecZ = (top_neighbour_height - bot_neighbour_height) / 2
-
-            left_neighbour_height = self.get_height(hmap, x-1, z)
-            right_neighbour_height = self.get_height(hmap, x+1, z)
-            vecX = (left_neighbour_height - right_neighbour_height) / 2
-
-            # Combine the vectors together to get the final vector (normal)
-            final_vec = normalized(np.array([vecX, 1.0, vecZ]))
-            return final_vec
-
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
-        GL.glUseProgram(self.shader.glid)
-        
-        light_location = GL.glGetUniformLocation(self.shader.glid, 'light_dir')
-        kd_loc = GL.glGetUniformLocation(self.shader.glid, 'k_d')
-        s_loc = GL.glGetUniformLocation(self.shader.glid, 's')
-
-        GL.glUniform3fv(light_location, 1, self.light)
-
-        GL.glUniform3fv(kd_loc, 1, [0.9, 0.9, 0.9])
-        GL.glUniform1f(s_loc, 100.0)
+        """ Build the quadtree tiles, one vertex block per tile stored one after
+            the other, and the 16 stitched index patterns shared by all tiles """
+        positions, normals, tex_coords = grid_vertices(self.heights)
+        heights = positions[:, 1].reshape(self.size, self.size)
+        last = self.size - 1
+
+        # root tile spans a power of two of tiles, samples beyond the map clamp
+        tiles_per_side = 1
+        while tiles_per_side * self.tile_size < last:
+            tiles_per_side *= 2
+        self.tiles_per_side = tiles_per_side
+
+        tiles = []
+        steps = np.arange(self.tile_size + 1)
+
+        def make_tile(x, z, cells, depth):
+            area = heights[z:z + cells + 1, x:x + cells + 1]
+            tile = TerrainTile(x, z, cells, depth, (area.min(), area.max()))
+            tile.base_vertex = len(tiles) * len(steps) ** 2
+            tiles.append(tile)
+            if cells > self.tile_size:
+                half = cells // 2
+                tile.children = [make_tile(child_x, child_z, half, depth + 1)
+                                 for child_z in (z, z + half)
+                                 for child_x in (x, x + half)
+                                 if child_x < last and child_z < last]
+            return tile
+
+        self.root = make_tile(0, 0, tiles_per_side * self.tile_size, 0)
+
+        # gather the vertices of every tile from the full resolution grid
+        vertex_ids = np.empty((len(tiles), len(steps), len(steps)), np.int64)
+        for tile, ids in zip(tiles, vertex_ids):
+            stride = tile.cells // self.tile_size
+            xs = np.minimum(tile.x + stride * steps, last)
+            zs = np.minimum(tile.z + stride * steps, last)
+            ids[...] = zs[:, None] * self.size + xs[None, :]
+        vertex_ids = vertex_ids.reshape(-1)
+        self.vertice_array = positions[vertex_ids]
+        self.normal_array = normals[vertex_ids]
+        self.tex_coords_array = tex_coords[vertex_ids]
+
+        # one index buffer holding the tile triangulation for each edge mask
+        patterns = [stitched_tile_indices(self.tile_size, mask)
+                    for mask in range(16)]
+        firsts = np.cumsum([0] + [len(pattern) for pattern in patterns])
+        self.patterns = [(int(first), len(pattern))
+                         for first, pattern in zip(firsts, patterns)]
+        self.indices = np.concatenate(patterns)
+
+    def select_tiles(self, position=None, frustum=None):
+        """ Leaf tiles to draw for a terrain space camera position, each with
+            the edge mask of its sides facing a coarser neighbour tile. Tiles
+            are refined until neighbours differ by at most one level. Tiles
+            outside the optional terrain space frustum planes are skipped """
+        leaves, stack = [], [self.root]
+        while stack:
+            tile = stack.pop()
+            if frustum is not None and bounds_outside(tile.bounds, frustum):
+                frame_stats['culled'] += 1
+            elif tile.children and (position is None or tile.distance(position)
+                                    < self.lod_distance * tile.cells):
+                stack.extend(tile.children)
+            else:
+                leaves.append(tile)
+
+        # depth of the leaf covering each finest tile slot, -1 outside the map
+        depths = np.full((self.tiles_per_side,) * 2, -1)
+
+        def mark(tile):
+            i, j, span = self._slot(tile)
+            depths[j:j + span, i:i + span] = tile.depth
+
+        for tile in leaves:
+            mark(tile)
+        unbalanced = True
+        while unbalanced:
+            unbalanced = [tile for tile in leaves if tile.children and
+                          max(edge.max(initial=-1) for edge in
+                              self._neighbours(depths, tile)) > tile.depth + 1]
+            for tile in unbalanced:
+                leaves.remove(tile)
+                leaves.extend(tile.children)
+                for child in tile.children:
+                    mark(child)
+
+        selection = []
+        for tile in leaves:
+            mask = 0
+            for flag, edge in zip((NORTH, EAST, SOUTH, WEST),
+                                  self._neighbours(depths, tile)):
+                edge = edge[edge >= 0]
+                if edge.size and edge.min() < tile.depth:
+                    mask |= flag
+            selection.append((tile, mask))
+        return selection
+
+    def _slot(self, tile):
+        """ position and span of a tile in units of finest tiles """
+        return (tile.x // self.tile_size, tile.z // self.tile_size,
+                tile.cells // self.tile_size)
+
+    def _neighbours(self, depths, tile):
+        """ leaf depths along the north, east, south and west tile edges """
+        i, j, span = self._slot(tile)
+        end, none = self.tiles_per_side, np.empty(0, int)
+        return (depths[j - 1, i:i + span] if j > 0 else none,
+                depths[j:j + span, i + span] if i + span < end else none,
+                depths[j + span, i:i + span] if j + span < end else none,
+                depths[j:j + span, i - 1] if i > 0 else none)
+
+    def draw(self, primitives=GL.GL_TRIANGLES, render_queue=None, **uniforms):
+        # camera position in terrain space picks the tiles level of detail
+        model = uniforms.get('model', np.identity(4))
+        position, frustum = None, uniforms.get('frustum')
+        if uniforms.get('w_camera_position') is not None:
+            camera = np.append(np.asarray(uniforms['w_camera_position'])[:3], 1)
+            position = (np.linalg.inv(model) @ camera)[:3]
+        if frustum is not None:   # world planes to terrain space planes
+            frustum = frustum @ model
+        selection = self.select_tiles(position, frustum)
+
+        def draw_tiles(primitives):
+            self.draw_tiles(primitives, selection)
 
+        if render_queue is not None:
+            render_queue.submit(self.shader, self.vertex_array, primitives,
+                                uniforms, self.uniforms, self.textures,
+                                command=draw_tiles)
+            return
+        self.shader.use()
         for index, (name, texture) in enumerate(self.textures.items()):
             GL.glActiveTexture(GL.GL_TEXTURE0 + index)
             GL.glBindTexture(texture.type, texture.glid)
             uniforms[name] = index
-        self.drawable.draw(primitives=primitives, **uniforms)
+        frame_stats['texture_binds'] += len(self.textures)
+        self.shader.set_uniforms(uniforms, self.uniforms)
+        draw_tiles(primitives)
+        frame_stats['drawn'] += 1
 
+    def draw_tiles(self, primitives, selection):
+        """ all tiles share the index patterns, offset to their own vertex
+            block. Program, textures and uniforms must already be set """
+        GL.glBindVertexArray(self.vertex_array.glid)
+        self.nb_triangles = 0
+        for tile, mask in selection:
+            first, count = self.patterns[mask]
+            GL.glDrawElementsBaseVertex(primitives, count, GL.GL_UNSIGNED_INT,
+                                        ctypes.c_void_p(4 * first),
+                                        tile.base_vertex)
+            self.nb_triangles += count // 3
+        frame_stats['draw_calls'] += len(selection)
+        frame_stats['triangles'] += self.nb_triangles
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Headless, deterministic benchmark of the full scene: an offscreen OpenGL
+context (surfaceless EGL, e.g. Mesa llvmpipe on machines without display or
+GPU, or a hidden GLFW window), a seeded scene, time advancing by a fixed step
+and a scripted camera path. Reports frame time percentiles and the CPU scope,
+GPU pass and counter breakdown of the profiler as JSON, to compare commits.
+
+    python headless_benchmark.py --frames 300 --output bench.json
+"""
+# Python built-in modules
+import argparse                     # command line options
+import json                         # benchmark report
+import os                           # PyOpenGL platform selection
+import random                       # seeded scene placement
+import subprocess                   # commit of the benchmarked tree
+import sys                          # early command line check
+
+# the EGL context needs PyOpenGL's EGL platform, chosen when it is imported
+if '--window' not in sys.argv:
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+    os.environ.setdefault('EGL_PLATFORM', 'surfaceless')   # Mesa, no display
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import glfw                         # lean window system wrapper for OpenGL
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from main import GLOBAL_LIGHT, build_scene
+from profiler import Profiler
+from scene_constructor import prefetch_scene_assets
+from viewer import Viewer
+
+# camera keys: (time in seconds, position, yaw, pitch), the preset views
+CAMERA_PATH = [(0.0, (-80.0, 15.0, 0.0), 0.0, -15.0),
+               (4.0, (-16.0, 17.0, -103.0), 78.0, -6.0),
+               (8.0, (12.0, 19.0, -36.0), -84.0, 0.0),
+               (12.0, (60.0, 30.0, 40.0), -160.0, -20.0),
+               (16.0, (-80.0, 15.0, 0.0), 0.0, -15.0)]
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+# -------------- offscreen contexts ---------------------------------------------
+def egl_context():
+    """ make an OpenGL 3.3 core context current, without any surface """
+    import ctypes
+    from OpenGL import EGL
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    if not EGL.eglInitialize(display, None, None):
+        raise RuntimeError('cannot initialize EGL')
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    attributes = (EGL.EGLint * 5)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                  EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                                  EGL.EGL_NONE)
+    config, count = EGL.EGLConfig(), EGL.EGLint()
+    EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1,
+                        ctypes.pointer(count))
+    if not count.value:
+        raise RuntimeError('no EGL config renders OpenGL')
+    version = (EGL.EGLint * 7)(EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+                               EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+                               EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+                               EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+                               EGL.EGL_NONE)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, version)
+    if not context or not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE,
+                                             EGL.EGL_NO_SURFACE, context):
+        raise RuntimeError('cannot make an OpenGL 3.3 core context current')
+    return display, context
+
+
+def framebuffer(width, height):
+    """ bind a width x height framebuffer object with color & depth """
+    glid = GL.glGenFramebuffers(1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, glid)
+    for storage, attachment in ((GL.GL_RGBA8, GL.GL_COLOR_ATTACHMENT0),
+                                (GL.GL_DEPTH_COMPONENT24, GL.GL_DEPTH_ATTACHMENT)):
+        buffer = GL.glGenRenderbuffers(1)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, buffer)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, storage, width, height)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, attachment,
+                                     GL.GL_RENDERBUFFER, buffer)
+    status = GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER)
+    assert status == GL.GL_FRAMEBUFFER_COMPLETE, 'incomplete framebuffer'
+    GL.glViewport(0, 0, width, height)
+    return glid
+
+
+# -------------- scripted run -----------------------------------------------------
+def place_camera(camera, time, path=CAMERA_PATH):
+    """ camera at time on the path, keys linearly interpolated, looping """
+    times = [key[0] for key in path]
+    time = time % times[-1]
+    position = [np.interp(time, times, [key[1][axis] for key in path])
+                for axis in range(3)]
+    camera.position = np.array(position)
+    camera.yaw = float(np.interp(time, times, [key[2] for key in path]))
+    camera.pitch = float(np.interp(time, times, [key[3] for key in path]))
+    camera.updateCameraVectors()
+
+
+def distribution(values):
+    """ mean, percentiles and max of a list of numbers, None if empty """
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    result = dict(mean=float(np.mean(values)))
+    result.update(('p%d' % percent, float(value)) for percent, value in
+                  zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+    result['max'] = float(np.max(values))
+    return result
+
+
+def git_commit():
+    """ commit of the working tree, '+' marking local changes, or None """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '-uno'],
+                               capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.stdout.strip() + ('+' if dirty.stdout.strip() else '')
+
+
+def report(records, settings):
+    """ JSON ready summary of the profiled frames """
+    keys = list(dict.fromkeys(key for record in records for key in record))
+
+    def times(kind):
+        return {key[len(kind) + 1:-3]: distribution([r.get(key) for r in records])
+                for key in keys if key.startswith(kind + '_') and key.endswith('_ms')}
+    counters = [key for key in keys if key != 'frame' and not key.endswith('_ms')]
+    return dict(
+        settings=settings, commit=git_commit(),
+        renderer=dict(vendor=GL.glGetString(GL.GL_VENDOR).decode(),
+                      renderer=GL.glGetString(GL.GL_RENDERER).decode(),
+                      version=GL.glGetString(GL.GL_VERSION).decode()),
+        frame_ms=distribution([record['frame_ms'] for record in records]),
+        cpu_ms=times('cpu'), gpu_ms=times('gpu'),
+        counters={key: float(np.mean([record.get(key, 0) for record in records]))
+                  for key in counters})
+
+
+def main():
+    """ build the seeded scene offscreen, render it at a fixed time step along
+        the camera path, and report the profile of the measured frames """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=300, help='measured frames')
+    parser.add_argument('--warmup', type=int, default=30, help='frames not measured')
+    parser.add_argument('--step', type=float, default=1 / 60, help='seconds per frame')
+    parser.add_argument('--seed', type=int, default=0, help='scene placement seed')
+    parser.add_argument('--size', type=int, nargs=2, default=(1600, 900),
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--pipelined', action='store_true',
+                        help='update animations on a worker thread')
+    parser.add_argument('--window', action='store_true',
+                        help='hidden GLFW window instead of surfaceless EGL')
+    parser.add_argument('--output', help='JSON report file, also printed')
+    args = parser.parse_args()
+    width, height = args.size
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    prefetch_scene_assets()
+    if args.window:
+        glfw.window_hint(glfw.VISIBLE, False)
+    else:
+        egl_context()
+        framebuffer(width, height)
+    viewer = Viewer(width, height, light_dir=GLOBAL_LIGHT,
+                    pipelined=args.pipelined, window=args.window)
+    build_scene(viewer)
+
+    # fixed steps from time 0; glFinish waits for each frame to be drawn
+    pipeline = viewer.make_pipeline()
+    profiler = Profiler(window=None)
+    for index in range(args.warmup + args.frames):
+        frame_time = index * args.step
+        place_camera(viewer.camera, frame_time)
+        profiler.begin_frame()
+        viewer.render_frame(frame_time, args.step, profiler, pipeline)
+        with profiler.scope('finish'):
+            GL.glFinish()
+        profiler.end_frame()
+    profiler.close()
+    if pipeline is not None:
+        pipeline.shutdown()
+
+    records = [record for record in profiler.recent
+               if record['frame'] >= args.warmup]
+    settings = dict(frames=args.frames, warmup=args.warmup, step=args.step,
+                    seed=args.seed, width=width, height=height,
+                    pipelined=args.pipelined,
+                    context='hidden window' if args.window else 'EGL')
+    result = report(records, settings)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=1)
+    print(json.dumps(result, indent=1))
+
+
+if __name__ == '__main__':
+    main()                     # main function keeps variables locally scoped
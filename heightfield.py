@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Shared terrain heightfield: height maps are decoded once per file, big ones
+memory mapped from the disk cache, then queried for bilinearly interpolated
+heights and normals, at scalar positions or whole arrays of them.
+"""
+# Python built-in modules
+import math                         # scalar queries without numpy overhead
+import os                           # os function, i.e. resolving file paths
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+import disk_cache
+from asset_loader import asset_loader
+from texture import decode_image
+
+MAX_HEIGHT = 25         # ground height of a full intensity height map texel
+MMAP_TEXELS = 1 << 20   # maps at least this big are memory mapped from disk
+
+
+class Heightfield:
+    """ Ground heights of the red channel of a height map, heights[x, z]
+        being texel hmap[x, z] scaled to max_height, as the terrain mesh.
+        Positions are in ground units, clamped to the map edges """
+    def __init__(self, heights):
+        self.heights = heights
+        self.size_x, self.size_z = heights.shape
+
+    @classmethod
+    def from_file(cls, file, max_height=MAX_HEIGHT):
+        """ heightfield of an image file, decoded in the background if it
+            was prefetched. Maps of MMAP_TEXELS or more are stored in the disk
+            cache once, then memory mapped instead of decoded """
+        key = disk_cache.cache_key(file, max_height)
+        entry = disk_cache.load_entry('heightfields', key)
+        if entry is not None:
+            return cls(entry['heights'])
+        image = asset_loader.result('image', file)
+        image = decode_image(file) if image is None else image
+        heights = image[..., 0].astype(np.float32) * np.float32(max_height / 256)
+        if heights.size >= MMAP_TEXELS:
+            disk_cache.save_entry('heightfields', key, dict(heights=heights))
+            heights = disk_cache.load_entry('heightfields', key)['heights']
+        return cls(heights)
+
+    def cells(self, x, z):
+        """ grid cell corner (x0, z0) and fractions (fx, fz) in it """
+        x = np.clip(np.asarray(x, np.float64), 0, self.size_x - 1)
+        z = np.clip(np.asarray(z, np.float64), 0, self.size_z - 1)
+        x0 = np.minimum(x.astype(np.intp), self.size_x - 2)
+        z0 = np.minimum(z.astype(np.intp), self.size_z - 2)
+        return x0, z0, x - x0, z - z0
+
+    def corners(self, x0, z0):
+        """ heights at the 4 corners of grid cells, (x0, z0) first """
+        heights = self.heights
+        return (heights[x0, z0], heights[x0 + 1, z0],
+                heights[x0, z0 + 1], heights[x0 + 1, z0 + 1])
+
+    def height(self, x, z):
+        """ bilinear height at x, z, scalars or arrays broadcast together """
+        if np.isscalar(x) and np.isscalar(z):
+            return self.scalar_height(x, z)
+        x0, z0, fx, fz = self.cells(x, z)
+        h00, h10, h01, h11 = self.corners(x0, z0)
+        return ((h00 * (1 - fx) + h10 * fx) * (1 - fz)
+                + (h01 * (1 - fx) + h11 * fx) * fz)
+
+    def scalar_cell(self, x, z):
+        """ cells(x, z) for one position, in plain Python arithmetic """
+        x = min(max(float(x), 0.0), self.size_x - 1.0)
+        z = min(max(float(z), 0.0), self.size_z - 1.0)
+        x0, z0 = min(int(x), self.size_x - 2), min(int(z), self.size_z - 2)
+        return x0, z0, x - x0, z - z0
+
+    def scalar_height(self, x, z):
+        """ height(x, z) for one position """
+        x0, z0, fx, fz = self.scalar_cell(x, z)
+        (h00, h01), (h10, h11) = self.heights[x0:x0 + 2, z0:z0 + 2].tolist()
+        return ((h00 * (1 - fx) + h10 * fx) * (1 - fz)
+                + (h01 * (1 - fx) + h11 * fx) * fz)
+
+    def normal(self, x, z):
+        """ unit normal of the bilinear surface at x, z: (3,) for scalars,
+            else an array of shape (..., 3) """
+        if np.isscalar(x) and np.isscalar(z):
+            return np.array(self.scalar_normal(x, z))
+        x0, z0, fx, fz = self.cells(x, z)
+        h00, h10, h01, h11 = self.corners(x0, z0)
+        slope_x = (h10 - h00) * (1 - fz) + (h11 - h01) * fz
+        slope_z = (h01 - h00) * (1 - fx) + (h11 - h10) * fx
+        normals = np.stack((-slope_x, np.ones_like(slope_x), -slope_z), axis=-1)
+        return normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+    def scalar_normal(self, x, z):
+        """ normal(x, z) for one position, as an (x, y, z) tuple """
+        x0, z0, fx, fz = self.scalar_cell(x, z)
+        (h00, h01), (h10, h11) = self.heights[x0:x0 + 2, z0:z0 + 2].tolist()
+        slope_x = (h10 - h00) * (1 - fz) + (h11 - h01) * fz
+        slope_z = (h01 - h00) * (1 - fx) + (h11 - h10) * fx
+        norm = math.sqrt(slope_x * slope_x + 1 + slope_z * slope_z)
+        return (-slope_x / norm, 1 / norm, -slope_z / norm)
+
+
+heightfields = {}       # (real file path, max height) -> shared Heightfield
+
+
+def load_heightfield(file, max_height=MAX_HEIGHT):
+    """ shared Heightfield of a height map file, loaded on first use only """
+    key = (os.path.realpath(file), max_height)
+    if key not in heightfields:
+        heightfields[key] = Heightfield.from_file(file, max_height)
+    return heightfields[key]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Array backed scene graph transforms: the local and world matrices of a Node
+subtree are stored in two (N, 4, 4) arrays, in breadth first order, and world
+matrices are propagated one tree level at a time with batched matmuls.
+"""
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Node, frame_stats, world_versions
+from transform import identity
+
+
+class TransformHierarchy:
+    """ Structure of arrays holding the transforms of the nodes of a subtree.
+        Nodes become views into the arrays: setting a node transform writes
+        its row and marks the hierarchy dirty, drawing the root recomputes all
+        world matrices if needed. Transforms are best set before the scene is
+        drawn, nodes changed during the traversal (keyframe nodes) fix their
+        subtree up one node at a time. Nodes with several parents, and their
+        subtrees, are left out and keep per node updates """
+    def __init__(self, root):
+        self.root = root
+        self.nodes, parents, depths = [root], [-1], [0]
+        self.boundary = []          # regular nodes with a parent in arrays
+        for index, node in enumerate(self.nodes):   # grows while iterating
+            for child in (c for c in node.children if isinstance(c, Node)):
+                if len(child.parents) > 1 or child.hierarchy is not None:
+                    self.boundary.append(child)
+                    continue
+                self.nodes.append(child)
+                parents.append(index)
+                depths.append(depths[index] + 1)
+
+        self.parents = np.array(parents)
+        depths = np.array(depths)
+        self.levels = [np.flatnonzero(depths == depth)
+                       for depth in range(1, depths.max() + 1)]
+        self.local = np.array([node.transform for node in self.nodes], np.float32)
+        self.world = np.empty_like(self.local)
+        self.model, self.dirty, self.version = None, True, 0
+
+        # nodes now view their rows, and are no longer updated one by one
+        for index, node in enumerate(self.nodes):
+            node._transform = self.local[index]
+            node.world_transform = self.world[index]
+            node.hierarchy = self
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def propagate(self, model, local=None, world=None):
+        """ world matrices of every node from local ones, one level at a time,
+            by default from and into our own arrays """
+        local = self.local if local is None else local
+        world = self.world if world is None else world
+        np.matmul(np.asarray(model, np.float32), local[0], out=world[0])
+        for level in self.levels:
+            world[level] = world[self.parents[level]] @ local[level]
+
+    def update(self, model=identity()):
+        """ Recompute every world matrix if a transform or the parent world
+            matrix of the root changed, returns True if it did """
+        if not self.dirty and model is self.model:
+            return False
+        self.propagate(model)
+        self.updated(model)
+        return True
+
+    def updated(self, model):
+        """ world matrices are now those of model and our local matrices """
+        self.model, self.dirty = model, False
+        self.version = next(world_versions)
+        for node in self.boundary:      # parent world matrix changed in place
+            node._world_dirty = True
+        frame_stats['world_updates'] += len(self.nodes)
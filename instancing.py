@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Hardware instancing of static props: every mesh of a subtree is drawn for all
+instance transforms with a single glDraw*Instanced call, the transforms being
+read from a per instance mat4 attribute ('instance_model' in texphong.vert).
+"""
+# Python built-in modules
+import ctypes                       # byte offsets of the instance attributes
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Mesh, Node, frame_stats
+from texture import Textured
+from transform import (identity, bounds_union, bounds_outside, empty_bounds,
+                       transform_bounds)
+
+
+# ------------  instanced vertex array ----------------------------------------
+class InstancedVertexArray:
+    """ Vertex array object reading the vertex buffers of an existing
+        VertexArray, plus a buffer of per instance 4x4 transforms """
+    def __init__(self, shader, vertex_array, transforms):
+        self.glid = GL.glGenVertexArrays(1)
+        GL.glBindVertexArray(self.glid)
+        for loc, buffer, size in vertex_array.layout:
+            GL.glEnableVertexAttribArray(loc)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+            GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
+        if vertex_array.index_buffer is not None:
+            GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, vertex_array.index_buffer)
+
+        # mat4 attribute spans 4 locations, one per column, advanced per instance
+        self.buffer = GL.glGenBuffers(1)
+        self.nb_instances = len(transforms)
+        self.transforms = transforms    # CPU side, e.g. for ray queries
+        columns = np.ascontiguousarray(np.transpose(transforms, (0, 2, 1)),
+                                       np.float32)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffer)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, columns, GL.GL_STATIC_DRAW)
+        loc = GL.glGetAttribLocation(shader.glid, 'instance_model')
+        assert loc >= 0, 'shader has no instance_model attribute'
+        for column in range(4):
+            GL.glEnableVertexAttribArray(loc + column)
+            GL.glVertexAttribPointer(loc + column, 4, GL.GL_FLOAT, False, 64,
+                                     ctypes.c_void_p(16 * column))
+            GL.glVertexAttribDivisor(loc + column, 1)
+        GL.glBindVertexArray(0)
+
+        if vertex_array.index_buffer is not None:
+            count = vertex_array.arguments[0]
+            self.draw_command = GL.glDrawElementsInstanced
+            self.arguments = (count, GL.GL_UNSIGNED_INT, None, self.nb_instances)
+        else:
+            self.draw_command = GL.glDrawArraysInstanced
+            self.arguments = vertex_array.arguments + (self.nb_instances,)
+        self.nb_triangles = vertex_array.nb_triangles * self.nb_instances
+
+    def execute(self, primitive):
+        """ draw all instances at once """
+        GL.glBindVertexArray(self.glid)
+        self.draw_command(primitive, *self.arguments)
+        frame_stats['instances'] += self.nb_instances
+        frame_stats['draw_calls'] += 1
+        frame_stats['triangles'] += self.nb_triangles
+
+    def __del__(self):  # vertex buffers belong to the original vertex array
+        GL.glDeleteVertexArrays(1, [self.glid])
+        GL.glDeleteBuffers(1, [self.buffer])
+
+
+# ------------  instanced node ------------------------------------------------
+def static_meshes(drawables, transform=identity(), textures=None):
+    """ (transform relative to the root, mesh, textures) for every mesh of
+        static subtrees, which must not hold animated nodes, skinned meshes
+        or bones, i.e. nodes other drawables depend on """
+    for drawable in drawables:
+        if isinstance(drawable, Node):
+            if type(drawable).draw is not Node.draw or not drawable.cullable:
+                raise ValueError('%r is not a static node' % drawable)
+            yield from static_meshes(drawable.children,
+                                     transform @ drawable.transform, textures)
+        elif isinstance(drawable, Textured):
+            yield from static_meshes([drawable.drawable], transform,
+                                     {**(textures or {}), **drawable.textures})
+        elif isinstance(drawable, Mesh) and type(drawable).draw is Mesh.draw:
+            yield transform, drawable, textures
+        else:
+            raise ValueError('cannot instance %r' % drawable)
+
+
+class InstancedNode(Node):
+    """ Draws copies of static subtrees, one per transform of an (N, 4, 4)
+        array, with one instanced draw call per mesh instead of one per copy
+        and mesh. Meshes keep their own uniforms and textures """
+    def __init__(self, children, transforms, transform=identity()):
+        super().__init__(transform=transform)
+        transforms = np.asarray(transforms, np.float32).reshape(-1, 4, 4)
+        self.nb_instances = len(transforms)
+        # source subtrees, kept as live instances of their models so that
+        # the model cache does not evict the textures the batches bind
+        self.sources = list(children)
+        self.batches = []           # (mesh, textures, instanced vertex array)
+        boxes = []
+        for local, mesh, textures in static_meshes(children):
+            instances = transforms @ local
+            self.batches.append((mesh, textures, InstancedVertexArray(
+                mesh.shader, mesh.vertex_array, instances)))
+            if mesh.bounds is None:
+                boxes = None
+            elif boxes is not None:
+                boxes.extend(transform_bounds(mesh.bounds, instance)
+                             for instance in instances)
+        self.instance_bounds = (None if boxes is None else
+                                bounds_union(empty_bounds(), *boxes))
+
+    @property
+    def bounds(self):
+        """ bounding box of all instances, in this node's frame """
+        return self.instance_bounds
+
+    def draw(self, model=identity(), frustum=None, primitives=GL.GL_TRIANGLES,
+             render_queue=None, **uniforms):
+        """ draw all instances of every mesh, unless culled as a whole """
+        self.update_world_transform(model)
+        if frustum is not None and self.bounds is not None:
+            if bounds_outside(self.update_world_bounds(), frustum):
+                frame_stats['culled'] += 1
+                return
+        uniforms.update(model=self.world_transform, instanced=1)
+        for mesh, textures, vertex_array in self.batches:
+            def execute(primitives, shader=mesh.shader, array=vertex_array):
+                array.execute(primitives)
+                shader.set_uniforms(dict(instanced=0))  # back to plain meshes
+            if render_queue is not None:
+                render_queue.submit(mesh.shader, vertex_array, primitives,
+                                    dict(uniforms), mesh.uniforms, textures,
+                                    command=execute)
+                continue
+            mesh.shader.use()
+            for index, (name, texture) in enumerate((textures or {}).items()):
+                GL.glActiveTexture(GL.GL_TEXTURE0 + index)
+                GL.glBindTexture(texture.type, texture.glid)
+                uniforms[name] = index
+            frame_stats['texture_binds'] += len(textures or {})
+            mesh.shader.set_uniforms(uniforms, mesh.uniforms)
+            execute(primitives)
+            frame_stats['drawn'] += 1
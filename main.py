@@ -1,25 +1,27 @@
 import random
+import sys
 import numpy as np
 from core import Shader, Node
 from ground import Ground
-from scene_constructor import construct_boat, construct_flagship, construct_galleon, construct_golem, construct_musketeer_onboat, construct_random_tree, construct_rocks, construct_seagulls_and_animation, construct_seagulls_formation, construct_ship_animation
+from scene_constructor import GROUND_HMAP, GROUND_TEXMAP, prefetch_scene_assets, construct_boat, construct_flagship, construct_galleon, construct_golem, construct_musketeer_onboat, construct_random_tree, construct_rocks, construct_seagulls_and_animation, construct_seagulls_formation, construct_ship_animation
+from texture import texture_registry
 from transform import translate
 from viewer import Viewer
 
 # -------------- main program and scene setup --------------------------------
-def main():
-    """ create a window, add scene objects, then run rendering loop """
-    viewer = Viewer(width=1600, height=900)
+GLOBAL_LIGHT = np.array((0.6, -0.8, 0.1))
 
-    global_light = np.array((0.6, -0.8, 0.1))
 
+def build_scene(viewer, global_light=GLOBAL_LIGHT):
+    """ add the scene objects to the viewer. Placements of the trees, rocks
+        and seagulls come from the random module """
     texphong_shader = Shader("shaders/texphong.vert", "shaders/texphong.frag")
     ground_shader = Shader("shaders/ground.vert", "shaders/ground.frag")
     skinning_shader = Shader("shaders/skinning.vert", "shaders/skinning.frag")
 
     # Add the ground to the scene. It has 3 textures and terrains with different height.
     base = Node(transform=translate(-128, 0, -128))
-    base.add(Ground(ground_shader, "mappings/ground_texmap_256.png", "mappings/ground_hmap_256.png", 256, light=global_light))
+    base.add(Ground(ground_shader, GROUND_TEXMAP, GROUND_HMAP, 256, light=global_light))
 
     # Add the a boat to the scene. It has an animation corresponding to the tide of water.
     boat = construct_boat(shader=texphong_shader, light_dir=global_light)
@@ -48,12 +50,12 @@ def main():
     
     # Add the trees on the grass terrain into the scene.
     # The position of the tree depends on the height of the terrain.
-    tree = construct_random_tree(shader=texphong_shader, light_dir=global_light, hmap_file="mappings/ground_hmap_256.png")
+    tree = construct_random_tree(shader=texphong_shader, light_dir=global_light, hmap_file=GROUND_HMAP)
 
     # Add rocks on the beach
     rock = construct_rocks(shader=texphong_shader, light_dir=global_light)
     
-    viewer.constructMuskOnBeach(shader=skinning_shader, light_dir=global_light, hmap_file="mappings/ground_hmap_256.png")
+    viewer.constructMuskOnBeach(shader=skinning_shader, light_dir=global_light, hmap_file=GROUND_HMAP)
 
     # KeyFrameControlNode(self.translateKeys, self.rotateKeys, self.scaleKeys)
 
@@ -63,6 +65,20 @@ def main():
     base.add(tree)
     base.add(rock)
     viewer.add(base) 
+    texture_registry.report()
+
+
+def main():
+    """ create a window, add scene objects, then run rendering loop """
+    # parse models and decode images in the background, GL uploads stay here
+    prefetch_scene_assets()
+    # --pipelined: animations update on a worker thread, a frame ahead
+    # --profile[=trace.json or .csv]: frame timings, optionally traced to file
+    profile = next((arg.partition('=')[2] for arg in sys.argv
+                    if arg.startswith('--profile')), None)
+    viewer = Viewer(width=1600, height=900, light_dir=GLOBAL_LIGHT,
+                    pipelined='--pipelined' in sys.argv, profile=profile)
+    build_scene(viewer)
 
     # start rendering loop
     message = """
@@ -1,11 +1,13 @@
 import numpy as np
 
-from PIL import Image
-from scene_constructor import get_height
+from scene_constructor import get_height, ANIMATION_BAKE_RATE, MUSKETEER_CLIPS, MUSKETEER_TEXTURE
 from core import load, Node
+from animation import Animator
 from transform import  translate, rotate, scale, identity
 import glfw                         # lean window system wrapper for OpenGL
 
+MUSKETEER_FADE = 0.2    # seconds of cross-fade between clips
+
 class MusketeerOnBeach(Node):
     def __init__(self, shader, light_dir, hmap_file):
         super().__init__(transform=translate(0, 0, 0))
@@ -16,45 +18,20 @@ class MusketeerOnBeach(Node):
         self.musk_angle = 0.0
         self.hmap_file = hmap_file
         self.musketeer_mode = 'idle'
-        musketeer_idleNodes=load(file="./models/Musketeer/Musketeer_idle.fbx",
-                                      shader=shader, 
-                                      tex_file="./models/Musketeer/texture/texture.png",
-                                      light_dir=light_dir,
-                                      k_a = np.array((0.3, 0.3, 0.3)),
-                                      k_d = np.array((0.6, 0.6, 0.6)),
-                                      k_s = np.array((0.2, 0.2, 0.2)),
-                                      s=32)
-        musketeer_runNodes=load(file="./models/Musketeer/Musketeer_run.fbx",
-                                      shader=shader, 
-                                      tex_file="./models/Musketeer/texture/texture.png",
-                                      light_dir=light_dir,
-                                      k_a = np.array((0.3, 0.3, 0.3)),
-                                      k_d = np.array((0.6, 0.6, 0.6)),
-                                      k_s = np.array((0.2, 0.2, 0.2)),
-                                      s=32)
-        musketeer_jumpNodes=load(file="./models/Musketeer/Musketeer_jump.fbx",
-                                      shader=shader, 
-                                      tex_file="./models/Musketeer/texture/texture.png",
-                                      light_dir=light_dir,
-                                      k_a = np.array((0.3, 0.3, 0.3)),
-                                      k_d = np.array((0.6, 0.6, 0.6)),
-                                      k_s = np.array((0.2, 0.2, 0.2)),
-                                      s=32)
-        musketeer_victoryNodes=load(file="./models/Musketeer/Musketeer_victory.fbx",
+        # one mesh & skeleton, the clips of the other files play on it
+        musketeerNodes=load(file=MUSKETEER_CLIPS['idle'],
                                       shader=shader, 
-                                      tex_file="./models/Musketeer/texture/texture.png",
+                                      tex_file=MUSKETEER_TEXTURE,
                                       light_dir=light_dir,
                                       k_a = np.array((0.3, 0.3, 0.3)),
                                       k_d = np.array((0.6, 0.6, 0.6)),
                                       k_s = np.array((0.2, 0.2, 0.2)),
-                                      s=32)
-        self.musketeerIdleNode = Node(children=musketeer_idleNodes, transform=translate(12, 0, 12) @ scale(0.25, 0.25, 0.25))
-        self.musketeerRunNode = Node(children=musketeer_runNodes, transform=translate(12, 0, 12) @ scale(0.25, 0.25, 0.25))
-        self.musketeerJumpNode = Node(children=musketeer_jumpNodes, transform=translate(12, 0, 12) @ scale(0.25, 0.25, 0.25))
-        self.musketeerVicNode = Node(children=musketeer_victoryNodes, transform=translate(12, 0, 12) @ scale(0.25, 0.25, 0.25))
+                                      s=32, bake_rate=ANIMATION_BAKE_RATE,
+                                      clips=MUSKETEER_CLIPS)
+        self.animators = [node for node in musketeerNodes if isinstance(node, Animator)]
+        self.musketeerNode = Node(children=musketeerNodes, transform=translate(12, 0, 12) @ scale(0.25, 0.25, 0.25))
 
-        self.add(self.musketeerIdleNode)
-        self.add(self.musketeerRunNode)
+        self.add(self.musketeerNode)
 
     def musketeer_reset(self):
         self.musketeer_mode = 'idle'
@@ -100,28 +77,19 @@ class MusketeerOnBeach(Node):
 
         yPos = self.get_relative_height(128+self.xOffset, 128+self.zOffset)
 
-        self.musketeerIdleNode.transform=translate(self.xOffset, yPos, self.zOffset) @ rotate((0.0, 1.0, 0.0), self.musk_angle) @ scale(0.25, 0.25, 0.25)
-        self.musketeerRunNode.transform=translate(self.xOffset, yPos, self.zOffset) @ rotate((0.0, 1.0, 0.0), self.musk_angle) @ scale(0.25, 0.25, 0.25)
-        self.musketeerJumpNode.transform=translate(self.xOffset, yPos, self.zOffset) @ rotate((0.0, 1.0, 0.0), self.musk_angle) @ scale(0.25, 0.25, 0.25)
-        self.musketeerVicNode.transform=translate(self.xOffset, yPos, self.zOffset) @ rotate((0.0, 1.0, 0.0), self.musk_angle) @ scale(0.25, 0.25, 0.25)
+        self.musketeerNode.transform=translate(self.xOffset, yPos, self.zOffset) @ rotate((0.0, 1.0, 0.0), self.musk_angle) @ scale(0.25, 0.25, 0.25)
 
     def draw(self, model=identity(), **other_uniforms):
         """ Recursive draw, passing down updated model matrix. """
-        self.world_transform = model @ self.transform
-        if self.musketeer_mode == 'idle':
-            self.musketeerIdleNode.draw(**other_uniforms)
-        elif self.musketeer_mode == 'run':
-            self.musketeerRunNode.draw(**other_uniforms)
-        elif self.musketeer_mode == 'jump':
-            self.musketeerJumpNode.draw(**other_uniforms)
-        elif self.musketeer_mode == 'victory':
-            self.musketeerVicNode.draw(**other_uniforms)
+        self.update_world_transform(model)
+        for animator in self.animators:     # same clip again changes nothing
+            if self.musketeer_mode in animator.tracks:
+                animator.play(self.musketeer_mode, fade=MUSKETEER_FADE)
+        self.musketeerNode.draw(**other_uniforms)
 
     def get_relative_height(self, x, z):
-        # Get the height from the input heightmap
-        hmap = np.asarray(Image.open(self.hmap_file).convert('RGB'))
-        height = get_height(hmap, x, z)
-        print("x = ", x, "; z = ", z)
+        # Get the height from the shared heightfield of the input heightmap
+        height = get_height(self.hmap_file, x, z)
         if(z < 128): 
             in_water_height = 0.5 * (128 - z)
             if in_water_height > 5 : in_water_height = 5
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Pipelined scene update: the animation of frame N+1 (keyframe evaluation,
+skeleton poses, world matrices and bone palettes) runs on a worker thread
+while the main thread submits frame N. Updaters compute into back buffers,
+published between frames, so that draws never see a half updated frame.
+"""
+# Python built-in modules
+import time                         # update thread timing
+from concurrent.futures import ThreadPoolExecutor
+
+from animation import KeyFrameControlNode
+from core import Node
+
+
+class UpdatePipeline:
+    """ Calls update(time) of its updaters on a worker thread, and their
+        swap() on the main thread once that update is done. Frames are drawn
+        one update late: frame(time) publishes the update started by the
+        previous call, starts the one of time, and returns the time of the
+        published frame, at which the rest of the scene should be drawn """
+    def __init__(self, updaters=()):
+        self.updaters = []
+        self.worker = ThreadPoolExecutor(max_workers=1,
+                                         thread_name_prefix='update')
+        self.job, self.time = None, None
+        self.update_seconds = 0.0       # worker time of the last update
+        self.add(*updaters)
+
+    def add(self, *updaters):
+        """ updaters no longer update themselves while drawn """
+        for updater in updaters:
+            updater.pipelined = True
+            self.updaters.append(updater)
+
+    def collect(self, node):
+        """ add the animated nodes of a scene graph, returns their number """
+        found, seen, stack = [], set(), [node]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            if isinstance(node, KeyFrameControlNode):
+                found.append(node)
+            stack.extend(child for child in node.children
+                         if isinstance(child, Node))
+        self.add(*found)
+        return len(found)
+
+    def _update(self, frame_time):
+        start = time.perf_counter()
+        for updater in self.updaters:
+            updater.update(frame_time)
+        self.update_seconds = time.perf_counter() - start
+
+    def frame(self, frame_time):
+        """ publish the last update and start the next one, see class doc """
+        if self.job is None:        # first frame: nothing in flight yet
+            self._update(frame_time)
+            self.time = frame_time
+        else:
+            self.job.result()       # re-raises exceptions of the worker
+        for updater in self.updaters:
+            updater.swap()
+        published, self.time = self.time, frame_time
+        self.job = self.worker.submit(self._update, frame_time)
+        return published
+
+    def shutdown(self):
+        """ wait for the update in flight, then stop the worker """
+        self.worker.shutdown(wait=True)
+        self.job = None
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Frame profiler: wall clock time of named CPU scopes, GPU time of render
+passes measured by GL_TIME_ELAPSED queries, read back a few frames late so
+that the CPU never waits for the GPU, and the frame_stats counters of each
+frame. Gives a rolling summary, and writes a CSV or JSON trace of all frames.
+"""
+# Python built-in modules
+import csv                          # per frame trace, one row per frame
+import ctypes                       # 64 bit query results
+import json                         # per frame trace, with a summary
+import time                         # wall clock timing
+from collections import deque       # rolling window of recent frames
+from contextlib import contextmanager
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import frame_stats
+
+# counters of the summary, after the frame_stats key they are read from
+SUMMARY_COUNTERS = dict(draws='draw_calls', tris='triangles',
+                        programs='program_binds', textures='texture_binds',
+                        uniforms='uniform_uploads')
+
+
+class Profiler:
+    """ Collects one record per frame, between begin_frame() and end_frame():
+        'frame_ms', 'cpu_<scope>_ms' and 'gpu_<pass>_ms' times, and the
+        frame_stats counters. GPU times come in latency frames later or more,
+        a frame is complete once all its queries are. Up to max_pending
+        frames wait for their queries, older ones lose their GPU times """
+    def __init__(self, trace_file=None, window=120, latency=3, max_pending=8,
+                 gpu=True):
+        self.trace_file, self.latency = trace_file, latency
+        self.max_pending, self.gpu = max_pending, gpu
+        self.recent = deque(maxlen=window)  # last frames, all if window None
+        self.trace = []                     # every complete record, for trace
+        self.pending = deque()              # (record, [(pass, query)]) by age
+        self.record, self.queries = None, []
+        self.free_queries = []              # query objects ready for reuse
+        self.stale_queries = []             # of dropped frames, still running
+        self.frame_start, self.frame_count = None, 0
+        self.available = np.zeros(1, np.int32)  # query readback buffers
+        self.elapsed = ctypes.c_uint64()        # ns, no numpy uint64 in GL
+
+    # -------------- per frame --------------------------------------------------
+    def begin_frame(self):
+        """ start a frame record, resetting the frame_stats counters """
+        frame_stats.clear()
+        self.frame_start = time.perf_counter()
+        self.record, self.queries = dict(frame=self.frame_count), []
+        self.frame_count += 1
+
+    def end_frame(self):
+        """ close the frame record, and complete those of older frames whose
+            GPU queries are done, without waiting for the others """
+        record = self.record
+        record['frame_ms'] = 1000 * (time.perf_counter() - self.frame_start)
+        stats = frame_stats
+        stats['uniform_uploads'] = (stats['uniforms_set']
+                                    + stats['uniform_buffer_updates'])
+        record.update(stats)
+        self.pending.append((record, self.queries))
+        self.record, self.queries = None, []
+        self.collect()
+
+    def collect(self, wait=False):
+        """ complete pending frames, oldest first, whose queries are done.
+            Queries finish in order, so a frame is done when its last one is """
+        while self.stale_queries:       # reused once their result is in
+            GL.glGetQueryObjectiv(self.stale_queries[0],
+                                  GL.GL_QUERY_RESULT_AVAILABLE, self.available)
+            if not self.available[0]:
+                break
+            self.free_queries.append(self.stale_queries.pop(0))
+        while self.pending:
+            record, queries = self.pending[0]
+            age = self.frame_count - record['frame']
+            if queries and not wait:
+                if age <= self.latency and len(self.pending) <= self.max_pending:
+                    break
+                GL.glGetQueryObjectiv(queries[-1][1], GL.GL_QUERY_RESULT_AVAILABLE,
+                                      self.available)
+                if not self.available[0] and len(self.pending) <= self.max_pending:
+                    break
+                if not self.available[0]:   # too late, dropped
+                    record.update(('gpu_%s_ms' % name, None) for name, _ in queries)
+                    self.stale_queries.extend(query for _, query in queries)
+                    queries = []
+            for name, query in queries:
+                GL.glGetQueryObjectui64v(query, GL.GL_QUERY_RESULT, self.elapsed)
+                key = 'gpu_%s_ms' % name
+                record[key] = record.get(key, 0) + self.elapsed.value / 1e6
+            self.free_queries.extend(query for _, query in queries)
+            self.pending.popleft()
+            self.recent.append(record)
+            if self.trace_file:
+                self.trace.append(record)
+
+    # -------------- scopes -----------------------------------------------------
+    @contextmanager
+    def scope(self, name):
+        """ time the CPU work of a with block as 'cpu_<name>_ms', summed
+            over the blocks of the same name in the frame """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.record is not None:
+                key = 'cpu_%s_ms' % name
+                seconds = time.perf_counter() - start
+                self.record[key] = self.record.get(key, 0) + 1000 * seconds
+
+    @contextmanager
+    def gpu_pass(self, name):
+        """ time the GPU work of the GL commands issued in a with block, as
+            'gpu_<name>_ms'. Time elapsed queries cannot nest """
+        if not self.gpu or self.record is None:
+            yield
+            return
+        query = (self.free_queries.pop() if self.free_queries else
+                 int(np.ravel(GL.glGenQueries(1))[0]))
+        GL.glBeginQuery(GL.GL_TIME_ELAPSED, query)
+        try:
+            yield
+        finally:
+            GL.glEndQuery(GL.GL_TIME_ELAPSED)
+            self.queries.append((name, query))
+
+    # -------------- reports ----------------------------------------------------
+    def averages(self):
+        """ mean of each time and counter over the recent frames """
+        totals, counts = {}, {}
+        for record in self.recent:
+            for key, value in record.items():
+                if key != 'frame' and value is not None:
+                    totals[key] = totals.get(key, 0) + value
+                    counts[key] = counts.get(key, 0) + 1
+        return {key: totals[key] / counts[key] for key in totals}
+
+    def summary(self):
+        """ one line of recent averages: frame, CPU scopes, GPU passes and
+            main counters """
+        means = self.averages()
+        if not means:
+            return 'no frame profiled yet'
+        frame_ms = means.get('frame_ms', 0)
+        parts = ['%.2f ms (%.0f fps)' % (frame_ms, 1000 / frame_ms if frame_ms else 0)]
+        for kind in ('cpu', 'gpu'):
+            times = ['%s %.2f' % (key[len(kind) + 1:-3], value)
+                     for key, value in means.items()
+                     if key.startswith(kind + '_') and key.endswith('_ms')]
+            if times:
+                parts.append(kind + ' ' + ' '.join(times))
+        parts.append(' '.join('%d %s' % (means.get(key, 0), label)
+                              for label, key in SUMMARY_COUNTERS.items()))
+        return ' | '.join(parts)
+
+    def close(self):
+        """ complete the pending frames, waiting for their queries, write the
+            trace file if any and free the query objects """
+        self.collect(wait=True)
+        if self.trace_file:
+            self.write_trace(self.trace_file)
+        queries = self.free_queries + self.stale_queries
+        if queries:
+            GL.glDeleteQueries(len(queries), queries)
+            self.free_queries, self.stale_queries = [], []
+
+    def write_trace(self, file):
+        """ all complete frame records, as CSV rows if file ends with .csv,
+            else as JSON with the averages of the last frames """
+        if file.endswith('.csv'):
+            fields = list(dict.fromkeys(key for record in self.trace
+                                        for key in record))
+            with open(file, 'w', newline='') as output:
+                writer = csv.DictWriter(output, fields)
+                writer.writeheader()
+                writer.writerows(self.trace)
+        else:
+            with open(file, 'w') as output:
+                json.dump(dict(frames=self.trace, recent=self.averages()),
+                          output, indent=1)
+        print('Profile trace of %d frames written to %s' % (len(self.trace), file))
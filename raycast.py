@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Ray queries against the terrain and the meshes of the scene, for whole
+batches of rays given as (N, 3) origin and direction arrays. Terrain rays
+descend a min-max height pyramid, skipping the cells they pass above, mesh
+rays descend per mesh triangle BVHs. Hits are ray parameters t, inf when
+missed: hit positions are origins + t * directions.
+"""
+# Python built-in modules
+import weakref                      # BVHs live as long as their vertex array
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Mesh, Node
+from instancing import InstancedNode
+from texture import Textured
+from transform import identity
+
+RAY_CHUNK = 65536        # rays traversed together, bounds temporary arrays
+
+
+# -------------- ray primitives --------------------------------------------------
+def inverse_directions(directions):
+    """ 1 / directions, zero components replaced by tiny ones, for slabs """
+    directions = np.asarray(directions, np.float64)
+    tiny = np.where(directions < 0, -1e-30, 1e-30)
+    return 1 / np.where(np.abs(directions) < 1e-30, tiny, directions)
+
+
+def ray_boxes(origins, inverse, box_min, box_max):
+    """ ray parameters where rays enter and leave boxes, pairwise: entry is
+        clamped to 0, the box is missed if entry > exit """
+    t0, t1 = (box_min - origins) * inverse, (box_max - origins) * inverse
+    entry = np.maximum(np.minimum(t0, t1).max(axis=-1), 0)
+    return entry, np.maximum(t0, t1).min(axis=-1)
+
+
+def ray_triangles(origins, directions, a, b, c):
+    """ ray parameters of pairwise ray / triangle hits, both faces, inf if
+        missed (Moller-Trumbore) """
+    edge1, edge2 = b - a, c - a
+    p = np.cross(directions, edge2)
+    det = np.einsum('ij,ij->i', edge1, p)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = 1 / det
+        s = origins - a
+        u = np.einsum('ij,ij->i', s, p) * inverse
+        q = np.cross(s, edge1)
+        v = np.einsum('ij,ij->i', directions, q) * inverse
+        t = np.einsum('ij,ij->i', edge2, q) * inverse
+        hit = (np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return np.where(hit, t, np.inf)
+
+
+def chunked(raycast, origins, directions, max_t=np.inf):
+    """ t of raycast(origins, directions, best) over chunks of RAY_CHUNK rays,
+        best being the ray parameters to beat, updated in place. max_t is a
+        scalar or one value per ray """
+    origins = np.asarray(origins, np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, np.float64).reshape(-1, 3)
+    best = np.full(len(origins), max_t, np.float64)
+    for start in range(0, len(origins), RAY_CHUNK):
+        chunk = slice(start, start + RAY_CHUNK)
+        raycast(origins[chunk], directions[chunk], best[chunk])
+    return np.where(best < max_t, best, np.inf)
+
+
+# -------------- terrain ---------------------------------------------------------
+class HeightPyramid:
+    """ Min-max mip pyramid of a Heightfield: level 0 holds the height range
+        of each grid cell, each next level that of 2x2 cells of the previous
+        one. Rays only descend into cells whose height range they cross, and
+        end on the two triangles of a cell, as in the terrain mesh """
+    def __init__(self, heightfield):
+        self.heights = np.asarray(heightfield.heights, np.float32)
+        self.size_x, self.size_z = self.heights.shape
+        h = self.heights
+        corners = np.stack((h[:-1, :-1], h[1:, :-1], h[:-1, 1:], h[1:, 1:]))
+        low, high = corners.min(axis=0), corners.max(axis=0)
+        self.levels = [(low, high)]
+        while max(low.shape) > 1:
+            pad = [(0, low.shape[0] % 2), (0, low.shape[1] % 2)]
+            low, high = (np.pad(array, pad, mode='edge') for array in (low, high))
+            shape = (low.shape[0] // 2, 2, low.shape[1] // 2, 2)
+            low = low.reshape(shape).min(axis=(1, 3))
+            high = high.reshape(shape).max(axis=(1, 3))
+            self.levels.append((low, high))
+
+        # every level in one flat array, for lookups at mixed levels
+        self.shapes = np.array([low.shape for low, _ in self.levels])
+        self.offsets = np.cumsum([0, *self.shapes.prod(axis=1)[:-1]])
+        self.low = np.concatenate([low.ravel() for low, _ in self.levels])
+        self.high = np.concatenate([high.ravel() for _, high in self.levels])
+
+    def raycast(self, origins, directions, max_t=np.inf):
+        """ ray parameters of the first terrain hits, in heightfield space """
+        return chunked(self.traverse, origins, directions, max_t)
+
+    def traverse(self, origins, directions, best):
+        """ lower best to the terrain hits of rays, all rays marching front to
+            back in lockstep: a ray above the height range of its cell skips
+            to the cell exit and moves up a level, else it moves down a level,
+            down to the two triangles of a grid cell, as in the terrain mesh """
+        inverse = inverse_directions(directions)
+        top = len(self.levels) - 1
+        pad = 1e-6      # keeps rays along the map edges inside
+        t, end = ray_boxes(origins, inverse, [-pad, self.low.min(), -pad],
+                           [self.size_x - 1 + pad, self.high.max(),
+                            self.size_z - 1 + pad])
+        rays = np.flatnonzero((t <= end) & (t < best))
+        t, end = t[rays], np.minimum(end[rays], best[rays])
+        level = np.full(len(rays), top)
+        step = np.sign(inverse[:, [0, 2]]) * 1e-6       # into the next cell
+        heights = self.heights
+        while len(rays):
+            o, d, size = origins[rays], directions[rays], 1 << level
+            cells = np.floor((o[:, [0, 2]] + t[:, None] * d[:, [0, 2]]
+                              + step[rays]) / size[:, None]).astype(np.intp)
+            exits = np.empty(len(rays))
+            for axis in (0, 1):
+                cells[:, axis] = np.maximum(cells[:, axis], 0)
+                slope = inverse[rays, 2 * axis]
+                bound = (cells[:, axis] + (slope > 0)) * size
+                crossing = (bound - o[:, 2 * axis]) * slope
+                exits = crossing if axis == 0 else np.minimum(exits, crossing)
+            exits = np.maximum(exits, t)
+            y_range = o[:, 1, None] + np.stack((t, exits), -1) * d[:, 1, None]
+            shape = self.shapes[level]
+            cells = np.minimum(cells, shape - 1)
+            flat = self.offsets[level] + cells[:, 0] * shape[:, 1] + cells[:, 1]
+            low, high = self.low[flat], self.high[flat]
+            skip = (y_range.min(axis=1) > high) | (y_range.max(axis=1) < low)
+
+            # grid cells that may hold a hit: test their two triangles
+            test = np.flatnonzero(~skip & (level == 0))
+            x, z = cells[test, 0], cells[test, 1]
+
+            def corner(dx, dz):
+                return np.stack((x + dx, heights[x + dx, z + dz], z + dz), axis=-1)
+            c00, c01, c10, c11 = corner(0, 0), corner(0, 1), corner(1, 0), corner(1, 1)
+            hit = np.minimum(ray_triangles(o[test], d[test], c00, c01, c10),
+                             ray_triangles(o[test], d[test], c10, c01, c11))
+            found = np.isfinite(hit)
+            best[rays[test[found]]] = np.minimum(best[rays[test[found]]], hit[found])
+
+            # advance past skipped & missed cells, descend into the others
+            done = np.zeros(len(rays), bool)
+            done[test[found]] = True
+            # rays that cannot advance have left the map
+            advance = skip | (level == 0)
+            done |= advance & ((exits >= end) | (exits <= t))
+            t = np.where(advance, exits, t)
+            level = np.where(advance, np.minimum(level + 1, top), level - 1)
+            rays, t, end, level = rays[~done], t[~done], end[~done], level[~done]
+
+
+# -------------- meshes ----------------------------------------------------------
+class TriangleBVH:
+    """ Bounding volume hierarchy of the triangles of a mesh, in flat arrays:
+        node boxes, and per node either the index of its first child (the
+        second follows it), or its range of triangles, stored in tree order """
+    LEAF_SIZE = 8
+    BOX_PADDING = 1e-6
+
+    def __init__(self, positions, index=None):
+        positions = np.asarray(positions, np.float64)
+        index = (np.arange(len(positions)) if index is None else
+                 np.asarray(index, np.intp)).reshape(-1, 3)
+        triangles = positions[index]
+        centroids = triangles.mean(axis=1)
+        order = np.arange(len(triangles))
+        box_min, box_max, first, count, axes = [], [], [], [], []
+        pending = [(0, len(triangles))]     # (start, stop) in order, per node
+        for start, stop in pending:         # grows while iterating
+            span = triangles[order[start:stop]].reshape(-1, 3)
+            box_min.append(span.min(axis=0))
+            box_max.append(span.max(axis=0))
+            if stop - start <= self.LEAF_SIZE:
+                first.append(start)
+                count.append(stop - start)
+                axes.append(0)
+                continue
+            # median split along the longest axis of the centroids
+            points = centroids[order[start:stop]]
+            axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+            middle = (stop - start) // 2
+            split = np.argpartition(points[:, axis], middle)
+            order[start:stop] = order[start:stop][split]
+            first.append(len(pending))
+            count.append(0)
+            axes.append(axis)
+            pending += [(start, start + middle), (start + middle, stop)]
+
+        # padded, as the terrain box: a ray lying in a box face, with a zero
+        # direction component, would otherwise leave the box at t = 0
+        self.box_min = np.array(box_min) - self.BOX_PADDING
+        self.box_max = np.array(box_max) + self.BOX_PADDING
+        self.first, self.count = np.array(first), np.array(count)
+        self.axes = np.array(axes)
+        self.depth = int(np.ceil(np.log2(max(len(triangles), 1)))) + 2
+        self.triangles = triangles[order]
+
+    def raycast(self, origins, directions, max_t=np.inf):
+        """ ray parameters of the first triangle hits, in mesh space """
+        return chunked(self.traverse, origins, directions, max_t)
+
+    def traverse(self, origins, directions, best):
+        """ lower best to the triangle hits of rays, all rays walking the tree
+            depth first in lockstep, near child first, and skipping nodes
+            entered after the nearest hit found so far """
+        inverse = inverse_directions(directions)
+        stacks = np.zeros((len(origins), self.depth), np.intp)  # root first
+        heights = np.ones(len(origins), np.intp)
+        rays = np.arange(len(origins))
+        slots = np.arange(self.LEAF_SIZE)
+        while len(rays):
+            heights[rays] -= 1
+            nodes = stacks[rays, heights[rays]]
+            entry, exit = ray_boxes(origins[rays], inverse[rays],
+                                    self.box_min[nodes], self.box_max[nodes])
+            enter = (entry <= exit) & (entry < best[rays])
+            rays, nodes = rays[enter], nodes[enter]
+            leaf = self.count[nodes] > 0
+
+            # all triangles of reached leaves, one (ray, triangle) pair each
+            valid = slots < self.count[nodes[leaf], None]
+            pairs = np.repeat(rays[leaf], valid.sum(axis=1))
+            triangles = self.triangles[(self.first[nodes[leaf], None] + slots)[valid]]
+            t = ray_triangles(origins[pairs], directions[pairs], triangles[:, 0],
+                              triangles[:, 1], triangles[:, 2])
+            np.minimum.at(best, pairs, t)
+
+            # push both children of inner nodes, the one nearer the ray on top
+            inner, nodes = rays[~leaf], nodes[~leaf]
+            forward = directions[inner, self.axes[nodes]] >= 0
+            children = self.first[nodes]
+            stacks[inner, heights[inner]] = children + forward
+            stacks[inner, heights[inner] + 1] = children + ~forward
+            heights[inner] += 2
+            rays = np.flatnonzero(heights > 0)
+
+
+# BVH of each vertex array, built on first query and shared by its meshes
+mesh_bvhs = weakref.WeakKeyDictionary()
+
+
+def mesh_bvh(mesh):
+    """ TriangleBVH of a mesh's vertex array """
+    vertex_array = mesh.vertex_array
+    if vertex_array not in mesh_bvhs:
+        mesh_bvhs[vertex_array] = TriangleBVH(vertex_array.attributes['position'],
+                                              vertex_array.index)
+    return mesh_bvhs[vertex_array]
+
+
+# -------------- scene -----------------------------------------------------------
+def scene_meshes(drawable, model=identity()):
+    """ (world matrix, mesh) of the rigid meshes below a drawable, instances
+        included, from the current node transforms. Skinned meshes, whose
+        vertices follow bones, and custom drawables are skipped """
+    if isinstance(drawable, InstancedNode):
+        world = model @ drawable.transform
+        for mesh, _, vertex_array in drawable.batches:
+            for instance in vertex_array.transforms:
+                yield world @ instance, mesh
+    elif isinstance(drawable, Node):
+        world = model @ drawable.transform
+        for child in drawable.children:
+            yield from scene_meshes(child, world)
+    elif isinstance(drawable, Textured):
+        yield from scene_meshes(drawable.drawable, model)
+    elif (isinstance(drawable, Mesh)
+          and 'position' in getattr(drawable.vertex_array, 'attributes', ())):
+        yield model, drawable
+
+
+class SceneRaycaster:
+    """ Ray queries in world space against a terrain heightfield, placed by
+        terrain_transform, and the rigid meshes below a scene graph node.
+        Mesh placements are read again by refresh(), e.g. once per frame """
+    def __init__(self, root=None, heightfield=None, terrain_transform=identity()):
+        self.root = root
+        self.terrain = None if heightfield is None else HeightPyramid(heightfield)
+        self.terrain_transform = np.asarray(terrain_transform, np.float64)
+        self.targets = []
+        self.refresh()
+
+    def refresh(self):
+        """ read the current world matrices of the meshes below root """
+        self.targets = [] if self.root is None else [
+            (np.asarray(world, np.float64), mesh)
+            for world, mesh in scene_meshes(self.root)]
+
+    @staticmethod
+    def local_rays(world, origins, directions):
+        """ rays in the frame of world matrix, with the same ray parameters """
+        inverse = np.linalg.inv(world)
+        return (origins @ inverse[:3, :3].T + inverse[:3, 3],
+                directions @ inverse[:3, :3].T)
+
+    def raycast(self, origins, directions, max_t=np.inf):
+        """ first hits of rays: ray parameters t (inf if missed), and what
+            they hit per ray, the Mesh, the terrain HeightPyramid or None """
+        origins = np.asarray(origins, np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, np.float64).reshape(-1, 3)
+        best = np.full(len(origins), max_t, np.float64)
+        hits = np.full(len(origins), None, dtype=object)
+        targets = [(world, mesh_bvh(mesh), mesh) for world, mesh in self.targets]
+        if self.terrain is not None:
+            targets.append((self.terrain_transform, self.terrain, self.terrain))
+        for world, accelerator, target in targets:
+            local = self.local_rays(world, origins, directions)
+            t = accelerator.raycast(*local, max_t=best)
+            closer = t < best
+            best[closer], hits[closer] = t[closer], target
+        return np.where(best < max_t, best, np.inf), hits
+
+    def visible(self, starts, ends):
+        """ True for segments from starts to ends that nothing blocks, e.g.
+            the line of sight between two characters """
+        starts = np.asarray(starts, np.float64).reshape(-1, 3)
+        t, _ = self.raycast(starts, np.asarray(ends, np.float64) - starts,
+                            max_t=1.0)
+        return np.isinf(t)
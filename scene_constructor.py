@@ -5,92 +5,139 @@ import numpy as np                 # all matrix manipulations & OpenGL args
 import math
 from animation import KeyFrameControlNode
 
-from core import load, Node
+from asset_loader import asset_loader
+from batching import bake_static
+from core import load, Node, prefetch_scene
+from ground import TERRAIN_TEXTURES
+from heightfield import load_heightfield
+from instancing import InstancedNode
+from texture import prefetch_image
 from transform import vec, translate, rotate, scale, quaternion, quaternion_from_euler
-from PIL import Image
 
 
+# Model and image files of the scene, used by the constructors & the prefetch
+BOAT_MODEL = "./models/ship1/pirate_baot.obj"
+BOAT_TEXTURE = "./models/ship1/boat.001.png"
+FLAGSHIP_MODEL = "./models/Boats/Galleon_Flying.FBX"
+GALLEON_MODEL = "./models/Boats/Galleon.FBX"
+SHIP_TEXTURE = "./textures/Ships 1.tga"
+TREE_MODEL = "./models/tree/Lowpoly_tree_sample.obj"
+ROCK_MODEL = "./models/Free rock/Rock_1.fbx"
+ROCK_TEXTURE = "./models/Free rock/Yeni klasör/Rock_1_Base_Color.jpg"
+MUSKETEER_CLIPS = dict(idle="./models/Musketeer/Musketeer_idle.fbx",
+                       run="./models/Musketeer/Musketeer_run.fbx",
+                       jump="./models/Musketeer/Musketeer_jump.fbx",
+                       victory="./models/Musketeer/Musketeer_victory.fbx")
+MUSKETEER_TEXTURE = "./models/Musketeer/texture/texture.png"
+SEAGULL_MODEL = "./models/seagull/seagul.FBX"
+SEAGULL_TEXTURE = "./models/seagull/gull.png"
+GROUND_TEXMAP = "mappings/ground_texmap_256.png"
+GROUND_HMAP = "mappings/ground_hmap_256.png"
+
+SCENE_MODELS = [BOAT_MODEL, FLAGSHIP_MODEL, GALLEON_MODEL, TREE_MODEL,
+                ROCK_MODEL, *MUSKETEER_CLIPS.values(), SEAGULL_MODEL]
+SCENE_IMAGES = [BOAT_TEXTURE, SHIP_TEXTURE, ROCK_TEXTURE, MUSKETEER_TEXTURE,
+                SEAGULL_TEXTURE, *TERRAIN_TEXTURES.values(), GROUND_TEXMAP,
+                GROUND_HMAP]
+
+# Samples per second of the baked tables replacing keyframe interpolation
+ANIMATION_BAKE_RATE = 30
+
+def prefetch_scene_assets(wait=False):
+    """ Submit all model imports and image decodes at once to the asset loader
+        workers. The constructors then only wait on each result when they
+        load it """
+    for file in SCENE_MODELS:
+        prefetch_scene(file)
+    for file in SCENE_IMAGES:
+        prefetch_image(file)
+    if wait:
+        asset_loader.wait()
+
+
+def bake(node, name):
+    # Merge the static meshes of a model, one draw call per material
+    before, after = bake_static(node)
+    print('Baked', name, '\t(%d draw calls -> %d)' % (before, after))
+    return node
+
 def construct_boat(shader, light_dir):
-    boat_nodeList = load(file="./models/ship1/pirate_baot.obj", 
+    boat_nodeList = load(file=BOAT_MODEL, 
                          shader=shader,
-                         tex_file="./models/ship1/boat.001.png",
+                         tex_file=BOAT_TEXTURE,
                          light_dir=light_dir,
                          k_a = np.array((0.05, 0.05, 0.05)),
                          k_d = np.array((0.8, 0.8, 0.8)),
                          k_s = np.array((0.2, 0.2, 0.2)),
                          s=64)
     boat = Node(children=boat_nodeList, transform=translate(0, -1, 0))
-    return boat
+    return bake(boat, 'boat')
 
 def construct_flagship(shader, light_dir):
-    flagship_nodeList =load(file="./models/Boats/Galleon_Flying.FBX",
+    flagship_nodeList =load(file=FLAGSHIP_MODEL,
                             shader=shader, 
-                            tex_file="./textures/Ships 1.tga",
+                            tex_file=SHIP_TEXTURE,
                             light_dir=light_dir,
                             k_a = np.array((0.05, 0.05, 0.05)),
                             k_d = np.array((0.6, 0.6, 0.6)),
                             k_s = np.array((0.1, 0.1, 0.1)),
                             s=64)
     flagship = Node(children=flagship_nodeList, transform=translate(0, 0, 0) @ rotate((0.0, 1.0, 0.0), -90.0) @ scale(0.8, 0.8, 0.8))
-    return flagship
+    return bake(flagship, 'flagship')
 
 def construct_galleon(shader, light_dir):
-    galleon_nodeList =load(file="./models/Boats/Galleon.FBX",
+    galleon_nodeList =load(file=GALLEON_MODEL,
                             shader=shader, 
-                            tex_file="./textures/Ships 1.tga",
+                            tex_file=SHIP_TEXTURE,
                             light_dir=light_dir,
                             k_a = np.array((0.05, 0.05, 0.05)),
                             k_d = np.array((0.6, 0.6, 0.6)),
                             k_s = np.array((0.1, 0.1, 0.1)),
                             s=20)
     galleon = Node(children=galleon_nodeList, transform=translate(0, 0, 0) @ rotate((0.0, 1.0, 0.0), -90.0) @ scale(0.5, 0.5, 0.5))
-    return galleon
+    return bake(galleon, 'galleon')
 
-def construct_random_tree(shader, light_dir, hmap_file):
-    treeTotalNode = Node(transform=translate(0, 0, 0))
-    hmap = np.asarray(Image.open(hmap_file).convert('RGB'))
-    tree_nodeList = load("./models/tree/Lowpoly_tree_sample.obj", 
+def construct_random_tree(shader, light_dir, hmap_file, count=10):
+    # All trees are instances of one model, drawn with one call per submesh
+    tree_nodeList = load(TREE_MODEL, 
                             shader,
                             light_dir=light_dir)
-    for i in range(0, 10):
-        xpos = random.randint(0, 255)
-        zpos = random.randint(160, 255)
-        ypos = get_height(hmap, xpos, zpos)
-        tree = Node(transform=translate(xpos, ypos, zpos))
-        for node in tree_nodeList:
-            tree.add(node)
-        treeTotalNode.add(tree)
-        
-    return treeTotalNode
-
-def construct_rocks(shader, light_dir):
-    rock_rootNode = Node(transform=translate(0, 0, 0))
-    rock_nodeList =load(file="./models/Free rock/Rock_1.fbx",
+    positions = np.array([(random.randint(0, 255), random.randint(160, 255))
+                          for i in range(0, count)], 'f')
+    # heights of all trees in one heightfield query
+    heights = load_heightfield(hmap_file).height(positions[:, 0], positions[:, 1])
+    transforms = np.tile(np.identity(4, 'f'), (count, 1, 1))
+    transforms[:, :3, 3] = np.column_stack((positions[:, 0], heights, positions[:, 1]))
+
+    return InstancedNode(tree_nodeList, transforms)
+
+def construct_rocks(shader, light_dir, count=20):
+    # All rocks are instances of one model, drawn with one call per submesh
+    rock_nodeList =load(file=ROCK_MODEL,
                             shader=shader, 
+                            tex_file=ROCK_TEXTURE,
                             light_dir=light_dir,
                             k_a = np.array((0.05, 0.05, 0.005)),
                             k_d = np.array((0.7, 0.7, 0.7)),
                             k_s = np.array((0.07, 0.07, 0.07)),
                             s=20)
-    for i in range(0, 20):
+    transforms = []
+    for i in range(0, count):
         xpos = random.randint(0, 255)
         zpos = random.randint(128, 160)
         angle = random.randint(0, 360)
-        rock_node = Node(transform=translate(xpos, 0, zpos) @ rotate((1.0, 0.0, 0.0), angle) @ scale(0.0025, 0.0025, 0.0025))
-        for node in rock_nodeList:
-            rock_node.add(node)
-        rock_rootNode.add(rock_node)
-    return rock_rootNode
+        transforms.append(translate(xpos, 0, zpos) @ rotate((1.0, 0.0, 0.0), angle) @ scale(0.0025, 0.0025, 0.0025))
+    return InstancedNode(rock_nodeList, transforms)
 
 def construct_musketeer_onboat(shader, light_dir):
-    musketeer_nodeList =load(file="./models/Musketeer/Musketeer_idle.fbx",
+    musketeer_nodeList =load(file=MUSKETEER_CLIPS['idle'],
                             shader=shader, 
-                            tex_file="./models/Musketeer/texture/texture.png",
+                            tex_file=MUSKETEER_TEXTURE,
                             light_dir=light_dir,
                             k_a = np.array((0.3, 0.3, 0.3)),
                             k_d = np.array((0.6, 0.6, 0.6)),
                             k_s = np.array((0.2, 0.2, 0.2)),
-                            s=32)
+                            s=32, bake_rate=ANIMATION_BAKE_RATE)
     musketeer = Node(children=musketeer_nodeList, transform=translate(13.0, 15.5, 34.5) @ rotate((1.0, 0.0, 0.0), -5.0) @ scale(0.25, 0.25, 0.25))
     return musketeer
 
@@ -102,23 +149,27 @@ def construct_golem(shader, light_dir):
                          k_a = np.array((0.3, 0.3, 0.3)),
                          k_d = np.array((0.6, 0.6, 0.6)),
                          k_s = np.array((0.2, 0.2, 0.2)),
-                         s=32)
+                         s=32, bake_rate=ANIMATION_BAKE_RATE)
     golem = Node(children=golem_nodeList, transform=translate(128, 0, 190) @ rotate((0.0, 1.0, 0.0), 180.0) @ scale(0.25, 0.25, 0.25))
     return golem
 
 def construct_seagulls_formation(shader, light_dir, center, radius, seagull_count_each_side):
     seagull_formation_node = Node(transform=translate(0, 0, 0))
-    seagull_nodeList = load(file="./models/seagull/seagul.FBX",
-                            shader=shader, 
-                            tex_file="./models/seagull/gull.png",
-                            light_dir=light_dir)
     heightList = []
     for i in range(0, 33):
         heightList.append(random.randint(-5, 5))
     for i in range(1-seagull_count_each_side, seagull_count_each_side):
+        # each seagull is its own instance of the cached model, with own bones
+        seagull_nodeList = load_seagull(shader, light_dir)
         seagull_formation_node.add(construct_seagull(shader, light_dir, center, radius, i, seagull_nodeList, heightList))
     return seagull_formation_node
 
+def load_seagull(shader, light_dir):
+    return load(file=SEAGULL_MODEL,
+                shader=shader, 
+                tex_file=SEAGULL_TEXTURE,
+                light_dir=light_dir, bake_rate=ANIMATION_BAKE_RATE)
+
 # Load a seagull. 
 # relative_position : The position in the formation of seagull. -3 means it's the 3rd seagull on the left of the leading seagull.
 def construct_seagull(shader, light_dir, center, radius, relative_position, seagull_nodeList, heightList):
@@ -137,7 +188,8 @@ def construct_seagull(shader, light_dir, center, radius, relative_position, seag
                    32: quaternion_from_euler(0, 360, 0)
                   }
     scale_keys = {0: 1}
-    keynode = KeyFrameControlNode(translate_keys, rotate_keys, scale_keys)
+    keynode = KeyFrameControlNode(translate_keys, rotate_keys, scale_keys,
+                                  bake_rate=ANIMATION_BAKE_RATE)
     keynode.add(seagull_node)
     return keynode
 
@@ -146,14 +198,10 @@ def construct_seagulls_and_animation(shader, light_dir, center, radius):
     seagullL = Node(transform=translate(0, 0, 0) @ rotate((0.0, 1.0, 0.0), -90.0) @ scale(0.25, 0.25, 0.25))
     seagullC = Node(transform=translate(0, 0, 0) @ rotate((0.0, 1.0, 0.0), -90.0) @ scale(0.25, 0.25, 0.25))
     seagullR = Node(transform=translate(0, 0, 0) @ rotate((0.0, 1.0, 0.0), -90.0) @ scale(0.25, 0.25, 0.25))
-    seagull_nodeList =load(file="./models/seagull/seagul.FBX",
-                            shader=shader, 
-                            tex_file="./models/seagull/gull.png",
-                            light_dir=light_dir)
-    for node in seagull_nodeList:        
-        seagullL.add(node)
-        seagullC.add(node)
-        seagullR.add(node)
+    # one instance of the cached seagull model each, sharing GPU buffers only
+    seagullL.add(*load_seagull(shader, light_dir))
+    seagullC.add(*load_seagull(shader, light_dir))
+    seagullR.add(*load_seagull(shader, light_dir))
 
     translate_keysL = {}
     translate_keysR = {}
@@ -172,11 +220,14 @@ def construct_seagulls_and_animation(shader, light_dir, center, radius):
                    32: quaternion_from_euler(0, 360, 0)
                   }
     scale_keys = {0: 1}
-    keynodeL = KeyFrameControlNode(translate_keysL, rotate_keys, scale_keys)
+    keynodeL = KeyFrameControlNode(translate_keysL, rotate_keys, scale_keys,
+                                   bake_rate=ANIMATION_BAKE_RATE)
     keynodeL.add(seagullL)
-    keynodeR = KeyFrameControlNode(translate_keysR, rotate_keys, scale_keys)
+    keynodeR = KeyFrameControlNode(translate_keysR, rotate_keys, scale_keys,
+                                   bake_rate=ANIMATION_BAKE_RATE)
     keynodeR.add(seagullR)
-    keynodeC = KeyFrameControlNode(translate_keysC, rotate_keys, scale_keys)
+    keynodeC = KeyFrameControlNode(translate_keysC, rotate_keys, scale_keys,
+                                   bake_rate=ANIMATION_BAKE_RATE)
     keynodeC.add(seagullC)
     seagull_final_animation_node.add(keynodeL, keynodeR, keynodeC)
     return seagull_final_animation_node
@@ -187,11 +238,10 @@ def construct_ship_animation(x, z, offset, yrange):
         translate_keys[time] = vec(x, yrange * math.sin(((time+offset) % 16) * math.pi / 8), z)
     rotate_keys = {0: quaternion()}
     scale_keys = {0: 1}
-    keynode = KeyFrameControlNode(translate_keys, rotate_keys, scale_keys)
+    keynode = KeyFrameControlNode(translate_keys, rotate_keys, scale_keys,
+                                  bake_rate=ANIMATION_BAKE_RATE)
     return keynode
 
-def get_height(hmap, x, z):
-    # Get the height from the input heightmap
-    height = hmap[int(x), int(z), 0]
-    height = height * 25 / 256    # 25 is the max height of the ground
-    return height
\ No newline at end of file
+def get_height(hmap_file, x, z):
+    # Get the bilinearly interpolated ground height from the input heightmap
+    return load_heightfield(hmap_file).height(x, z)
\ No newline at end of file
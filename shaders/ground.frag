@@ -9,8 +9,12 @@ in vec2 frag_tex_coords;
 // fragment position and normal of the fragment, in WORLD coordinates
 in vec3 w_position, w_normal;
 
-// light dir, in world coordinates
-uniform vec3 light_dir;
+// per frame camera & lighting data, shared by all programs (binding 0)
+layout(std140, row_major) uniform FrameData {
+    mat4 view, projection;
+    vec3 w_camera_position;     // world camera position
+    vec3 light_dir;             // light dir, in world coordinates
+};
 
 // material properties
 uniform vec3 k_d;
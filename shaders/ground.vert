@@ -6,8 +6,13 @@ in vec3 normal;
 in vec2 tex_coords;
 
 uniform mat4 model;
-uniform mat4 view;
-uniform mat4 projection;
+
+// per frame camera & lighting data, shared by all programs (binding 0)
+layout(std140, row_major) uniform FrameData {
+    mat4 view, projection;
+    vec3 w_camera_position;     // world camera position
+    vec3 light_dir;             // light dir, in world coordinates
+};
 
 out vec2 frag_tex_coords;
 
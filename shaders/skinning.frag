@@ -7,16 +7,17 @@ in vec3 w_position, w_normal;
 
 uniform sampler2D diffuse_map;
 
-// light dir, in world coordinates
-uniform vec3 light_dir;
+// per frame camera & lighting data, shared by all programs (binding 0)
+layout(std140, row_major) uniform FrameData {
+    mat4 view, projection;
+    vec3 w_camera_position;     // world camera position
+    vec3 light_dir;             // light dir, in world coordinates
+};
 
 // material properties
 uniform vec3 k_d, k_a, k_s;
 uniform float s;
 
-// world camera position
-uniform vec3 w_camera_position;
-
 out vec4 out_color;
 
 void main() {
@@ -2,11 +2,33 @@
 // TODO: complete the loop for TP7 exercise 1
 
 // ---- camera geometry
-uniform mat4 model, projection, view;
+uniform mat4 model;
+
+// per frame camera & lighting data, shared by all programs (binding 0)
+layout(std140, row_major) uniform FrameData {
+    mat4 view, projection;
+    vec3 w_camera_position;     // world camera position
+    vec3 light_dir;             // light dir, in world coordinates
+};
 
 // ---- skinning globals and attributes
 const int MAX_VERTEX_BONES=4, MAX_BONES=128;
-uniform mat4 bone_matrix[MAX_BONES];
+uniform mat4 bone_matrix[MAX_BONES];    // fallback, without palette buffer
+
+// bone palettes of all skeletons, 4 texels (matrix rows) per bone
+uniform samplerBuffer bone_palette;
+uniform int bone_offset;                // our first bone in bone_palette
+uniform int bone_buffer;                // 1 to use bone_palette
+
+mat4 bone(int id) {
+    if (bone_buffer == 0)
+        return bone_matrix[id];
+    int texel = 4 * (bone_offset + id);
+    return transpose(mat4(texelFetch(bone_palette, texel),
+                          texelFetch(bone_palette, texel + 1),
+                          texelFetch(bone_palette, texel + 2),
+                          texelFetch(bone_palette, texel + 3)));
+}
 
 // ---- vertex attributes
 in vec3 position;
@@ -21,9 +43,20 @@ out vec3 w_position, w_normal;   // in world coordinates
 void main() {
     
     // ------ creation of the skinning deformation matrix
+    // bone_matrix only holds MAX_BONES bones: weights of the others are
+    // dropped and the kept ones renormalized, as the palette has them all
     mat4 skin_matrix = mat4(0);
-    for (int b=0; b < MAX_VERTEX_BONES; b++)    
-        skin_matrix +=  bone_weights[b] * bone_matrix[int(bone_ids[b])];
+    float total = 0, kept = 0;
+    for (int b=0; b < MAX_VERTEX_BONES; b++) {
+        int id = int(bone_ids[b]);
+        total += bone_weights[b];
+        if (bone_buffer == 1 || id < MAX_BONES) {
+            skin_matrix +=  bone_weights[b] * bone(id);
+            kept += bone_weights[b];
+        }
+    }
+    if (kept > 0 && kept < total)
+        skin_matrix *= total / kept;
 
     // ------ compute world and normalized eye coordinates of our vertex
     vec4 w_position4 = skin_matrix * vec4(position, 1.0);
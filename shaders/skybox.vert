@@ -4,8 +4,13 @@ in vec3 position;
 out vec3 TexCoords;
 
 uniform mat4 model;
-uniform mat4 projection;
-uniform mat4 view;
+
+// per frame camera & lighting data, shared by all programs (binding 0)
+layout(std140, row_major) uniform FrameData {
+    mat4 view, projection;
+    vec3 w_camera_position;     // world camera position
+    vec3 light_dir;             // light dir, in world coordinates
+};
 
 void main()
 {
@@ -5,14 +5,26 @@ in vec3 position;
 in vec3 normal;
 in vec2 tex_coord;
 
-uniform mat4 model, view, projection;
+// per instance transform, used when drawing instanced props
+in mat4 instance_model;
+uniform int instanced;
+
+uniform mat4 model;
+
+// per frame camera & lighting data, shared by all programs (binding 0)
+layout(std140, row_major) uniform FrameData {
+    mat4 view, projection;
+    vec3 w_camera_position;     // world camera position
+    vec3 light_dir;             // light dir, in world coordinates
+};
 
 // position and normal for the fragment shader, in WORLD coordinates
 out vec3 w_position, w_normal;   // in world coordinates
 out vec2 frag_tex_coords;
 
 void main() {
-    vec4 w_position4 = model * vec4(position, 1.0);
+    mat4 world = instanced != 0 ? model * instance_model : model;
+    vec4 w_position4 = world * vec4(position, 1.0);
     gl_Position = projection * view * w_position4;
 
     frag_tex_coords = tex_coord;
@@ -21,6 +33,6 @@ void main() {
     w_position = w_position4.xyz / w_position4.w;  // dehomogenize
 
     // fragment normal in world coordinates
-    mat3 nit_matrix = transpose(inverse(mat3(model)));
+    mat3 nit_matrix = transpose(inverse(mat3(world)));
     w_normal = normalize(nit_matrix * normal);
 }
\ No newline at end of file
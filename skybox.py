@@ -4,7 +4,8 @@ from ctypes import sizeof
 import OpenGL.GL as GL
 import numpy as np
 from PIL import Image
-from core import Node
+from core import Node, frame_stats
+from transform import identity
 
 class Skybox(Node):
     def __init__(self, shader_skybox, path):
@@ -106,22 +107,15 @@ class Skybox(Node):
 
         return texture_ID
 
-    def draw(self, model, view, projection):
-        GL.glUseProgram(self.shader.glid)
+    def draw(self, model=identity(), **_other_uniforms):
+        """ camera matrices come from the shared FrameData uniform block """
+        self.shader.use()
         GL.glDepthFunc(GL.GL_LEQUAL)
-        
-        self.model_loc = GL.glGetUniformLocation(self.shader.glid, 'model')
-        self.view_loc = GL.glGetUniformLocation(self.shader.glid, 'view')
-        self.projection_loc = GL.glGetUniformLocation(self.shader.glid, "projection")
-        self.skybox_loc = GL.glGetUniformLocation(self.shader.glid, "skybox")
-
-        GL.glUniformMatrix4fv(self.model_loc, 1, True, model)
-        GL.glUniformMatrix4fv(self.view_loc, 1, True, view)
-        GL.glUniformMatrix4fv(self.projection_loc, 1, True, projection)
-        GL.glUniform1i(self.skybox_loc, 0)
+        self.shader.set_uniforms(dict(model=model, skybox=0))
         
         GL.glBindVertexArray(self.skybox_vao)
         GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.skybox_texture)
         GL.glDrawArrays(GL.GL_TRIANGLES, 0, 36)
+        frame_stats.update(draw_calls=1, triangles=12, texture_binds=1)
         GL.glBindVertexArray(0)
         GL.glDepthMask(GL.GL_FALSE)
\ No newline at end of file
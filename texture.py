@@ -1,6 +1,23 @@
+import os                           # os function, i.e. resolving file paths
+
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # decoded images are numpy arrays
 from PIL import Image               # load texture maps
 
+from asset_loader import asset_loader
+from core import frame_stats
+
+
+def decode_image(tex_file):
+    """ image file as a height x width x 4 RGBA uint8 array, no GL involved
+        so that it can run on a loader worker """
+    return np.asarray(Image.open(tex_file).convert('RGBA'))
+
+
+def prefetch_image(tex_file):
+    """ start decoding an image on the default asset loader """
+    asset_loader.submit('image', tex_file, decode_image)
+
 
 # -------------- OpenGL Texture Wrapper ---------------------------------------
 class Texture:
@@ -10,24 +27,82 @@ class Texture:
                  tex_type=GL.GL_TEXTURE_2D):
         self.glid = GL.glGenTextures(1)
         self.type = tex_type
+        self.nbytes = 0                 # GPU memory used, mipmaps included
         try:
-            # imports image as a numpy array in exactly right format
-            tex = Image.open(tex_file).convert('RGBA')
+            # imports image as a numpy array in exactly right format, decoded
+            # in the background if it was prefetched
+            tex = asset_loader.result('image', tex_file)
+            tex = decode_image(tex_file) if tex is None else tex
+            height, width = tex.shape[:2]
             GL.glBindTexture(tex_type, self.glid)
-            GL.glTexImage2D(tex_type, 0, GL.GL_RGBA, tex.width, tex.height,
-                            0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex.tobytes())
+            GL.glTexImage2D(tex_type, 0, GL.GL_RGBA, width, height,
+                            0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex)
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_S, wrap_mode)
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_T, wrap_mode)
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MIN_FILTER, min_filter)
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MAG_FILTER, mag_filter)
             GL.glGenerateMipmap(tex_type)
-            # print(f'Loaded texture {tex_file} ({tex.width}x{tex.height}'
+            self.nbytes = width * height * 4 * 4 // 3
+            # print(f'Loaded texture {tex_file} ({width}x{height}'
             #       f' wrap={str(wrap_mode).split()[0]}'
             #       f' min={str(min_filter).split()[0]}'
             #       f' mag={str(mag_filter).split()[0]})')
         except FileNotFoundError:
             print("ERROR: unable to load texture file %s" % tex_file)
 
+    def delete(self):
+        """ free the GL texture, the object must not be used anymore """
+        GL.glDeleteTextures(1, [self.glid])
+
+
+# -------------- Shared textures -----------------------------------------------
+class TextureRegistry:
+    """ Hands out one shared, reference counted Texture per image file and
+        sampler settings, so that each image is decoded and uploaded once """
+    def __init__(self):
+        self.entries = {}       # key -> [texture, reference count]
+        self.keys = {}          # id(texture) -> key, to release textures
+        self.hits, self.misses, self.bytes_saved = 0, 0, 0
+
+    def acquire(self, tex_file, wrap_mode=GL.GL_REPEAT,
+                mag_filter=GL.GL_LINEAR, min_filter=GL.GL_LINEAR_MIPMAP_LINEAR,
+                tex_type=GL.GL_TEXTURE_2D):
+        """ shared texture for these settings, created on first request """
+        key = (os.path.realpath(tex_file), int(wrap_mode), int(mag_filter),
+               int(min_filter), int(tex_type))
+        entry = self.entries.get(key)
+        if entry:
+            entry[1] += 1
+            self.hits += 1
+            self.bytes_saved += entry[0].nbytes
+            return entry[0]
+        self.misses += 1
+        texture = Texture(tex_file, wrap_mode, mag_filter, min_filter, tex_type)
+        self.entries[key] = [texture, 1]
+        self.keys[id(texture)] = key
+        return texture
+
+    def release(self, texture):
+        """ drop one reference, the GL texture is deleted with the last one """
+        key = self.keys.get(id(texture))
+        if key is None:
+            return
+        entry = self.entries[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.entries[key], self.keys[id(texture)]
+            texture.delete()
+
+    def report(self):
+        """ print sharing statistics """
+        print('Textures: %d unique, %d hits, %d misses, %.1f MB GPU memory saved'
+              % (len(self.entries), self.hits, self.misses,
+                 self.bytes_saved / 2**20))
+
+
+# default registry, used by the scene loaders
+texture_registry = TextureRegistry()
+
 # -------------- Textured mesh decorator --------------------------------------
 class Textured:
     """ Drawable mesh decorator that activates and binds OpenGL textures """
@@ -35,9 +110,21 @@ class Textured:
         self.drawable = drawable
         self.textures = textures
 
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+    @property
+    def bounds(self):
+        """ bounding box of the decorated drawable """
+        return getattr(self.drawable, 'bounds', None)
+
+    def draw(self, primitives=GL.GL_TRIANGLES, render_queue=None, **uniforms):
+        if render_queue is not None:    # queue binds them with the draw item
+            uniforms['textures'] = {**uniforms.get('textures', {}),
+                                    **self.textures}
+            self.drawable.draw(primitives=primitives,
+                               render_queue=render_queue, **uniforms)
+            return
         for index, (name, texture) in enumerate(self.textures.items()):
             GL.glActiveTexture(GL.GL_TEXTURE0 + index)
             GL.glBindTexture(texture.type, texture.glid)
             uniforms[name] = index
+        frame_stats['texture_binds'] += len(self.textures)
         self.drawable.draw(primitives=primitives, **uniforms)
\ No newline at end of file
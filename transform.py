@@ -114,6 +114,55 @@ def lookat(eye, target, up):
     return rotation @ translate(-eye)
 
 
+# bounding boxes & view frustum ----------------------------------------------
+def bounds(points):
+    """ axis aligned bounding box of 3d points, as a 2x3 array (min, max) """
+    points = np.asarray(points, 'f').reshape(-1, np.shape(points)[-1])[:, :3]
+    if not len(points):
+        return empty_bounds()
+    return np.array((points.min(axis=0), points.max(axis=0)), 'f')
+
+
+def empty_bounds():
+    """ bounding box containing nothing, neutral element of bounds_union """
+    return np.array(((np.inf,) * 3, (-np.inf,) * 3), 'f')
+
+
+def bounds_union(*boxes):
+    """ smallest bounding box containing all given bounding boxes """
+    boxes = np.asarray(boxes, 'f').reshape(-1, 2, 3)
+    return np.array((boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)), 'f')
+
+
+def transform_bounds(box, matrix):
+    """ bounding box of a bounding box transformed by an affine 4x4 matrix """
+    if np.any(box[0] > box[1]):  # empty box stays empty
+        return box
+    center, half = (box[0] + box[1]) / 2, (box[1] - box[0]) / 2
+    center = matrix[:3, :3] @ center + matrix[:3, 3]
+    half = np.abs(matrix[:3, :3]) @ half
+    return np.array((center - half, center + half), 'f')
+
+
+def frustum_planes(matrix):
+    """ 6 view frustum planes (a, b, c, d) of a projection @ view matrix,
+        a point is inside when a*x + b*y + c*z + d >= 0 for all of them """
+    rows = np.asarray(matrix, 'f')
+    planes = np.array((rows[3] + rows[0], rows[3] - rows[0],   # left, right
+                       rows[3] + rows[1], rows[3] - rows[1],   # bottom, top
+                       rows[3] + rows[2], rows[3] - rows[2]))  # near, far
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def bounds_outside(box, planes):
+    """ True if the bounding box is entirely behind one of the planes """
+    if np.any(box[0] > box[1]):  # empty boxes are kept, nodes may need update
+        return False
+    center, half = (box[0] + box[1]) / 2, (box[1] - box[0]) / 2
+    distance = planes[:, :3] @ center + planes[:, 3]
+    return bool(np.any(distance < -(np.abs(planes[:, :3]) @ half)))
+
+
 # quaternion functions -------------------------------------------------------
 def quaternion(x=vec(0., 0., 0.), y=0.0, z=0.0, w=1.0):
     """ Init quaternion, w=real and, x,y,z or vector x imaginary components """
@@ -173,6 +222,37 @@ def quaternion_slerp(q0, q1, fraction):
     return q0*math.cos(theta) + q2*math.sin(theta)
 
 
+# batched versions, one quaternion or transform per row ----------------------
+def quaternion_slerps(q0, q1, fraction):
+    """ Row by row quaternion_slerp of two (N, 4) arrays, by N fractions """
+    q0 = q0 / np.linalg.norm(q0, axis=1, keepdims=True)
+    q1 = q1 / np.linalg.norm(q1, axis=1, keepdims=True)
+    dot = np.einsum('ij,ij->i', q0, q1)
+    q1 = np.where((dot > 0)[:, None], q1, -q1)  # shorter path, as slerp
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1, 1)) * fraction
+    q2 = q1 - q0 * dot[:, None]
+    norm = np.linalg.norm(q2, axis=1, keepdims=True)
+    q2 = np.divide(q2, norm, out=np.zeros_like(q2), where=norm > 0)
+    return q0 * np.cos(theta)[:, None] + q2 * np.sin(theta)[:, None]
+
+
+def trs_matrices(translations, rotations, scales, out=None):
+    """ (N, 4, 4) translate @ quaternion_matrix @ scale matrices, from (N, 3)
+        translations, (N, 4) quaternions and (N, 3) scale factors """
+    q = rotations / np.linalg.norm(rotations, axis=1, keepdims=True)
+    w, x, y, z = q.T
+    out = np.zeros((len(q), 4, 4), 'f') if out is None else out
+    out[:, 0, 0], out[:, 0, 1], out[:, 0, 2] = 1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)
+    out[:, 1, 0], out[:, 1, 1], out[:, 1, 2] = 2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)
+    out[:, 2, 0], out[:, 2, 1], out[:, 2, 2] = 2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)
+    out[:, :3, :3] *= scales[:, None, :]      # scale columns
+    out[:, :3, 3] = translations
+    out[:, 3] = (0, 0, 0, 1)
+    return out
+
+
 # a trackball class based on provided quaternion functions -------------------
 class Trackball:
     """Virtual trackball for 3D scene viewing. Independent of window system."""
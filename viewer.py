@@ -7,40 +7,50 @@ import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 
 from camera import Camera
-from core import Node
+from core import Node, RenderQueue, UniformBuffer, UNIFORM_BLOCKS, frame_stats
 from musketeerOnBeach import MusketeerOnBeach
-from transform import identity, perspective
-# our transform functions
-from transform import identity
+from pipeline import UpdatePipeline
+from profiler import Profiler
+from transform import perspective, frustum_planes
+
+REPORT_PERIOD = 1.0     # seconds between profile summaries
 
 # ------------  Viewer class & window management ------------------------------
 class Viewer(Node):
     """ GLFW viewer window, with classic initialization & graphics loop """
 
-    def __init__(self, width=640, height=480):
+    def __init__(self, width=640, height=480, light_dir=(0, -1, 0),
+                 pipelined=False, profile=None, window=True):
         super().__init__()
         self.lastFrame = 0.0
-
-        # version hints: create GL window with >= OpenGL 3.3 and core profile
-        glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
-        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
-        glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
-        glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
-        glfw.window_hint(glfw.RESIZABLE, True)
-        self.win = glfw.create_window(width, height, 'Viewer', None, None)
-
-        # make win's OpenGL context current; no OpenGL calls can happen before
-        glfw.make_context_current(self.win)
+        self.pipelined = pipelined
+        # profile: None, or a trace file name ('' for none) to report timings
+        self.profile = profile
+        # without window, frames are drawn in the current context, e.g. an
+        # offscreen one, by render_frame() calls: no run loop nor events
+        self.win, self.size = None, (width, height)
+
+        if window:
+            # version hints: create GL window with >= OpenGL 3.3 and core profile
+            glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
+            glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
+            glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
+            glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+            glfw.window_hint(glfw.RESIZABLE, True)
+            self.win = glfw.create_window(width, height, 'Viewer', None, None)
+
+            # make win's OpenGL context current; no OpenGL calls can happen before
+            glfw.make_context_current(self.win)
+
+            # register event handlers
+            glfw.set_key_callback(self.win, self.on_key)
+            glfw.set_window_size_callback(self.win, self.on_size)
 
         # Init camera
         camera_pos = np.array((-80.0, 15.0, 0.0))
         world_up = np.array((0.0, 1.0, 0.0))
         self.camera = Camera(camera_pos, world_up, pitch=-15.0)
 
-        # register event handlers
-        glfw.set_key_callback(self.win, self.on_key)
-        glfw.set_window_size_callback(self.win, self.on_size)
-
         # useful message to check OpenGL renderer characteristics
         print('OpenGL', GL.glGetString(GL.GL_VERSION).decode() + ', GLSL',
               GL.glGetString(GL.GL_SHADING_LANGUAGE_VERSION).decode() +
@@ -51,38 +61,112 @@ class Viewer(Node):
         GL.glEnable(GL.GL_CULL_FACE)   # backface culling enabled (TP2)
         GL.glEnable(GL.GL_DEPTH_TEST)  # depth test now enabled (TP2)
 
+        # camera & lighting data, shared by all programs, set once per frame
+        self.light_dir = light_dir
+        self.frame_data = UniformBuffer(UNIFORM_BLOCKS['FrameData'],
+                                        view=16, projection=16,
+                                        w_camera_position=3, light_dir=3)
+
+        # scene traversal queues draws, issued sorted by program and textures
+        self.render_queue = RenderQueue()
+
         # cyclic iterator to easily toggle polygon rendering modes
         self.fill_modes = cycle([GL.GL_LINE, GL.GL_POINT, GL.GL_FILL])
 
     def run(self):
-        """ Main render loop for this OpenGL window """
+        """ Main render loop for this OpenGL window. Pipelined, animations
+            of the next frame are updated on a worker thread while this one
+            is submitted, the scene being drawn one frame late. Frames are
+            always timed, profiling reports them every REPORT_PERIOD seconds
+            and traces them to the profile file """
+        pipeline = self.make_pipeline()
+        profiling = self.profile is not None
+        profiler = Profiler(trace_file=self.profile or None, gpu=profiling)
+        last_report = glfw.get_time()
         while not glfw.window_should_close(self.win):
-            
+            profiler.begin_frame()
+
             # Set frame time
             self.currentFrame = glfw.get_time()
             deltaTime = self.currentFrame - self.lastFrame
             self.lastFrame = self.currentFrame
+            self.render_frame(self.currentFrame, deltaTime, profiler, pipeline)
+
+            # window title set every REPORT_PERIOD: a window system round trip
+            since_report = self.currentFrame - last_report   # < 0 if time reset
+            if not 0 <= since_report < REPORT_PERIOD:
+                last_report = self.currentFrame
+                if profiling:
+                    summary = profiler.summary()
+                    print('Profile:', summary)
+                    glfw.set_window_title(self.win, 'Viewer - ' + summary)
+                else:
+                    stats = frame_stats
+                    glfw.set_window_title(self.win, (
+                        'Viewer - %d drawn, %d culled, %d/%d uniforms, %d/%d '
+                        'programs set, %d state changes (%d unsorted)') % (
+                        stats['drawn'], stats['culled'], stats['uniforms_set'],
+                        stats['uniforms_set'] + stats['uniforms_skipped'],
+                        stats['program_binds'],
+                        stats['program_binds'] + stats['program_binds_skipped'],
+                        stats['state_changes'], stats['state_changes_unsorted']))
 
+            # flush render commands, and swap draw buffers
+            with profiler.scope('swap'):
+                glfw.swap_buffers(self.win)
+
+            # Poll for and process events
+            with profiler.scope('input'):
+                glfw.poll_events()
+            profiler.end_frame()
+
+        profiler.close()
+        if pipeline is not None:
+            pipeline.shutdown()
+
+    def make_pipeline(self):
+        """ update pipeline of our animated nodes if pipelined, else None """
+        if not self.pipelined:
+            return None
+        pipeline = UpdatePipeline()
+        print('Pipelined update of', pipeline.collect(self), 'animated nodes')
+        return pipeline
+
+    def render_frame(self, frame_time, delta_time, profiler, pipeline=None):
+        """ draw the scene at frame_time, camera moved by the keys held for
+            delta_time seconds if we have a window. Pipelined, the scene is
+            drawn at the time of the update published by the pipeline """
+        if pipeline is not None:    # publish update of last frame's time
+            with profiler.scope('animation'):
+                frame_time = pipeline.frame(frame_time)
+
+        with profiler.gpu_pass('scene'):
             # clear draw buffer and depth buffer (<-TP2)
             GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
 
-            win_size = glfw.get_window_size(self.win)
+            win_size = glfw.get_window_size(self.win) if self.win else self.size
 
             # Add key listenser for camera movement
-            self.camera.camera_key_handler(window=self.win, deltaTime=deltaTime)
-
-            # draw our scene objects
-            cam_pos = np.linalg.inv(self.camera.get_view_matrix())[:, 3]
-            self.draw(view=self.camera.get_view_matrix(),
-                      projection=perspective(fovy=45.0, aspect=(win_size[0]/win_size[1]), near=0.1, far=1000.0),
-                      model=identity(),
-                      w_camera_position=cam_pos)
-
-            # flush render commands, and swap draw buffers
-            glfw.swap_buffers(self.win)
-
-            # Poll for and process events
-            glfw.poll_events()
+            if self.win is not None:
+                with profiler.scope('input'):
+                    self.camera.camera_key_handler(window=self.win, deltaTime=delta_time)
+
+            # draw our scene objects, skipping those outside the view frustum
+            with profiler.scope('uniforms'):
+                view = self.camera.get_view_matrix()
+                projection = perspective(fovy=45.0, aspect=(win_size[0]/win_size[1]), near=0.1, far=1000.0)
+                cam_pos = np.linalg.inv(view)[:, 3]
+                self.frame_data.update(view=view, projection=projection,
+                                       w_camera_position=cam_pos[:3],
+                                       light_dir=self.light_dir)
+            self.render_queue.camera_position = cam_pos[:3]
+            with profiler.scope('traversal'):
+                self.draw(time=frame_time,
+                          w_camera_position=cam_pos,
+                          frustum=frustum_planes(projection @ view),
+                          render_queue=self.render_queue)
+            with profiler.scope('submit'):
+                self.render_queue.flush()
 
     def on_key(self, _win, key, _scancode, action, _mods):
         """ 'Escape' quits """
@@ -119,4 +203,5 @@ class Viewer(Node):
     def constructMuskOnBeach(self, shader, light_dir, hmap_file):
         self.musk = MusketeerOnBeach(shader=shader, light_dir=light_dir, hmap_file=hmap_file)
         self.add(self.musk)
-        glfw.set_key_callback(self.win, self.on_key_musk)
\ No newline at end of file
+        if self.win is not None:
+            glfw.set_key_callback(self.win, self.on_key_musk)
\ No newline at end of file